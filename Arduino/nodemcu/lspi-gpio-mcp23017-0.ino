@@ -3,6 +3,9 @@
  * A sketch for NodeMCU devices to receive json udp data (truncated) when using :
  * [network]
  * networking = serverjson
+ *
+ * Each packet is one frame, {"seq":12,"data":[0.5,1.0,-1.0]}, with the
+ * level of every channel between 0.0 and 1.0 and -1 for channels not set
  * 
  * Send all GPIO data to a MCP23017 device
  * 
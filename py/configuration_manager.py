@@ -22,6 +22,7 @@ import logging
 import os
 import os.path
 import sys
+import time
 import warnings
 import json
 import shlex
@@ -39,6 +40,13 @@ if not HOME_DIR:
 CONFIG_DIR = HOME_DIR + '/config'
 LOG_DIR = HOME_DIR + '/logs'
 
+# seconds after the state file was written during which it is always reloaded
+STATE_SETTLE_TIME = 1.0
+
+# the [audio_processing] settings a song's .cfg file can override
+FFT_OPTIONS = ("min_frequency", "max_frequency",
+               "custom_channel_mapping", "custom_channel_frequencies")
+
 
 def _as_list(list_str, delimiter=','):
     """Return a list of items from a delimited string (after stripping whitespace).
@@ -55,6 +63,42 @@ def _as_list(list_str, delimiter=','):
     return [str.strip(item).rstrip() for item in list_str.split(delimiter)]
 
 
+def custom_audio_processing(config_filename, defaults):
+    """The fft settings for a song, with the [custom_audio_processing] overrides
+
+    :param config_filename: path and name of the song's .cfg file
+    :type config_filename: str
+
+    :param defaults: the [audio_processing] settings, at least FFT_OPTIONS
+    :type defaults: dict
+
+    :return: min_frequency, max_frequency, custom_channel_mapping and
+        custom_channel_frequencies
+    :rtype: dict
+    """
+    settings = dict((option, defaults[option]) for option in FFT_OPTIONS)
+
+    if not os.path.isfile(config_filename):
+        return settings
+
+    config = configparser.RawConfigParser(allow_no_value=True)
+    with open(config_filename) as f:
+        config.read_file(f)
+
+    cap = 'custom_audio_processing'
+    if config.has_section(cap):
+        for option in ("min_frequency", "max_frequency"):
+            if config.has_option(cap, option):
+                settings[option] = config.getfloat(cap, option)
+
+        for option in ("custom_channel_mapping", "custom_channel_frequencies"):
+            if config.has_option(cap, option):
+                temp = config.get(cap, option)
+                settings[option] = list(map(int, temp.split(','))) if temp else 0
+
+    return settings
+
+
 class Configuration(object):
     """Configuration management for the lightshow.
 
@@ -80,6 +124,8 @@ class Configuration(object):
         self.state = configparser.RawConfigParser()
 
         self.state_section = 'do_not_modify'
+        self.state_signature = None
+        self.state_loaded = 0.0
 
         self.load_config()
 
@@ -125,14 +171,47 @@ class Configuration(object):
             overrides.append(self.config_dir + "overrides.cfg")
         self.config.read(overrides)
 
-    # handle the program state / next 3 methods
+    # handle the program state / next 4 methods
     def load_state(self):
         """Force the state to be reloaded form disk."""
         with open(self.state_file) as state_fp:
             fcntl.lockf(state_fp, fcntl.LOCK_SH)
+            self.state_loaded = time.time()
+            self.state_signature = self._state_signature(os.fstat(state_fp.fileno()))
             self.state.read_file(state_fp, self.state_file)
             fcntl.lockf(state_fp, fcntl.LOCK_UN)
 
+    def refresh_state(self):
+        """Reload the state from disk only if the state file has changed
+
+        Cheap enough to call for every chunk of audio, the state file is only
+        parsed when another process (the web ui, sms) has written to it.
+
+        File timestamps are only as fine as the kernel clock tick, so a write
+        made within STATE_SETTLE_TIME of the last load could leave the same
+        signature behind.  Until the file is older than that it is reloaded
+        every time, just like load_state.
+
+        :return: True if the state was reloaded
+        :rtype: bool
+        """
+        try:
+            stat_result = os.stat(self.state_file)
+        except OSError:
+            return False
+
+        if self._state_signature(stat_result) == self.state_signature and \
+                stat_result.st_mtime < self.state_loaded - STATE_SETTLE_TIME:
+            return False
+
+        self.load_state()
+        return True
+
+    @staticmethod
+    def _state_signature(stat_result):
+        """Identify a version of the state file from its stat result"""
+        return stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns
+
     def get_state(self, name, default=""):
         """
         Get application state
@@ -174,6 +253,9 @@ class Configuration(object):
         with open(self.state_file, 'wt') as state_fp:
             fcntl.lockf(state_fp, fcntl.LOCK_EX)
             self.state.write(state_fp)
+            state_fp.flush()
+            self.state_loaded = time.time()
+            self.state_signature = self._state_signature(os.fstat(state_fp.fileno()))
             fcntl.lockf(state_fp, fcntl.LOCK_UN)
 
     def set_configs(self):
@@ -286,6 +368,11 @@ class Configuration(object):
         led["universe_boundary"] = self.led_config.getint('led', 'universe_boundary')
         led["universe_start"] = self.led_config.getint('led', 'universe_start')
 
+        try:
+            led["sacn_keepalive"] = self.led_config.getfloat('led', 'sacn_keepalive')
+        except configparser.NoOptionError:
+            led["sacn_keepalive"] = 1.0
+
         c_order = self.led_config.get('led', 'channel_order').upper()
         if c_order in ["RGB", "RBG", "GRB", "GBR", "BRG", "BGR"]:
             led["channel_order"] = c_order
@@ -411,6 +498,19 @@ class Configuration(object):
         ntwrk["ip_clients"] = list(map(str, self.config.get('network', 'ip_clients').split(",")))
         ntwrk["port"] = self.config.getint('network', 'port')
         ntwrk["buffer"] = self.config.getint('network', 'buffer')
+        ntwrk["keepalive"] = self.config.getfloat('network', 'keepalive')
+        ntwrk["multicast_group"] = self.config.get('network', 'multicast_group').strip()
+        ntwrk["playout_delay"] = self.config.getfloat('network', 'playout_delay')
+        ntwrk["max_late"] = self.config.getfloat('network', 'max_late')
+        ntwrk["send_rate"] = self.config.getfloat('network', 'send_rate')
+        ntwrk["render_rate"] = self.config.getfloat('network', 'render_rate')
+
+        client_channels = list()
+        for client in self.config.get('network', 'client_channels').split(";"):
+            if client.strip():
+                address, channels = client.split("=")
+                client_channels.append((address.strip(), list(map(int, channels.split(",")))))
+        ntwrk["client_channels"] = client_channels
 
         if len(self.config.get('network', 'channels')) == 0:
             channels = [_ for _ in range(self.gpio_len)]
@@ -519,6 +619,7 @@ class Configuration(object):
         audio_prcssng = dict()
         audio_prcssng["use_gpu"] = self.config.getboolean('audio_processing', 'use_gpu')
         audio_prcssng["chunk_size"] = self.config.getint('audio_processing', 'chunk_size')
+        audio_prcssng["read_ahead"] = self.config.getfloat('audio_processing', 'read_ahead')
         audio_prcssng["min_frequency"] = \
             self.config.getfloat('audio_processing', 'min_frequency')
         audio_prcssng["max_frequency"] = \
@@ -529,6 +630,21 @@ class Configuration(object):
         temp = self.config.get('audio_processing', 'custom_channel_frequencies')
         audio_prcssng["custom_channel_frequencies"] = \
             list(map(int, temp.split(','))) if temp else 0
+        audio_prcssng["sync_stats"] = self.config.get('audio_processing', 'sync_stats')
+        audio_prcssng["store_spectrum"] = \
+            self.config.getboolean('audio_processing', 'store_spectrum')
+        audio_prcssng["sync_cache_dir"] = \
+            self.config.get('audio_processing', 'sync_cache_dir').replace(
+                '$SYNCHRONIZED_LIGHTS_HOME', self.home_dir)
+        audio_prcssng["sync_cache_size"] = \
+            int(self.config.getfloat('audio_processing', 'sync_cache_size') * 1024 * 1024)
+        audio_prcssng["pcm_cache_dir"] = \
+            self.config.get('audio_processing', 'pcm_cache_dir').replace(
+                '$SYNCHRONIZED_LIGHTS_HOME', self.home_dir)
+        audio_prcssng["pcm_cache_size"] = \
+            int(self.config.getfloat('audio_processing', 'pcm_cache_size') * 1024 * 1024)
+        audio_prcssng["pcm_cache_ahead"] = \
+            self.config.getint('audio_processing', 'pcm_cache_ahead')
 
         self.audio_processing = Section(audio_prcssng)
 
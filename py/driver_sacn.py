@@ -27,9 +27,10 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 from bibliopixel.drivers.driver_base import DriverBase
-from e131packet import E131Packet
+from e131packet import E131Template
 import socket
 import sys
+import threading
 import time
 import struct
 
@@ -51,10 +52,33 @@ class RETURN_CODES:
     ERROR_UNSUPPORTED = 2  # Unsupported command
 
 
+class Universe(object):
+    """One universe of the pixel buffer, with its packet and what was last sent"""
+
+    def __init__(self, number, data):
+        self.number = number
+        self.data = data
+        self.packet = E131Template(universe=number, length=len(data))
+        self.last = bytearray(len(data))
+        self.sent = None
+        self.sequence = 0
+
+    def changed(self):
+        return self.sent is None or self.last != self.data
+
+    def send(self, sock, address, now):
+        self.packet.update(self.data, self.sequence)
+        sock.sendto(self.packet.packet_data, address)
+        self.last[:] = self.data
+        self.sent = now
+        self.sequence = (self.sequence + 1) % 256
+
+
 class DriverSACN(DriverBase):
     """Driver for communicating with another device on the network."""
 
-    def __init__(self, num=0, width=0, height=0, host="localhost", broadcast=False, port=5568, universe=1, universe_boundary=512, broadcast_interface=''):
+    def __init__(self, num=0, width=0, height=0, host="localhost", broadcast=False, port=5568,
+                 universe=1, universe_boundary=512, broadcast_interface='', keepalive=1.0):
         super(DriverSACN, self).__init__(num, width, height)
 
         self._host = host
@@ -64,8 +88,29 @@ class DriverSACN(DriverBase):
         self._broadcast_interface = broadcast_interface
         self._universe = universe
         self._universe_boundary = universe_boundary
-        self.sequenceno = 0
-        self.lastbuf = None
+        self._keepalive = keepalive
+        self._send_lock = threading.Lock()
+        self._universes = self._make_universes()
+        self.packets_sent = 0
+        self.packets_skipped = 0
+
+    def _make_universes(self):
+        """Split the pixel buffer into universes
+
+        Each universe keeps a memoryview of its part of the driver buffer,
+        highest universe first, so sending a frame only copies the pixel
+        data into the packets.
+        """
+        bbc = self.bufByteCount()
+        buf_view = memoryview(self._buf)
+        universes = []
+
+        for start in range(0, max(bbc, 1), self._universe_boundary):
+            end = min(start + self._universe_boundary, bbc)
+            universes.append(Universe(self._universe + len(universes), buf_view[start:end]))
+
+        universes.reverse()
+        return universes
 
     def _connect(self):
         try:
@@ -93,41 +138,40 @@ class DriverSACN(DriverBase):
 
     # Push new data to strand
     def _send_packet(self):
+        self.send_universes(check_changes=True)
+
+    def keepalive(self):
+        """Resend the universes that have not been sent for keepalive seconds
+
+        Call this while the pixels are not being updated, receivers treat a
+        universe that has not been heard from for a few seconds as lost.
+        """
+        self.send_universes(check_changes=False)
+
+    def send_universes(self, check_changes):
+        """Send the universes that are due a keepalive, and those that changed
+
+        :param check_changes: also send the universes whose pixels changed
+        :type check_changes: bool
+        """
         try:
-            # open sock only once
-            if self._sock == None:
-                s = self._connect()
-            else:
-                s = self._sock
-            # do not duplicate packets
-            bytesdata = bytes(self._buf)
-            if self.lastbuf == bytesdata:
-                return
-            bbc = self.bufByteCount()
-
-            universes = int(bbc / self._universe_boundary) + 1
-            countlast = bbc % self._universe_boundary
-
-            countboundary = self._universe_boundary * (universes - 1)
-            data = self._buf
-            udata = data[countboundary:countboundary + countlast]
-            if self.sequenceno == 256:
-                self.sequenceno = 0
-            packet = E131Packet(universe=self._universe + universes - 1, data=udata, sequence=self.sequenceno)
-            s.sendto(packet.packet_data, (self._host, self._port))
-            universes -= 1
-            while universes > 0:
-                countboundary = self._universe_boundary * (universes - 1)
-                udata = data[countboundary:countboundary + self._universe_boundary]
-                packet = E131Packet(universe=self._universe + universes - 1, data=udata, sequence=self.sequenceno)
-                s.sendto(packet.packet_data, (self._host, self._port))
-                universes -=1
-                
-
-
-#            s.close()
-            self.lastbuf = bytesdata
-            self.sequenceno += 1
+            with self._send_lock:
+                # open sock only once
+                if self._sock == None:
+                    s = self._connect()
+                else:
+                    s = self._sock
+
+                now = time.time()
+                address = (self._host, self._port)
+                for universe in self._universes:
+                    # do not duplicate packets, unless a keepalive is due
+                    if (check_changes and universe.changed()) or \
+                            universe.sent is None or now - universe.sent >= self._keepalive:
+                        universe.send(s, address, now)
+                        self.packets_sent += 1
+                    else:
+                        self.packets_skipped += 1
 
         except Exception as e:
             log.logger.error(e)
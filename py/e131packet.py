@@ -40,6 +40,10 @@ import uuid
 
 default_cid = uuid.uuid1().bytes
 
+# offsets into a full E1.31 packet
+SEQUENCE_OFFSET = 111
+DATA_OFFSET = 126
+
 def int_to_16bit(i):
     """
     return an int as a pair of bytes
@@ -141,3 +145,25 @@ class E131Packet(object):
                 dmp_packet=self.dmp_packet, sequence=sequence).packet_data()
         self.packet_data = RootLayer(cid=cid, framing_packet=self.framing_packet).packet_data()
 
+
+
+class E131Template(object):
+    """
+    A preallocated E1.31 packet for one universe
+
+    The layers are built once, each frame only the sequence number and the
+    DMX data are written into packet_data, so sending a universe does not
+    allocate a new packet.
+    """
+    def __init__(self, cid=None, name=None, universe=None, length=512):
+        self.packet_data = E131Packet(cid=cid, name=name, universe=universe,
+                                      data=bytes(length)).packet_data
+        self.data = memoryview(self.packet_data)[DATA_OFFSET:]
+
+    def update(self, data, sequence):
+        """
+        copy data (of the same length as the universe) and the sequence
+        number into the packet
+        """
+        self.packet_data[SEQUENCE_OFFSET] = sequence
+        self.data[:] = data
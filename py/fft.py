@@ -30,6 +30,10 @@ import math
 
 from rpi_audio_levels import AudioLevels
 
+# the fine spectrum kept next to sync files, see calculate_spectrum
+SPECTRUM_BANDS_PER_OCTAVE = 24
+SPECTRUM_MIN_FREQUENCY = 20.0
+
 
 class FFT(object):
     def __init__(self,
@@ -94,6 +98,8 @@ class FFT(object):
                 self.piff[a][1] += 1
         self.piff = self.piff.tolist()
 
+        self.spectrum_bins = self.calculate_spectrum_bins()
+
     def calculate_piff(self, val, chunk_size, sample_rate):
         return int(chunk_size * val / sample_rate) 
         
@@ -148,6 +154,234 @@ class FFT(object):
 
         return cache_matrix
 
+    def calculate_levels_batch(self, data, num_channels=2, block_size=256, spectrum=False):
+        """Calculate frequency response for a whole song at once
+
+        The song is split into chunks exactly as consecutive calls to
+        readframes(chunk_size) would split it.  Every full chunk is windowed
+        and transformed in one 2-D call per block of chunks, and the band sums
+        are reduced for the whole block.  A trailing partial chunk is handed
+        to calculate_levels, so every row is identical to the per-chunk path.
+
+        :param data: the whole decoded song, interleaved int16 samples
+        :type data: bytes | numpy.array
+
+        :param num_channels: number of channels interleaved in data
+        :type num_channels: int
+
+        :param block_size: number of chunks transformed at a time, this
+                           bounds the memory used on long songs
+        :type block_size: int
+
+        :param spectrum: also return the fine spectrum of every chunk, see
+                         calculate_spectrum (a trailing partial chunk is
+                         left silent)
+        :type spectrum: bool
+
+        :return: one row of levels for each chunk of the song, and the
+                 spectrum if asked for
+        :rtype: numpy.array | tuple
+        """
+        samples = frombuffer(data, dtype="int16")
+        frame_length = self.chunk_size * num_channels
+        num_frames = len(samples) // frame_length
+        tail = samples[num_frames * frame_length:]
+
+        cache_matrix = zeros((num_frames + int(len(tail) > 0), self.num_bins))
+        if spectrum:
+            spectrum_bins = self.get_spectrum_bins(num_channels)
+            fine_spectrum = full((len(cache_matrix), len(spectrum_bins) - 1), -inf,
+                                 dtype=float16)
+
+        # a view of the song with one chunk per row, then the left channel
+        # of each chunk if stereo, just as calculate_levels does
+        frames = samples[:num_frames * frame_length].reshape(num_frames, frame_length)
+        if self.input_channels == 2:
+            frames = frames[:, ::2]
+
+        window = hanning(frames.shape[1]).astype(float32)
+        piff = [(self.calculate_piff(low, self.chunk_size, self.sample_rate),
+                 self.calculate_piff(high, self.chunk_size, self.sample_rate))
+                for low, high in self.frequency_limits]
+
+        for start in range(0, num_frames, block_size):
+            block = frames[start:start + block_size] * window
+            rows = cache_matrix[start:start + len(block)]
+
+            # rows that are all zeros stay zero, no need to do the fft
+            has_data = any(block != 0.0, axis=1)
+
+            if not self.use_gpu or spectrum:
+                # Apply FFT - real data, to every chunk in the block
+                # Calculate the power spectrum
+                power = abs(fft.rfft(block[has_data], axis=1)[:, :-1]) ** 2
+
+            if spectrum:
+                spectrum_rows = fine_spectrum[start:start + len(block)]
+                spectrum_rows[has_data] = self.calculate_spectrum(power, spectrum_bins)
+
+            if self.use_gpu:
+                for row in flatnonzero(has_data):
+                    levels = array(self.audio_levels.compute(block[row], self.piff)[0])
+                    levels[isinf(levels)] = 0.0
+                    rows[row] = levels
+                continue
+
+            levels = zeros((len(power), self.num_bins))
+            for i, (low, high) in enumerate(piff):
+                psum = sum(power[:, low:high], axis=1)
+                nonzero = psum != 0
+                levels[nonzero, i] = log10(psum[nonzero])
+
+            rows[has_data] = levels
+
+        if len(tail):
+            cache_matrix[-1] = self.calculate_levels(tail.tobytes())
+
+        if spectrum:
+            return cache_matrix, fine_spectrum
+
+        return cache_matrix
+
+    def count_fft_bins(self, num_channels=2):
+        """Number of power bins the fft of a chunk gives
+
+        calculate_levels keeps every other sample of a chunk, the left
+        channel of a stereo song but half the samples of a mono one.
+
+        :param num_channels: number of channels in the song
+        :type num_channels: int
+
+        :rtype: int
+        """
+        samples = self.chunk_size * num_channels
+        if self.input_channels == 2:
+            samples //= 2
+
+        return samples // 2
+
+    def get_spectrum_bins(self, num_channels=2):
+        """spectrum_bins for a song with num_channels
+
+        :param num_channels: number of channels in the song
+        :type num_channels: int
+
+        :rtype: numpy.array
+        """
+        num_fft_bins = self.count_fft_bins(num_channels)
+        if num_fft_bins == self.chunk_size // 2:
+            return self.spectrum_bins
+
+        return self.calculate_spectrum_bins(num_fft_bins)
+
+    def calculate_spectrum_bins(self, num_fft_bins=None):
+        """Fft bins at the edges of the fine spectrum bands
+
+        Bands are 1/SPECTRUM_BANDS_PER_OCTAVE of an octave wide from
+        SPECTRUM_MIN_FREQUENCY, or one fft bin where that is narrower than a
+        bin, the first band holds every bin below SPECTRUM_MIN_FREQUENCY.
+
+        :param num_fft_bins: number of power bins, see count_fft_bins,
+            defaults to those of a stereo chunk
+        :type num_fft_bins: int
+
+        :return: first fft bin of each band, then the number of fft bins
+        :rtype: numpy.array
+        """
+        if num_fft_bins is None:
+            num_fft_bins = self.chunk_size // 2
+        octaves = log2(self.sample_rate / 2.0 / SPECTRUM_MIN_FREQUENCY)
+        bands = arange(int(ceil(octaves * SPECTRUM_BANDS_PER_OCTAVE)) + 1)
+        frequencies = SPECTRUM_MIN_FREQUENCY * 2 ** (bands / float(SPECTRUM_BANDS_PER_OCTAVE))
+
+        edges = [self.calculate_piff(frequency, self.chunk_size, self.sample_rate)
+                 for frequency in frequencies]
+
+        return unique(clip(concatenate([[0], edges, [num_fft_bins]]), 0, num_fft_bins))
+
+    def calculate_spectrum(self, power, spectrum_bins=None):
+        """Fine spectrum of chunks, for making levels for any channel layout
+
+        The log10 power of each band of spectrum_bins, as float16, -inf for
+        a band with no power.  levels_from_spectrum turns it into levels for
+        the channels of this FFT without the audio.
+
+        :param power: power spectrum of each chunk, one row per chunk
+        :type power: numpy.array
+
+        :param spectrum_bins: see get_spectrum_bins, defaults to spectrum_bins
+        :type spectrum_bins: numpy.array
+
+        :return: one row of bands for each chunk
+        :rtype: numpy.array
+        """
+        if spectrum_bins is None:
+            spectrum_bins = self.spectrum_bins
+
+        band_power = add.reduceat(power, spectrum_bins[:-1], axis=1)
+
+        with errstate(divide="ignore"):
+            return log10(band_power).astype(float16)
+
+    def get_spectrum_config(self, num_channels=2):
+        """The configuration used to generate the fine spectrum
+
+        :param num_channels: number of channels in the song
+        :type num_channels: int
+
+        :return: settings that a spectrum file must match to be used
+        :rtype: dict
+        """
+        return {"chunk_size": self.chunk_size,
+                "sample_rate": self.sample_rate,
+                "input_channels": self.input_channels,
+                "num_channels": num_channels,
+                "bands_per_octave": SPECTRUM_BANDS_PER_OCTAVE,
+                "min_frequency": SPECTRUM_MIN_FREQUENCY}
+
+    def levels_from_spectrum(self, spectrum, num_channels=2, block_size=4096):
+        """Levels for the channels of this FFT from a fine spectrum
+
+        The power of each channel is the sum of the bands it covers, with a
+        band it only partly covers counted in proportion, so one matrix
+        multiply gives the levels of every channel.  Channels whose edges
+        fall on band edges match calculate_levels to float16 precision.
+
+        :param spectrum: see calculate_spectrum
+        :type spectrum: numpy.array
+
+        :param num_channels: number of channels in the song
+        :type num_channels: int
+
+        :param block_size: number of chunks done at a time
+        :type block_size: int
+
+        :return: one row of levels for each chunk
+        :rtype: numpy.array
+        """
+        num_fft_bins = self.count_fft_bins(num_channels)
+        spectrum_bins = self.get_spectrum_bins(num_channels)
+        low = spectrum_bins[:-1]
+        high = spectrum_bins[1:]
+
+        # share of each band in each channel
+        weights = zeros((len(low), self.num_bins))
+        for i, (frequency_low, frequency_high) in enumerate(self.frequency_limits):
+            channel_low = self.calculate_piff(frequency_low, self.chunk_size, self.sample_rate)
+            channel_high = minimum(self.calculate_piff(frequency_high, self.chunk_size,
+                                                       self.sample_rate), num_fft_bins)
+            overlap = clip(minimum(high, channel_high) - maximum(low, channel_low), 0, None)
+            weights[:, i] = overlap / (high - low).astype(float)
+
+        levels = zeros((len(spectrum), self.num_bins))
+        for start in range(0, len(spectrum), block_size):
+            psum = dot(10.0 ** spectrum[start:start + block_size].astype(float64), weights)
+            rows = levels[start:start + block_size]
+            nonzero = psum > 0
+            rows[nonzero] = log10(psum[nonzero])
+
+        return levels
+
     def calculate_channel_frequency(self):
         """Calculate frequency values
 
@@ -208,6 +442,21 @@ class FFT(object):
         else:
             return frequency_store
 
+    def get_config(self):
+        """The configuration used to generate the fft data
+
+        :return: fft settings that a sync file must match to be reused
+        :rtype: dict
+        """
+        return {"chunk_size": self.chunk_size,
+                "sample_rate": self.sample_rate,
+                "num_bins": self.num_bins,
+                "min_frequency": self.min_frequency,
+                "max_frequency": self.max_frequency,
+                "custom_channel_mapping": self.custom_channel_mapping,
+                "custom_channel_frequencies": self.custom_channel_frequencies,
+                "input_channels": self.input_channels}
+
     def compare_config(self, cache_filename):
         """
         Compare the current configuration used to generate fft to a saved
@@ -228,7 +477,6 @@ class FFT(object):
                 self.config.read_file(f)
 
         fft_cache = dict()
-        fft_current = dict()
 
         try:
             fft_cache["chunk_size"] = self.config.getint("fft", "chunk_size")
@@ -255,23 +503,28 @@ class FFT(object):
         except configparser.Error:
             has_config = False
 
-        fft_current["chunk_size"] = self.chunk_size
-        fft_current["sample_rate"] = self.sample_rate
-        fft_current["num_bins"] = self.num_bins
-        fft_current["min_frequency"] = self.min_frequency
-        fft_current["max_frequency"] = self.max_frequency
-        fft_current["custom_channel_mapping"] = self.custom_channel_mapping
-        fft_current["custom_channel_frequencies"] = self.custom_channel_frequencies
-        fft_current["input_channels"] = self.input_channels
-
-        if fft_cache != fft_current:
+        if fft_cache != self.get_config():
             has_config = False
             logging.warn("Cached config data does not match")
 
         return has_config
 
-    def save_config(self):
-        """Save the current configuration used to generate the fft data"""
+    def save_config(self, cache_filename=None):
+        """Save the current configuration used to generate the fft data
+
+        The custom sections already in the config file are kept.
+
+        :param cache_filename: path and name of cache file, defaults to the
+            cache file last passed to compare_config
+        :type cache_filename: str
+        """
+        if cache_filename:
+            self.config_filename = cache_filename.replace(".sync", ".cfg")
+
+            if os.path.isfile(self.config_filename):
+                with open(self.config_filename) as f:
+                    self.config.read_file(f)
+
         if self.config.has_section("fft"):
             self.config.remove_section("fft")
 
@@ -34,8 +34,9 @@ from multiprocessing.managers import BaseManager
 
 from collections import defaultdict
 
+import numpy as np
+
 import configuration_manager
-import led_module
 import networking
 
 args = None
@@ -90,6 +91,9 @@ class Hardware(object):
 
         self.led = None
         if self.cm.configs.led:
+            # bibliopixel is only loaded when leds are used
+            import led_module
+
             self.led = list()
             if self.cm.configs.led_multiprocess:
                 LEDManager.register('LED', led_module.Led)      
@@ -192,6 +196,18 @@ class Hardware(object):
                                          cm.hardware.pwm_range,
                                          cm.hardware.piglow))
 
+        # output scale of each channel, used by set_lights to convert
+        # brightness to the value written to the pin
+        self.scaled_channels = np.array([channel.scaled for channel in self.channels], dtype=bool)
+        self.output_scale = np.array([channel.output_scale for channel in self.channels],
+                                     dtype=float)
+
+        # last value written to each pin, -1 if not known, so only the pins
+        # that change are written to
+        self.values = np.full(cm.hardware.gpio_len, -1, dtype=int)
+        self.writes = 0
+        self.skips = 0
+
     def set_overrides(self):
         """
         Set override flags if they are to be used
@@ -204,6 +220,12 @@ class Hardware(object):
             self.channels[channel].set_inverted(
                 channel + 1 in cm.lightshow.invert_channels)
 
+        # the same flags as masks, used by set_lights
+        self.always_off = np.array([channel.always_off for channel in self.channels], dtype=bool)
+        self.always_on = np.array([channel.always_on for channel in self.channels], dtype=bool)
+        self.always_on &= ~self.always_off
+        self.inverted = np.array([channel.inverted for channel in self.channels], dtype=bool)
+
     def set_pins_as_outputs(self):
         """Set all the configured pins as outputs."""
         for pin in range(cm.hardware.gpio_len):
@@ -221,6 +243,7 @@ class Hardware(object):
         :param pin: int, index of pin in gpio_pins
         """
         self.channels[pin].set_as_output()
+        self.values[pin] = -1
 
     def set_pin_as_input(self, pin):
         """
@@ -229,6 +252,7 @@ class Hardware(object):
         :param pin: int, index of pin in gpio_pins
         """
         self.channels[pin].set_as_input()
+        self.values[pin] = -1
 
     def turn_on_lights(self, use_always_onoff=False):
         """
@@ -238,8 +262,7 @@ class Hardware(object):
 
         :param use_always_onoff: int or boolean, should always on/off be used
         """
-        for pin in range(cm.hardware.physical_gpio_len):
-            self.set_light(pin, use_always_onoff, 1.0)
+        self.set_lights(np.ones(cm.hardware.physical_gpio_len), use_always_onoff)
 
         if self.led:
             for led_instance in self.led:
@@ -254,8 +277,7 @@ class Hardware(object):
 
         :param use_always_onoff: int or boolean, should always on/off be used
         """
-        for pin in range(cm.hardware.physical_gpio_len):
-            self.set_light(pin, use_always_onoff, 0)
+        self.set_lights(np.zeros(cm.hardware.physical_gpio_len), use_always_onoff)
 
         if self.led:
             for led_instance in self.led:
@@ -317,7 +339,81 @@ class Hardware(object):
             sendb[pin] = float(brightness)
             self.broadcast(sendb)
 
-        self.channels[pin].set_action(use_overrides, brightness)
+        self.write_light(pin, self.channels[pin].get_value(use_overrides, brightness))
+
+    def write_light(self, pin, value):
+        """Write a value to the specified light if it has changed
+
+        :param pin: index of pin in cm.hardware.gpio_pins
+        :type pin: int
+
+        :param value: pwm level for pwm and piglow pins, 0 or 1 for on/off pins
+        :type value: int
+        """
+        if self.values[pin] == value:
+            self.skips += 1
+            return
+
+        self.channels[pin].write(value)
+        self.values[pin] = value
+        self.writes += 1
+
+    def set_lights(self, levels, use_overrides=True, pins=None):
+        """Set the brightness of several lights at once
+
+        Does the same as calling set_light for each light, with active low
+        mode and the always on, always off and invert overrides applied to
+        all the levels at once.
+
+        :param levels: brightness of each light, between 0.0 and 1.0
+        :type levels: numpy.array
+
+        :param use_overrides: should overrides be used
+        :type use_overrides: bool
+
+        :param pins: index in cm.hardware.gpio_pins of each level, defaults
+            to the first len(levels) pins
+        :type pins: numpy.array
+        """
+        levels = np.array(levels, dtype=float, ndmin=1)
+        if not len(levels):
+            return
+
+        if pins is None:
+            pins = np.arange(len(levels))
+        else:
+            pins = np.asarray(pins, dtype=int)
+
+        if not self.network.playing and self.server:
+            sendb = [-1.0 for _ in range(cm.hardware.gpio_len)]
+            for pin, brightness in zip(pins, levels.tolist()):
+                sendb[pin] = brightness
+            self.broadcast(sendb)
+
+        if cm.hardware.active_low_mode:
+            levels = 1.0 - levels
+
+        if use_overrides:
+            levels[self.always_off[pins]] = 0.0
+            levels[self.always_on[pins]] = 1.0
+            inverted = self.inverted[pins]
+            levels[inverted] = 1.0 - levels[inverted]
+
+        # same conversion as Channel.get_value, truncate scaled levels, round on/off
+        values = np.where(self.scaled_channels[pins],
+                          levels * self.output_scale[pins],
+                          levels > 0.5).astype(int)
+
+        # only write the pins that have changed
+        changed = values != self.values[pins]
+        pins = pins[changed]
+        values = values[changed]
+        self.values[pins] = values
+        self.writes += len(pins)
+        self.skips += len(changed) - len(pins)
+
+        for pin, value in zip(pins.tolist(), values.tolist()):
+            self.channels[pin].write(value)
 
     def clean_up(self):
         """
@@ -329,6 +425,8 @@ class Hardware(object):
         self.turn_off_lights()
         self.set_pins_as_inputs()
 
+        logging.debug("channel writes: %d, unchanged and skipped: %d", self.writes, self.skips)
+
     def initialize(self,reset=True):
         """Set pins as outputs and start all lights in the off state."""
         wiringpi.wiringPiSetupPY()
@@ -358,13 +456,23 @@ class Channel(object):
         self.always_off = False
         self.inverted = False
 
+        # write a raw value to the pin with no overrides applied, and the
+        # scale used to convert a brightness to that value
         if self.pwm:
-            self.action = lambda b: wiringpi.softPwmWritePY(self.pin_number,
-                                                          int(b * self.pwm_max))
+            self.write = lambda v: wiringpi.softPwmWritePY(self.pin_number, v)
+            self.output_scale = self.pwm_max
         elif piglow:
-            self.action = lambda b: wiringpi.analogWritePY(self.pin_number + 577, int(b * 255))
+            self.write = lambda v: wiringpi.analogWritePY(self.pin_number + 577, v)
+            self.output_scale = 255
+        else:
+            self.write = lambda v: wiringpi.digitalWritePY(self.pin_number, v)
+            self.output_scale = 1
+
+        self.scaled = self.pwm or piglow
+        if self.scaled:
+            self.convert = lambda b: int(b * self.output_scale)
         else:
-            self.action = lambda b: wiringpi.digitalWritePY(self.pin_number, int(b > 0.5))
+            self.convert = lambda b: int(b > 0.5)
 
     def set_as_input(self):
         """
@@ -417,6 +525,17 @@ class Channel(object):
         0.0 is full off
         1.0 is full on
 
+        """
+        self.write(self.get_value(use_overrides, brightness))
+
+    def get_value(self, use_overrides=False, brightness=1.0):
+        """
+        The value to write to this pin for a brightness
+
+        Taking into account various overrides if specified.
+        :param use_overrides: int or boolean, should overrides be used
+        :param brightness: float, between 0.0 and 1.0, brightness of light
+        :return: int, pwm level for pwm and piglow pins, 0 or 1 for on/off pins
         """
         if self.active_low_mode:
             brightness = 1.0 - brightness
@@ -430,7 +549,7 @@ class Channel(object):
             if self.inverted:
                 brightness = 1 - brightness
 
-        self.action(brightness)
+        return self.convert(brightness)
 
 
 # test functions
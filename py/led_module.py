@@ -21,6 +21,7 @@ import time
 import bibliopixel.colors as colors
 import bibliopixel.util.image as image
 import bibliopixel.layout.font as font
+import bibliopixel.layout.matrix_drawing as matrix_drawing
 
 from bibliopixel.layout.strip import *
 from bibliopixel.layout.matrix import *
@@ -70,6 +71,11 @@ class Led(object):
 
         self.leds = numpy.array([0 for _ in range(self.led_config.led_count)])
 
+        # last frame written by write_full, quantized to 255 levels
+        self.last_frame = None
+        self.frames_written = 0
+        self.frames_skipped = 0
+
         self.per_channel = self.led_config.per_channel
         self.pattern_color = self.led_config.pattern_color
         self.pattern_color_map = self.led_config.pattern_color_map
@@ -113,6 +119,11 @@ class Led(object):
             color_map[0] = self.pattern_color
             self.pattern_color_map = 'MAP2'
 
+        if self.led_config.led_configuration == "STRIP":
+            self.strip_setup()
+        elif self.led_config.led_configuration == "MATRIX":
+            self.matrix_pattern_setup()
+
         self.led.set_brightness(int(self.max_brightness * 255))
 #        atexit.register(self.exit_function)
 
@@ -151,7 +162,78 @@ class Led(object):
                                  port=self.led_config.sacn_port,
                                  universe = self.led_config.universe_start,
                                  universe_boundary=self.led_config.universe_boundary,
-                                 broadcast=self.led_config.sacn_broadcast)
+                                 broadcast=self.led_config.sacn_broadcast,
+                                 keepalive=self.led_config.sacn_keepalive)
+
+    def strip_setup(self):
+        """Precompute the strip layout and colors used by write_full
+
+        Where each channel starts and its middle on the strip, the color of
+        each channel for every brightness, and the LBARS gradient.
+        """
+        if self.led_config.custom_per_channel:
+            per_channel = numpy.array(self.led_config.custom_per_channel)
+            self.channel_start = numpy.cumsum(per_channel) - per_channel
+            self.channel_middle = per_channel // 2
+        else:
+            self.channel_start = numpy.arange(self.led_config.led_count) * self.per_channel
+            self.channel_middle = numpy.full(self.led_config.led_count,
+                                             int(self.per_channel / 2))
+
+        self.channel_rgb = numpy.array(self.rgb, dtype=int)
+
+        # color for each brightness, for the color maps that do not scale
+        # the channel color by level
+        if self.pattern_color_map == 'MAP1':
+            color_table = [scale(color_map[b], b) for b in range(256)]
+        elif self.pattern_color_map == 'MAP2':
+            color_table = [scale(color_map[255 - b], b) for b in range(256)]
+        elif self.pattern_color_map in lspi_color_maps.map.keys():
+            lspi_map = lspi_color_maps.map[self.pattern_color_map]
+            color_table = [scale(lspi_map[255 - b], b) for b in range(256)]
+        else:
+            color_table = [(b, b, b) for b in range(256)]
+        self.color_table = numpy.array(color_table, dtype=int)
+
+        # LBARS color by distance from the middle of the channel
+        half_channels = self.per_channel / 2
+        self.lbars_palette = [tuple(int_map[int((float(gled) / half_channels) * 255)])
+                              for gled in range(int(half_channels))] + [(0, 0, 0)]
+
+    def paint_channels(self, starts, ends):
+        """Which channel is drawn on each led of the strip
+
+        Channels are drawn in order, so where two channels overlap the later
+        one is on top.
+
+        :param starts: first led of each channel, inclusive
+        :type starts: numpy.array
+
+        :param ends: last led of each channel, inclusive, less than start if
+            the channel is not drawn
+        :type ends: numpy.array
+
+        :return: channel drawn on each led, -1 for none
+        :rtype: numpy.array
+        """
+        starts = numpy.maximum(starts, 0)
+        ends = numpy.minimum(ends, self.led_count - 1)
+        lengths = numpy.maximum(ends - starts + 1, 0)
+
+        offsets = numpy.repeat(starts - (numpy.cumsum(lengths) - lengths), lengths)
+        leds = numpy.arange(lengths.sum()) + offsets
+        channels = numpy.repeat(numpy.arange(len(lengths)), lengths)
+
+        painted = numpy.full(self.led_count, -1)
+        numpy.maximum.at(painted, leds, channels)
+        return painted
+
+    def fill_ends(self, ends):
+        """The last led filled for each end passed to LEDStrip.fill
+
+        fill draws to the end of the strip for an end past it or below 0.
+        """
+        return numpy.where((ends < 0) | (ends >= self.led_count), self.led_count - 1, ends)
 
     def matrix_setup(self):
         self.images = []
@@ -172,7 +254,9 @@ class Led(object):
             self.images.append(rgba)
         self.base_image = Image.new("RGBA", self.images[0].size)
 
-        self.drops = [[0 for _ in range(self.led_config.matrix_height)] for _ in range(self.led_config.matrix_width)]
+        # MBARS history, one row of levels per frame, oldest at drops_head
+        self.drops = numpy.zeros((self.led_config.matrix_width, 0), dtype=int)
+        self.drops_head = 0
 
         self._len = (self.led_config.matrix_width * 2) + (self.led_config.matrix_height * 2) - 2
         self._step = 1
@@ -198,6 +282,7 @@ class Led(object):
 
     def all_leds_off(self):
         self.leds = numpy.array([0 for _ in range(self.led_config.led_count)])
+        self.last_frame = None
         self.led.all_off()
         self.led.push_to_driver()
 
@@ -212,7 +297,7 @@ class Led(object):
         self.write_all(self.leds)
 
     def write(self, pin, color):
-
+        self.last_frame = None
         self.led.set(pin, scale(color_map[color], color))
 
         self.led.push_to_driver()
@@ -223,68 +308,169 @@ class Led(object):
             if self.update_skip >= 0:
                 return
 
-        self.led.all_off()
-
         brightnesses = pin_list * 255
         brightnesses = brightnesses.astype(int)
-        half_channels = self.led_config.per_channel / 2
-        midl = int(half_channels)
-        pin = 0
 
-        for level, brightness in zip(pin_list, brightnesses):
-            if self.led_config.custom_per_channel:
-                sled = sum(self.led_config.custom_per_channel[0:pin])
-                midl = int(self.led_config.custom_per_channel[pin] / 2)
-                lastl = self.led_config.custom_per_channel[pin] - 1
-            else:
-                sled = pin * self.per_channel
+        # the strip already shows this frame
+        if numpy.array_equal(brightnesses, self.last_frame):
+            self.frames_skipped += 1
+            self.update_skip = self.skip
 
-            if self.pattern_color_map == 'MONO':
-                rgb = (int(level * self.pattern_color[0]),
-                       int(level * self.pattern_color[1]),
-                       int(level * self.pattern_color[2]))
+            # sACN receivers still expect to hear from every universe
+            if self.led_config.led_connection == "SACN":
+                self.driver.keepalive()
+            return
 
-            elif self.pattern_color_map == 'FREQ1':
-                # rgb = color_map[int((float(pin) / (self.last + 1)) * 255)]
-                rgb = self.rgb[pin]
-                rgb = (int(rgb[0] * level), int(rgb[1] * level), int(rgb[2] * level))
+        self.last_frame = brightnesses
+        self.frames_written += 1
 
-            elif self.pattern_color_map == 'FREQ1A':
-                if brightness < 255:
-                    rgb = self.rgb[pin]
-                else:
-                    rgb = self.pattern_color
-                rgb = (int(rgb[0] * level), int(rgb[1] * level), int(rgb[2] * level))
+        # the channels that fit on the strip
+        count = min(len(pin_list), len(self.channel_start))
+        levels = numpy.asarray(pin_list[:count], dtype=float)
+        brightnesses = brightnesses[:count]
+        start = self.channel_start[:count]
+        pattern_type = self.led_config.pattern_type
 
-            elif self.pattern_color_map == 'MAP1':
-                rgb = scale(color_map[brightness], brightness)
+        # which channel is drawn on each led
+        if pattern_type == 'CBARS':
+            middle = start + self.channel_middle[:count]
+            mlvl = (levels * self.channel_middle[:count]).astype(int)
+            painted = self.paint_channels(middle - mlvl, self.fill_ends(middle + mlvl))
 
-            elif self.pattern_color_map == 'MAP2':
-                rgb = scale(color_map[255 - brightness], brightness)
+        elif pattern_type == 'FULL':
+            painted = self.paint_channels(start,
+                                          self.fill_ends(start + self.led_config.per_channel - 1))
 
-            elif self.pattern_color_map in lspi_color_maps.map.keys():
-                rgb = scale(lspi_color_maps.map[self.pattern_color_map][255 - brightness], brightness)
-            else:
-                rgb = (brightness, brightness, brightness)
+        elif pattern_type == 'LBARS':
+            middle = int(self.per_channel / 2) + start
+            reach = numpy.minimum((levels * (self.per_channel / 2)).astype(int),
+                                  len(self.lbars_palette) - 1) - 1
+            painted = self.paint_channels(middle - reach, middle + reach)
+
+        else:
+            painted = numpy.full(self.led_count, -1)
+
+        # the color of each led as an index into a palette that ends with
+        # off, so leds that are not drawn (-1) are off
+        if pattern_type == 'LBARS':
+            # LBARS is colored by distance from the middle of the channel
+            palette = self.lbars_palette
+            distance = numpy.abs(numpy.arange(self.led_count) - middle[painted])
+            painted = numpy.where(painted >= 0, distance, -1)
+
+        else:
+            if self.pattern_color_map == 'MONO':
+                rgb = levels[:, None] * self.pattern_color
+
+            elif self.pattern_color_map == 'FREQ1':
+                rgb = self.channel_rgb[:count] * levels[:, None]
 
-            if self.led_config.pattern_type == 'CBARS':
-                mlvl = int(level * midl)
-                self.led.fill(rgb, sled + midl - mlvl, sled + midl + mlvl)
+            elif self.pattern_color_map == 'FREQ1A':
+                rgb = numpy.where((brightnesses < 255)[:, None],
+                                  self.channel_rgb[:count],
+                                  self.pattern_color) * levels[:, None]
 
-            elif self.led_config.pattern_type == 'FULL':
-                self.led.fill(rgb, sled, sled + self.led_config.per_channel - 1)
+            else:
+                rgb = self.color_table[brightnesses]
 
-            elif self.led_config.pattern_type == 'LBARS':
-                midl = int(half_channels) + sled
-                for gled in range(0, int((half_channels) * level)):
-                    self.led.set(midl + gled, int_map[int((float(gled) / half_channels) * 255)])
-                    self.led.set(midl - gled, int_map[int((float(gled) / half_channels) * 255)])
+            palette = list(map(tuple, rgb.astype(int).tolist())) + [(0, 0, 0)]
 
-            pin += 1
+        # the whole frame at once, in the format the layout keeps it
+        self.led.color_list[:] = list(map(palette.__getitem__, painted.tolist()))
 
         self.led.push_to_driver()
         self.update_skip = self.skip
 
+    def matrix_pattern_setup(self):
+        """Precompute the geometry and colors of the matrix patterns
+
+        The patterns are drawn as a grid of indexes into a palette, one cell
+        for each x, y position of the matrix, see write_grid.  Lines and
+        circles are traced once with the bibliopixel drawing functions, so
+        PINWHEEL and CIRCLES only need to color them for each frame.
+        """
+        h = self.led_config.matrix_height
+        w = self.led_config.matrix_width
+        coord_map = self.led.coord_map
+        self.matrix_rows = len(coord_map)
+        self.matrix_cols = len(coord_map[0])
+        self.matrix_order = None
+
+        # palettes
+        self.hue_palette = [tuple(colors.hue2rgb(c)) for c in range(256)]
+        self.sbars_palette = [tuple(color_map[int(255.0 * float(x_cord) / float(w))])
+                              for x_cord in range(w)]
+        self.cbars_palette = [scale(color_map[b], b) for b in range(256)]
+        self.mbars_palette = [scale(color_map[255 - d], int(d * 0.5)) for d in range(256)]
+        self.channel_rgb = numpy.array(self.rgb, dtype=int)
+
+        # the line drawn to each point on the edge, in drawing order
+        lines = [(self.midxa, self.midya, x, 0) for x in range(h)]
+        lines += [(self.midxb, self.midyb, h - 1, y) for y in range(w)]
+        lines += [(self.midxb, self.midyb, x, w - 1) for x in range(h - 1, -1, -1)]
+        lines += [(self.midxa, self.midya, 0, y) for y in range(w - 1, -1, -1)]
+        self.pinwheel_lines = numpy.arange(len(lines))
+        self.pinwheel_grid = self.trace_grid(
+            [lambda setter, line=line: matrix_drawing.draw_line(setter, *line) for line in lines])
+
+        # a circle for each channel
+        channel_count = self.led_config.led_channel_count
+        self.circles_grid = self.trace_grid(
+            [lambda setter, pin=pin: matrix_drawing.draw_circle(
+                setter, self.midxa, self.midyb, int(pin * ((w / 2) / channel_count)))
+             for pin in range(channel_count)])
+
+    def trace_grid(self, shapes):
+        """Which shape is drawn on each x, y position of the matrix
+
+        Shapes are drawn in order, so where two shapes overlap the later one
+        is on top.  Positions are resolved the way LEDMatrix.set does.
+
+        :param shapes: functions that draw a shape with a setter
+        :type shapes: list
+
+        :return: index of the shape drawn at each position, -1 for none
+        :rtype: numpy.array
+        """
+        rows = self.matrix_rows
+        cols = self.matrix_cols
+        grid = numpy.full((rows, cols), -1)
+
+        for index, shape in enumerate(shapes):
+            def setter(x, y, color=None):
+                if -rows <= y < rows and -cols <= x < cols:
+                    grid[y, x] = index
+
+            shape(setter)
+
+        return grid
+
+    def write_grid(self, palette, grid):
+        """Write a frame of palette indexes to the matrix layout
+
+        :param palette: colors of the frame
+        :type palette: list
+
+        :param grid: index in palette for each x, y position, -1 for off
+        :type grid: numpy.array
+        """
+        indexes = numpy.append(grid.ravel(), -1)[self.matrix_order]
+        palette = palette + [(0, 0, 0)]
+        self.led.color_list[:] = list(map(palette.__getitem__, indexes.tolist()))
+
+    def grid_order(self, coord_map):
+        """The x, y position in a flattened grid drawn on each led
+
+        Leds that no position maps to are given the cell past the end of the
+        grid, which write_grid leaves off.
+        """
+        order = numpy.full(self.led.numLEDs, self.matrix_rows * self.matrix_cols)
+        for y, row in enumerate(coord_map):
+            for x, pixel in enumerate(row):
+                if 0 <= pixel < self.led.numLEDs:
+                    order[pixel] = y * self.matrix_cols + x
+        return order
+
     def mmcm(self,p_type):
         if self.last_type == p_type:
             return
@@ -293,6 +479,8 @@ class Led(object):
             self.led.coord_map = make_matrix_coord_map( self.led_config.matrix_width, self.led_config.matrix_height, serpentine=self.serpentine, rotation=self.rotation_180, y_flip=self.vert_flip)
         else:
             self.led.coord_map = make_matrix_coord_map( self.led_config.matrix_width, self.led_config.matrix_height, serpentine=True, rotation=self.rotation, y_flip=self.vert_flip)
+            if self.matrix_order is None:
+                self.matrix_order = self.grid_order(self.led.coord_map)
             
          
     def write_matrix(self, pin_list):
@@ -315,39 +503,38 @@ class Led(object):
             self.p_type = self.led_config.matrix_pattern_type[self.p_num]
 
         self.mmcm(self.p_type)
-        self.led.all_off()
 
         h = self.led_config.matrix_height
         w = self.led_config.matrix_width
+        rows = self.matrix_rows
+        cols = self.matrix_cols
 
         if self.p_type == 'SBARS':
-            for y in range(h):
-                y_ind = int((float(len(pin_list)) / h) * y)
-                for x_cord in range(int(pin_list[y_ind] * float(w))):
-                    rgb = color_map[int( 255.0 * float(x_cord) / float(w) )]
-                    self.led.set(y_ind, x_cord, rgb)
-
-        if self.p_type == 'MBARS':
-            norm_arr = [int(x * 255) for x in pin_list]
-            self.drops.append(norm_arr)
-            for y_cord in range(w):
-                for x in range(h):
-                    x_ind = int((float(len(pin_list)) / h) * x)
-                    if self.drops[y_cord][x_ind] > 64:
-                        rgb = scale(color_map[255 - self.drops[y_cord][x_ind]],
-                                    int(self.drops[y_cord][x_ind] * 0.5))
-                        self.led.set(x, w - 1 - y_cord, rgb)
-            del self.drops[0]
-
-        elif self.p_type == 'IMAGE':
-            complete_image = self.base_image
-            for pin in range(len(pin_list)):
-                if pin_list[pin] > 0.55:
-                    complete_image = ImageChops.add_modulo(complete_image, ImageEnhance.Brightness(
-                        self.images[pin]).enhance(pin_list[pin]))
-
-            image.showImage(self.led, "",
-                            ImageEnhance.Brightness(complete_image).enhance(self.max_brightness * 0.5))
+            # a bar for each channel, colored by height
+            y_ind = ((float(len(pin_list)) / h) * numpy.arange(h)).astype(int)
+            y_ind = numpy.unique(y_ind[y_ind < cols])
+            heights = numpy.zeros(cols, dtype=int)
+            levels = numpy.asarray(pin_list)[y_ind]
+            heights[y_ind] = numpy.minimum((levels * float(w)).astype(int), w)
+            x_cord = numpy.arange(rows)[:, None]
+            self.write_grid(self.sbars_palette, numpy.where(x_cord < heights, x_cord, -1))
+
+        elif self.p_type == 'MBARS':
+            norm_arr = (numpy.asarray(pin_list) * 255).astype(int)
+            if self.drops.shape[1] != len(norm_arr):
+                self.drops = numpy.zeros((w, len(norm_arr)), dtype=int)
+                self.drops_head = 0
+
+            # the last w frames scroll down the matrix, newest at the bottom
+            x_ind = ((float(len(pin_list)) / h) * numpy.arange(h)).astype(int)
+            drops = self.drops[(self.drops_head + numpy.arange(w)) % w][::-1, x_ind]
+            drops = numpy.where(drops > 64, numpy.clip(drops, 0, 255), -1)
+            grid = numpy.full((rows, cols), -1)
+            grid[:min(w, rows), :min(h, cols)] = drops[:rows, :cols]
+            self.write_grid(self.mbars_palette, grid)
+
+            self.drops[self.drops_head] = norm_arr
+            self.drops_head = (self.drops_head + 1) % w
 
         elif self.p_type == 'PINWHEEL':
             amt = 0
@@ -356,46 +543,48 @@ class Led(object):
                 amt += pin_list[pin] * (len(pin_list) / (pin + 1)) * 0.25
             amt = int(amt)
 
-            pos = 0
-            for x in range(h):
-                c = colors.hue_helper(pos, self._len, self._step)
-                self.led.drawLine(self.midxa, self.midya, x, 0, c)
-                pos += 1
-
-            for y in range(w):
-                c = colors.hue_helper(pos, self._len, self._step)
-                self.led.drawLine(self.midxb, self.midyb, h - 1, y, c)
-                pos += 1
-
-            for x in range(h - 1, -1, -1):
-                c = colors.hue_helper(pos, self._len, self._step)
-                self.led.drawLine(self.midxb, self.midyb, x, w - 1, c)
-                pos += 1
-
-            for y in range(w - 1, -1, -1):
-                c = colors.hue_helper(pos, self._len, self._step)
-                self.led.drawLine(self.midxa, self.midya, 0, y, c)
-                pos += 1
+            hues = ((self.pinwheel_lines * 255 // self._len) + self._step) % 255
+            palette = list(map(self.hue_palette.__getitem__, hues.tolist()))
+            self.write_grid(palette, self.pinwheel_grid)
 
             self._step += amt
             if(self._step >= 255):
                 self._step = 0
 
         elif self.p_type == 'CBARS':
-            for y in range(w):
-                level = pin_list[int((y / float(w)) * float(self.led_config.led_channel_count))]
-                brightness = int(255 * level)
-                rgb = scale(color_map[brightness], brightness)
-                mlvl = int(level * self.midxa)
-                self.led.drawLine(self.midxa - mlvl, y,self.midxb + mlvl, y,rgb)
+            # a line from the middle of each row, as long as the level
+            y = numpy.arange(w)
+            channel = ((y / float(w)) * float(self.led_config.led_channel_count)).astype(int)
+            levels = numpy.asarray(pin_list)[channel]
+            brightness = (255 * levels).astype(int)
+            mlvl = (levels * self.midxa).astype(int)
+            x0 = self.midxa - mlvl
+            x1 = self.midxb + mlvl
+            x = numpy.arange(cols)
+            inside = (x >= numpy.minimum(x0, x1)[:, None]) & (x <= numpy.maximum(x0, x1)[:, None])
+            grid = numpy.full((rows, cols), -1)
+            grid[:min(w, rows)] = numpy.where(inside, brightness[:, None], -1)[:rows]
+            self.write_grid(self.cbars_palette, grid)
 
         elif self.p_type == 'CIRCLES':
-            for pin in range(self.led_config.led_channel_count):
-                rgb = self.rgb[pin]
-                c = scale(rgb,int((pin_list[pin]) * 255))
-                self.led.drawCircle(self.midxa,self.midyb,int(pin * ((w / 2) / self.led_config.led_channel_count)),c)
+            count = self.led_config.led_channel_count
+            brightness = (numpy.asarray(pin_list[:count]) * 255).astype(int)
+            rgb = (self.channel_rgb[:count] * brightness[:, None]) >> 8
+            self.write_grid(list(map(tuple, rgb.tolist())), self.circles_grid)
+
+        elif self.p_type == 'IMAGE':
+            self.led.all_off()
+            complete_image = self.base_image
+            for pin in range(len(pin_list)):
+                if pin_list[pin] > 0.55:
+                    complete_image = ImageChops.add_modulo(complete_image, ImageEnhance.Brightness(
+                        self.images[pin]).enhance(pin_list[pin]))
+
+            image.showImage(self.led, "",
+                            ImageEnhance.Brightness(complete_image).enhance(self.max_brightness * 0.5))
 
         elif self.p_type == 'BANNER':
+            self.led.all_off()
             rgb = self.rgb[list(pin_list).index(max(list(pin_list)))] 
 # fit 4 characters into width
             text = self.led_config.banner_text[int(self._bstep):int(self._bstep)+4]
@@ -408,5 +597,8 @@ class Led(object):
             if(self._bstep >= len(self.led_config.banner_text)):
                 self._bstep = 0
 
+        else:
+            self.led.all_off()
+
         self.led.push_to_driver()
         self.update_skip = self.skip
@@ -156,24 +156,11 @@ class Gui(Canvas):
 
     def tkinter_function(self):
         """this is where the window is updated"""
-        b_levels = None
-        data = self.network.receive()
-        done = False
+        b_levels = self.network.receive()
 
-        if isinstance(data[0], int):
-            pin = data[0]
-            if pin in self.channel_keys:
-                self.set_light(self.channels[pin], True, float(data[1]))
-            done = True
-
-        elif isinstance(data[0], np.ndarray):
-            b_levels = data[0]
-
-        else:
-            done = True
-
-        if not done:
-            for pin in self.channel_keys:
+        for pin in self.channel_keys:
+            # channels the server did not set are -1
+            if b_levels[pin] >= 0:
                 self.set_light(self.channels[pin], True, b_levels[pin])
 
         self.parent.after(1, self.tkinter_function)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.org/
+#
+
+"""Play the lightshow a lightshowpi server streams over the network
+
+A client only receives frames and sets its lights, so this script loads
+just the networking and hardware controller modules (and the led modules
+if leds are configured).  It starts much faster and uses far less memory
+than running synchronized_lights.py on the client, which also loads the
+audio, fft and terminal modules.
+
+The client must be configured with networking = client, see the [network]
+section of defaults.cfg.
+
+Sample usage:
+sudo python3 network_client.py
+
+With a config override -
+sudo python3 network_client.py --config=client.cfg
+"""
+
+import argparse
+import logging as log
+import os
+import signal
+import sys
+import time
+
+import numpy as np
+
+# Make sure SYNCHRONIZED_LIGHTS_HOME environment variable is set
+HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
+
+if not HOME_DIR:
+    print("Need to setup SYNCHRONIZED_LIGHTS_HOME environment variable, see readme")
+    sys.exit()
+
+LOG_DIR = HOME_DIR + '/logs'
+
+# logging levels
+levels = {'DEBUG': log.DEBUG,
+          'INFO': log.INFO,
+          'WARNING': log.WARNING,
+          'ERROR': log.ERROR,
+          'CRITICAL': log.CRITICAL}
+
+
+def run(hc, network):
+    """Receive frames from the server and set the lights until CTRL<C>
+
+    :param hc: hardware controller of this client
+    :type hc: hardware_controller.Hardware
+
+    :param network: network stream in client mode
+    :type network: networking.Networking
+    """
+    log.info("Network client mode starting")
+    print("Network client mode starting...")
+    print("press CTRL<C> to end")
+
+    hc.initialize()
+
+    try:
+        channels = network.channels
+
+        # server channel and local pin of each mapped channel
+        server_channels = np.array(list(channels.keys()), dtype=int)
+        local_pins = np.array([channels[pin] for pin in server_channels], dtype=int)
+
+        if network.render_rate:
+            # set the lights at render_rate, fading between frames
+            interval = 1.0 / network.render_rate
+            next_render = time.time()
+            while True:
+                brightness_levels = network.render(next_render)
+                if brightness_levels is not None:
+                    show(hc, brightness_levels, server_channels, local_pins)
+
+                next_render += interval
+                delay = next_render - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # running behind, skip the renders missed
+                    next_render = time.time()
+
+        while True:
+            show(hc, network.receive(), server_channels, local_pins)
+
+    except KeyboardInterrupt:
+        log.info("CTRL<C> pressed, stopping")
+        print("stopping")
+
+        network.close_connection()
+        hc.clean_up()
+
+
+def show(hc, brightness_levels, server_channels, local_pins):
+    """Set the lights to a frame
+
+    :param hc: hardware controller of this client
+    :type hc: hardware_controller.Hardware
+
+    :param brightness_levels: level of each server channel, -1 for the
+        channels the server did not set
+    :type brightness_levels: np.array
+
+    :param server_channels: server channel of each mapped channel
+    :type server_channels: np.array
+
+    :param local_pins: local pin of each mapped channel
+    :type local_pins: np.array
+    """
+    is_set = brightness_levels >= 0
+
+    if hc.led and is_set.all():
+        for led_instance in hc.led:
+            led_instance.write_all(brightness_levels)
+
+    is_set = is_set[server_channels]
+    hc.set_lights(brightness_levels[server_channels][is_set], True, local_pins[is_set])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', default=None,
+                        help='Set the logging level. levels:INFO, DEBUG, WARNING, ERROR, CRITICAL')
+    parser.add_argument('--config', default=None, help='Config File Override')
+    args = parser.parse_args()
+
+    log.basicConfig(filename=LOG_DIR + '/network_client.dbg',
+                    format='[%(asctime)s] %(levelname)s {%(pathname)s:%(lineno)d} - %(message)s',
+                    level=levels.get(str(args.log).upper(), log.INFO))
+
+    import hardware_controller
+
+    hc = hardware_controller.Hardware(param_config=args.config)
+
+    if hc.network.networking != "client":
+        print("networking must be set to client in the [network] section of your config")
+        sys.exit(1)
+
+    # hardware_controller ignores CTRL<C>, stop cleanly on it instead
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    run(hc, hc.network)
+
+
+if __name__ == "__main__":
+    main()
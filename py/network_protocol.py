@@ -0,0 +1,344 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.org/
+#
+
+"""Encode and decode the frames a lightshowpi server sends to its clients.
+
+A frame is a small header followed by the level of every channel, as
+unsigned 8 or 16 bit integers, so a frame for 16 channels is 38 bytes
+instead of the 300 or so a pickled numpy array takes.
+
+Layout (little endian):
+
+    magic          4 bytes    b"LSPI"
+    version        uint8
+    type           uint8      FULL or PARTIAL, plus FRAGMENT and LEVELS_16
+    sequence       uint32     incremented by the server for every frame
+    timestamp      float64    presentation time, server time.time() at which
+                              clients should show the frame
+    channel count  uint32     channels in this packet
+    fragment       FRAGMENT only, FRAGMENT_HEADER: first channel, channels
+                   in the whole frame, fragment index and fragment count
+    set mask       PARTIAL only, one bit per channel, numpy.packbits order
+    levels         uint8 or uint16 for each channel (each set channel for
+                   PARTIAL frames)
+
+A PARTIAL frame only sets some of the channels, the pre/post shows setting
+single lights or a server sending each client only the channels it uses.
+The channels that are not set are decoded as -1.
+
+A frame that does not fit in MAX_PACKET_SIZE is sent as several FRAGMENT
+packets, each holding a block of consecutive channels.  A fragment decodes
+like a PARTIAL frame setting only its block, so a client can show the
+blocks that arrived when one is lost.
+
+For clients that can not decode binary frames (the NodeMCU sketch in
+Arduino/nodemcu) encode_json() gives the same frame as compact json.
+
+Clients find how far their clock is from the server's by sending a clock
+request to the server's port + 1.  The server answers with the request's
+send time, the time it received the request and the time it answered,
+all packed in CLOCK (magic b"LSPC" and three float64).
+
+Clients also send the server's port + 1 a report of how their link is doing
+every few seconds, packed in STATS (magic b"LSPR"): the frames received and
+lost since the last report, the inter-arrival jitter, and the mean and least
+time frames arrived before they were due.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b"LSPI"
+VERSION = 1
+HEADER = struct.Struct("<4sBBIdI")
+FRAGMENT_HEADER = struct.Struct("<IIHH")
+
+# frame types
+FULL = 0
+PARTIAL = 1
+FRAGMENT = 2
+LEVELS_16 = 0x80
+
+# largest packet that fits in one ethernet or wifi frame (1500 byte mtu
+# less the ip and udp headers), larger frames are sent as fragments
+MAX_PACKET_SIZE = 1472
+
+# largest udp payload
+MAX_FRAME_SIZE = 65507
+
+CLOCK_MAGIC = b"LSPC"
+CLOCK = struct.Struct("<4sddd")
+
+STATS_MAGIC = b"LSPR"
+STATS = struct.Struct("<4sIIddd")
+
+
+def encode(levels, sequence, timestamp, bits=8, include=None):
+    """Encode channel levels as binary packets
+
+    :param levels: level of each channel between 0.0 and 1.0, -1 for a
+        channel that is not set
+    :type levels: numpy.array
+
+    :param sequence: frame sequence number
+    :type sequence: int
+
+    :param timestamp: presentation time of the frame
+    :type timestamp: float
+
+    :param bits: 8 or 16, resolution of the levels
+    :type bits: int
+
+    :param include: which channels to send, defaults to all of them
+    :type include: numpy.array of bool
+
+    :return: the frame as one packet, or as fragments if it does not fit
+        in MAX_PACKET_SIZE
+    :rtype: list of bytes
+    """
+    levels = np.asarray(levels, dtype=float).ravel()
+    dtype, scale = (np.dtype("<u2"), 65535) if bits == 16 else (np.dtype("u1"), 255)
+
+    is_set = levels >= 0
+    if include is not None:
+        is_set &= include
+
+    values = np.rint(np.clip(levels, 0.0, 1.0) * scale).astype(dtype)
+    frame_type = LEVELS_16 if bits == 16 else FULL
+    partial = not is_set.all()
+
+    total = len(values)
+    if HEADER.size + (total + 7) // 8 * partial + values.nbytes <= MAX_PACKET_SIZE:
+        return [encode_block(values, is_set, partial, frame_type, sequence, timestamp)]
+
+    # channels per fragment, allowing for a set mask
+    room = MAX_PACKET_SIZE - HEADER.size - FRAGMENT_HEADER.size
+    if partial:
+        block = (room - 1) * 8 // (8 * dtype.itemsize + 1)
+    else:
+        block = room // dtype.itemsize
+    fragments = (total + block - 1) // block
+
+    packets = list()
+    for index, first in enumerate(range(0, total, block)):
+        fragment = FRAGMENT_HEADER.pack(first, total, index, fragments)
+        packets.append(encode_block(values[first:first + block],
+                                    is_set[first:first + block],
+                                    partial,
+                                    frame_type | FRAGMENT,
+                                    sequence,
+                                    timestamp,
+                                    fragment))
+
+    return packets
+
+
+def encode_block(values, is_set, partial, frame_type, sequence, timestamp, fragment=b""):
+    """Encode one packet
+
+    :param values: level of each channel, as sent
+    :type values: numpy.array
+
+    :param is_set: which channels are set
+    :type is_set: numpy.array of bool
+
+    :param partial: send a set mask and only the channels that are set
+    :type partial: bool
+
+    :param frame_type: type of the packet, without PARTIAL
+    :type frame_type: int
+
+    :param sequence: frame sequence number
+    :type sequence: int
+
+    :param timestamp: presentation time of the frame
+    :type timestamp: float
+
+    :param fragment: FRAGMENT_HEADER for fragments
+    :type fragment: bytes
+
+    :return: the packet
+    :rtype: bytes
+    """
+    mask = b""
+    if partial:
+        frame_type |= PARTIAL
+        mask = np.packbits(is_set).tobytes()
+        values = values[is_set]
+
+    return b"".join([HEADER.pack(MAGIC, VERSION, frame_type, sequence & 0xFFFFFFFF,
+                                 timestamp, len(is_set)),
+                     fragment,
+                     mask,
+                     values.tobytes()])
+
+
+def decode(frame):
+    """Decode a binary frame or fragment
+
+    :param frame: frame as received
+    :type frame: bytes | bytearray | memoryview
+
+    :return: sequence, timestamp, the level of each channel (-1 for the
+        channels a PARTIAL frame or a fragment does not set) and the number
+        of fragments in the frame
+    :rtype: tuple
+    :raise ValueError: if frame is not a valid frame
+    """
+    if len(frame) < HEADER.size:
+        raise ValueError("frame is truncated")
+
+    magic, version, frame_type, sequence, timestamp, count = HEADER.unpack_from(frame)
+    if magic != MAGIC:
+        raise ValueError("not a lightshowpi frame")
+    if version != VERSION:
+        raise ValueError("unsupported frame version %d" % version)
+
+    dtype, scale = (np.dtype("<u2"), 65535.0) if frame_type & LEVELS_16 else (np.dtype("u1"), 255.0)
+
+    offset = HEADER.size
+    first, total, fragments = 0, count, 1
+    if frame_type & FRAGMENT:
+        if len(frame) < offset + FRAGMENT_HEADER.size:
+            raise ValueError("frame is truncated")
+
+        first, total, _, fragments = FRAGMENT_HEADER.unpack_from(frame, offset)
+        offset += FRAGMENT_HEADER.size
+        if first + count > total:
+            raise ValueError("fragment is outside of its frame")
+
+    if frame_type & PARTIAL:
+        mask_size = (count + 7) // 8
+        if len(frame) < offset + mask_size:
+            raise ValueError("frame is truncated")
+
+        mask = np.frombuffer(frame, dtype=np.uint8, count=mask_size, offset=offset)
+        is_set = np.unpackbits(mask)[:count].astype(bool)
+        offset += mask_size
+        set_count = int(is_set.sum())
+    else:
+        is_set = None
+        set_count = count
+
+    if len(frame) != offset + set_count * dtype.itemsize:
+        raise ValueError("frame length does not match its channel count")
+
+    values = np.frombuffer(frame, dtype=dtype, count=set_count, offset=offset) / scale
+    if is_set is None and not frame_type & FRAGMENT:
+        return sequence, timestamp, values, fragments
+
+    levels = np.full(total, -1.0)
+    block = levels[first:first + count]
+    if is_set is None:
+        block[:] = values
+    else:
+        block[is_set] = values
+
+    return sequence, timestamp, levels, fragments
+
+
+def encode_json(levels, sequence):
+    """Encode channel levels as compact json
+
+    Levels are rounded to 3 decimals, -1 for a channel that is not set.
+
+    :param levels: level of each channel between 0.0 and 1.0, -1 for a
+        channel that is not set
+    :type levels: numpy.array
+
+    :param sequence: frame sequence number
+    :type sequence: int
+
+    :return: the frame
+    :rtype: bytes
+    """
+    levels = np.round(np.asarray(levels, dtype=float).ravel(), 3)
+
+    return json.dumps({"seq": sequence, "data": levels.tolist()},
+                      separators=(",", ":")).encode("utf-8")
+
+
+def encode_clock(sent, received=0.0, answered=0.0):
+    """Encode a clock request (sent only) or answer
+
+    :param sent: client time the request was sent
+    :type sent: float
+
+    :param received: server time the request was received
+    :type received: float
+
+    :param answered: server time the answer was sent
+    :type answered: float
+
+    :return: the packet
+    :rtype: bytes
+    """
+    return CLOCK.pack(CLOCK_MAGIC, sent, received, answered)
+
+
+def decode_clock(packet):
+    """Decode a clock request or answer
+
+    :param packet: packet as received
+    :type packet: bytes
+
+    :return: sent, received and answered times
+    :rtype: tuple
+    :raise ValueError: if packet is not a clock packet
+    """
+    if len(packet) != CLOCK.size:
+        raise ValueError("clock packet has the wrong size")
+
+    magic, sent, received, answered = CLOCK.unpack(packet)
+    if magic != CLOCK_MAGIC:
+        raise ValueError("not a lightshowpi clock packet")
+
+    return sent, received, answered
+
+
+def encode_stats(received, lost, jitter, headroom, min_headroom):
+    """Encode a client's link report
+
+    :param received: frames received since the last report
+    :type received: int
+
+    :param lost: frames lost since the last report
+    :type lost: int
+
+    :param jitter: inter-arrival jitter in seconds
+    :type jitter: float
+
+    :param headroom: mean seconds frames arrived before they were due
+    :type headroom: float
+
+    :param min_headroom: least seconds a frame arrived before it was due
+    :type min_headroom: float
+
+    :return: the packet
+    :rtype: bytes
+    """
+    return STATS.pack(STATS_MAGIC, received, lost, jitter, headroom, min_headroom)
+
+
+def decode_stats(packet):
+    """Decode a client's link report
+
+    :param packet: packet as received
+    :type packet: bytes
+
+    :return: received, lost, jitter, headroom and min_headroom
+    :rtype: tuple
+    :raise ValueError: if packet is not a link report
+    """
+    if len(packet) != STATS.size:
+        raise ValueError("link report has the wrong size")
+
+    report = STATS.unpack(packet)
+    if report[0] != STATS_MAGIC:
+        raise ValueError("not a lightshowpi link report")
+
+    return report[1:]
@@ -12,12 +12,38 @@ The network controller handles all interaction with the raspberry pi
 to send or receive data to/from lightshowpi network enabled raspberry pi(s).
 """
 
-import pickle
+import errno
 import json
 import logging as log
+import os
 import socket
 import numpy as np
+import signal
+import struct
 import sys
+import threading
+import time
+from collections import deque
+
+import network_protocol
+
+# seconds between clock syncs, the offset is taken from the sync with the
+# shortest round trip of the last CLOCK_SAMPLES
+CLOCK_SYNC_INTERVAL = 5.0
+CLOCK_SAMPLES = 8
+
+# frames due further ahead than this are shown on arrival, the clock offset
+# must be wrong
+MAX_HOLD = 1.0
+
+# seconds to wait for the missing fragments of a frame
+FRAGMENT_TIMEOUT = 0.05
+
+# a jump in sequence numbers this large is the server restarting, not loss
+MAX_SEQUENCE_GAP = 1000
+
+# largest packet sent to the clock server
+CLOCK_PACKET_SIZE = max(network_protocol.CLOCK.size, network_protocol.STATS.size)
 
 
 class Networking(object):
@@ -33,10 +59,48 @@ class Networking(object):
         self.networking = cm.network.networking
         self.ip_clients = cm.network.ip_clients
         self.port = cm.network.port
-        self.network_buffer = cm.network.buffer
         self.channels = cm.network.channels
+        self.multicast_group = cm.network.multicast_group
+        self.client_channels = cm.network.client_channels
+        self.client_masks = dict()
         self.playing = False
 
+        # frames are sent with 16 bit levels if 8 bits can not hold pwm_range
+        self.level_bits = 16 if cm.hardware.pwm_range > 255 else 8
+        self.sequence = 0
+        self.receive_buffer = bytearray(network_protocol.MAX_FRAME_SIZE)
+        self.received_sequence = None
+        self.received_timestamp = None
+        self.frames_invalid = 0
+
+        # servers stamp frames with when to show them, clients hold frames
+        # until then
+        self.playout_delay = cm.network.playout_delay
+        self.jitter_buffer = JitterBuffer(cm.network.max_late)
+        self.link_stats = LinkStats()
+        self.clock_server = None
+        self.clock_client = None
+
+        # last frame sent, quantized to pwm_range, unchanged frames are only
+        # sent every keepalive seconds
+        self.keepalive = cm.network.keepalive
+        self.pwm_range = cm.hardware.pwm_range
+        self.last_frame = None
+        self.last_sent = 0.0
+        self.frames_sent = 0
+        self.frames_skipped = 0
+
+        # servers send at most send_rate full frames a second
+        self.send_interval = 1.0 / cm.network.send_rate if cm.network.send_rate > 0 else 0.0
+        self.next_send = 0.0
+        self.frames_throttled = 0
+
+        # clients set their lights render_rate times a second, fading from
+        # the frame shown (due at shown_time) to the next one
+        self.render_rate = cm.network.render_rate
+        self.shown = None
+        self.shown_time = None
+
         self.network_stream = None
         self.setup()
 
@@ -55,6 +119,18 @@ class Networking(object):
             self.network_stream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.network_stream.bind(('', 0))
             self.network_stream.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+            if self.multicast_group:
+                ttl = struct.pack('b', 1)
+                self.network_stream.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+                log.info("streaming to multicast group: " + self.multicast_group)
+
+            if self.networking == "server":
+                self.clock_server = ClockServer(self.port + 1,
+                                                self.playout_delay,
+                                                self.cm.log_dir + "network_clients.json")
+                self.clock_server.start()
+
             log.info("streaming on port: " + str(self.port))
         except socket.error(msg):
             log.error('Failed create socket or bind. Error code: ' +
@@ -70,6 +146,16 @@ class Networking(object):
             self.network_stream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.network_stream.bind(('', self.port))
 
+            if self.multicast_group:
+                membership = socket.inet_aton(self.multicast_group) + socket.inet_aton("0.0.0.0")
+                self.network_stream.setsockopt(socket.IPPROTO_IP,
+                                               socket.IP_ADD_MEMBERSHIP,
+                                               membership)
+                log.info("joined multicast group: " + self.multicast_group)
+
+            self.clock_client = ClockClient(self.port + 1, self.link_stats)
+            self.clock_client.start()
+
             print("listening on port: " + str(self.port))
 
             log.info("client channels mapped as\n" + str(self.channels))
@@ -82,61 +168,302 @@ class Networking(object):
 
     def close_connection(self):
         """Close the network stream"""
+        if self.frames_sent:
+            log.debug("network frames sent: %d, unchanged and skipped: %d, "
+                      "over send_rate: %d",
+                      self.frames_sent, self.frames_skipped, self.frames_throttled)
+
+        if self.jitter_buffer.played:
+            log.info("network frames played: %(played)d, dropped late: %(late)d, "
+                     "dropped for a newer frame: %(superseded)d, "
+                     "missing fragments: %(incomplete)d, invalid: %(invalid)d",
+                     self.receive_stats())
+
+        for clock in (self.clock_server, self.clock_client):
+            if clock:
+                clock.stop()
+
         if self.network_stream:
             self.network_stream.close()
             self.network_stream = None
 
     def receive(self):
-        """Receive the data sent from the server and decode it
+        """Receive the next frame from the server, at its presentation time
+
+        Frames wait in the jitter buffer until the time the server stamped
+        them with, on this clock.  Until the clock client has synced with
+        the server frames are shown as they arrive.  Every frame waiting on
+        the socket is read before a frame is returned, so a client that is
+        slow to set its lights skips to the newest frame instead of lagging.
 
-        :return: data
-        :rtype tuple: np.array | tuple
+        :return: level of each channel, -1 for the channels the frame does
+            not set
+        :rtype: np.array
         """
-        try:
-            data, address = self.network_stream.recvfrom(self.network_buffer)
-            data = pickle.loads(data)
-        except (IndexError, pickle.PickleError):
-            data = tuple(np.array([0 for _ in range(cm.hardware.gpio_len)]))
+        while True:
+            self.drain()
 
-        return data
+            now = time.time()
+            levels = self.jitter_buffer.pop(now)
+            if levels is not None:
+                return levels
 
-    def broadcast(self, *args):
-        """Broadcast data over the network
+            # wait for a frame, or until the next one is due
+            self.network_stream.settimeout(self.jitter_buffer.wait_time(now))
+            try:
+                self.add_packet(*self.network_stream.recvfrom_into(self.receive_buffer))
+            except socket.timeout:
+                continue
 
-        args will be pickled before being sent
+    def render(self, now):
+        """Channel levels to show at now, faded between frames
 
-        :param args: (list of lists) to broadcast clients channel data
+        For clients that set their lights at their own rate (render_rate)
+        rather than as each frame is due.  Each channel fades from the frame
+        shown last to the next frame in the jitter buffer, by how far now is
+        between their presentation times.  Channels the next frame does not
+        set hold their level, until the next frame arrives every channel
+        holds.  Never waits for a frame.
 
-                        (tuple) pin, brightness pair
+        :param now: time to render
+        :type now: float
 
-        :type args: list | tuple
+        :return: level of each channel, -1 for the channels no frame has set,
+            None until the first frame is due
+        :rtype: np.array | None
         """
-        if self.networking == "server":
+        self.drain()
+
+        levels = self.jitter_buffer.pop(now)
+        if levels is not None:
+            if self.shown is None or len(self.shown) != len(levels):
+                self.shown = levels
+            else:
+                self.shown = np.where(levels < 0, self.shown, levels)
+            self.shown_time = self.jitter_buffer.shown_time
+
+        upcoming = self.jitter_buffer.upcoming()
+        if self.shown is None or upcoming is None or len(upcoming[1]) != len(self.shown):
+            return self.shown
+
+        play_time, target = upcoming
+        if play_time <= self.shown_time:
+            return self.shown
+
+        fraction = min(max((now - self.shown_time) / (play_time - self.shown_time), 0.0), 1.0)
+        target = np.where(target < 0, self.shown, target)
+        start = np.where(self.shown < 0, target, self.shown)
+
+        return start + (target - start) * fraction
+
+    def drain(self):
+        """Add every packet waiting on the socket to the jitter buffer"""
+        self.network_stream.setblocking(False)
+        while True:
             try:
-                data = pickle.dumps(args)
-                if self.ip_clients[0] != '':
-                    for ip_client in self.ip_clients: 
-                        self.network_stream.sendto(data, (ip_client, self.port))
-                else:
-                    self.network_stream.sendto(data, ('<broadcast>', self.port))
-            except socket.error as msg:
-                if msg[0] != 9:
-                    log.error(str(msg[0]) + ' ' + msg[1])
-                    print(str(msg[0]) + ' ' + msg[1])
+                self.add_packet(*self.network_stream.recvfrom_into(self.receive_buffer))
+            except (BlockingIOError, InterruptedError):
+                return
+
+    def add_packet(self, size, address):
+        """Decode a packet in receive_buffer and add it to the jitter buffer
+
+        :param size: length of the packet
+        :type size: int
+
+        :param address: where the packet came from
+        :type address: tuple
+        """
+        try:
+            frame = network_protocol.decode(memoryview(self.receive_buffer)[:size])
+        except ValueError as error:
+            self.frames_invalid += 1
+            log.debug("ignoring network packet: " + str(error))
+            return
+
+        self.received_sequence, self.received_timestamp, levels, fragments = frame
+        self.clock_client.server = address[0]
+
+        now = time.time()
+        offset = self.clock_client.offset
+        self.link_stats.add(self.received_sequence, self.received_timestamp, now, offset)
+        if offset is None or self.received_timestamp - offset > now + MAX_HOLD:
+            play_time = now
+        else:
+            play_time = self.received_timestamp - offset
+
+        self.jitter_buffer.add(self.received_sequence, play_time, levels, fragments, now)
+
+    def receive_stats(self):
+        """How the frames received so far were handled
+
+        :return: frames played, dropped because they were late or out of
+            order, dropped because a newer frame was due, played with
+            fragments missing, and packets that were not valid frames
+        :rtype: dict
+        """
+        return {"played": self.jitter_buffer.played,
+                "late": self.jitter_buffer.late,
+                "superseded": self.jitter_buffer.superseded,
+                "incomplete": self.jitter_buffer.incomplete,
+                "invalid": self.frames_invalid}
+
+    def broadcast(self, levels, force=False):
+        """Broadcast channel levels over the network
+
+        As a binary frame, or as json in serverjson mode, see network_protocol
+
+        :param levels: level of each channel, -1 for the channels not to set
+            (the pre/post shows setting single lights)
+        :type levels: list | np.array
+
+        :param force: send the frame even if it is over send_rate, for the
+            last frame of a show
+        :type force: bool
+        """
+        if self.is_throttled(levels, force) or self.is_unchanged(levels):
+            return
+
+        # only a frame that is sent takes up a send_rate slot
+        self.schedule_next_send(force)
+
+        # when clients should show the frame
+        timestamp = time.time() + self.playout_delay
 
         if self.networking == "serverjson":
-            try:
-                data = list(map(str, [(round(item,3)) for item in args[0]]))
-                j_data = json.dumps({'data':(data)})
-                if self.ip_clients[0] != '':
-                    for ip_client in self.ip_clients: 
-                        self.network_stream.sendto(bytes(j_data, 'utf-8'), (ip_client, self.port))
-                else:
-                    self.network_stream.sendto(bytes(j_data, 'utf-8'), ('<broadcast>', self.port))
-            except socket.error as msg:
-                if msg[0] != 9:
-                    log.error(str(msg[0]) + ' ' + msg[1])
-                    print(str(msg[0]) + ' ' + msg[1])
+            data = network_protocol.encode_json(levels, self.sequence)
+            packets = [(data, address) for address in self.destinations()]
+
+        elif self.client_channels:
+            # each client gets a frame with only the channels it uses
+            packets = [(data, address)
+                       for include, address in self.get_client_masks(len(levels))
+                       for data in network_protocol.encode(levels,
+                                                           self.sequence,
+                                                           timestamp,
+                                                           self.level_bits,
+                                                           include)]
+
+        else:
+            frame = network_protocol.encode(levels, self.sequence, timestamp, self.level_bits)
+            packets = [(data, address) for address in self.destinations() for data in frame]
+
+        self.sequence += 1
+
+        # every packet is encoded before the first is sent, so they go out
+        # back to back
+        sendto = self.network_stream.sendto
+        try:
+            for data, address in packets:
+                sendto(data, address)
+        except socket.error as msg:
+            if msg.errno != errno.EBADF:
+                log.error(str(msg))
+                print(str(msg))
+
+    def destinations(self):
+        """Where to send frames that go to every client
+
+        :return: the multicast group, each of ip_clients, or the broadcast address
+        :rtype: list
+        """
+        if self.multicast_group:
+            return [(self.multicast_group, self.port)]
+
+        if self.ip_clients[0] != '':
+            return [(ip_client, self.port) for ip_client in self.ip_clients]
+
+        return [('<broadcast>', self.port)]
+
+    def get_client_masks(self, count):
+        """Which channels to send to each client in client_channels
+
+        :param count: number of channels in a frame
+        :type count: int
+
+        :return: a mask of the channels each client uses, with its address
+        :rtype: list
+        """
+        if count not in self.client_masks:
+            masks = list()
+            for address, channels in self.client_channels:
+                include = np.zeros(count, dtype=bool)
+                include[[channel for channel in channels if channel < count]] = True
+                masks.append((include, (address, self.port)))
+
+            self.client_masks[count] = masks
+
+        return self.client_masks[count]
+
+    def is_throttled(self, levels, force=False):
+        """Is this frame over send_rate
+
+        Only frames that set every channel are dropped, the next one sent
+        replaces them.  Frames setting single lights are always sent.
+
+        :param levels: channel levels about to be broadcast
+        :type levels: list | np.array
+
+        :param force: never drop the frame
+        :type force: bool
+
+        :return: True if the frame should not be sent
+        :rtype: bool
+        """
+        if not self.send_interval or force:
+            return False
+
+        if time.time() < self.next_send and np.min(levels) >= 0:
+            self.frames_throttled += 1
+            return True
+
+        return False
+
+    def schedule_next_send(self, force=False):
+        """Move the next send_rate slot on, for a frame that is being sent
+
+        Frames sent within a slot (single lights, the last frame of a show)
+        do not move it.
+
+        :param force: the frame was sent even if it was over send_rate
+        :type force: bool
+        """
+        if not self.send_interval or force:
+            return
+
+        now = time.time()
+        if now < self.next_send:
+            return
+
+        # keep to the send_rate cadence unless sending stopped for a while
+        if now - self.next_send < self.send_interval:
+            self.next_send += self.send_interval
+        else:
+            self.next_send = now + self.send_interval
+
+    def is_unchanged(self, levels):
+        """Has this frame already been sent
+
+        Levels are compared once quantized to pwm_range.  A frame that is
+        unchanged is still reported as changed once every keepalive seconds.
+
+        :param levels: channel levels about to be broadcast
+        :type levels: list | np.array
+
+        :return: True if the frame does not need to be sent
+        :rtype: bool
+        """
+        frame = np.rint(np.asarray(levels, dtype=float) * self.pwm_range)
+        now = time.time()
+
+        if now - self.last_sent < self.keepalive and np.array_equal(frame, self.last_frame):
+            self.frames_skipped += 1
+            return True
+
+        self.last_frame = frame
+        self.last_sent = now
+        self.frames_sent += 1
+        return False
 
     def set_playing(self):
         """Set a flag for playing,
@@ -155,3 +482,388 @@ class Networking(object):
     def unset_playing(self):
         """Unset the playing flag."""
         self.playing = False
+
+
+def block_signals():
+    """Leave CTRL<C> and kill to the main thread
+
+    A signal taken by another thread does not interrupt the main thread
+    while it waits for a frame, so it would not stop until the next frame.
+    """
+    signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGINT, signal.SIGTERM])
+
+
+class PendingFrame(object):
+    """A frame in the jitter buffer"""
+
+    def __init__(self, sequence, play_time, levels, fragments, now):
+        self.sequence = sequence
+        self.play_time = play_time
+        self.levels = levels
+
+        # fragments still to come, the frame is shown without them once
+        # FRAGMENT_TIMEOUT has passed
+        self.missing = fragments - 1
+        self.deadline = now + FRAGMENT_TIMEOUT
+
+    def add_fragment(self, levels):
+        self.levels = np.where(levels < 0, self.levels, levels)
+        self.missing -= 1
+
+    def due(self):
+        """When to show the frame"""
+        if self.missing:
+            return max(self.play_time, self.deadline)
+
+        return self.play_time
+
+
+class JitterBuffer(object):
+    """Hold received frames until their presentation time
+
+    The fragments of a frame are put back together, a frame that is still
+    missing fragments when it is due is shown with the blocks that came.
+
+    Stale frames are dropped, never queued, so a client that falls behind
+    catches up instead of building up lag: a frame that is more than
+    max_late late when it arrives, a frame older than one already received
+    and a frame that is due along with a later one.
+    """
+
+    def __init__(self, max_late):
+        self.max_late = max_late
+        self.frames = deque()
+        self.latest = None
+        self.shown = None
+        self.shown_time = None
+        self.played = 0
+        self.late = 0
+        self.superseded = 0
+        self.incomplete = 0
+
+    def add(self, sequence, play_time, levels, fragments, now):
+        """Add a frame or a fragment of one
+
+        :param sequence: frame sequence number
+        :type sequence: int
+
+        :param play_time: when to show the frame, time.time() on this clock
+        :type play_time: float
+
+        :param levels: level of each channel, -1 for the channels not set
+        :type levels: np.array
+
+        :param fragments: number of fragments in the frame
+        :type fragments: int
+
+        :param now: current time
+        :type now: float
+        """
+        if self.frames and self.frames[-1].sequence == sequence and self.frames[-1].missing:
+            self.frames[-1].add_fragment(levels)
+            return
+
+        if play_time < now - self.max_late or sequence == self.shown or \
+                (self.latest is not None and play_time < self.latest):
+            self.late += 1
+            return
+
+        self.latest = play_time
+        self.frames.append(PendingFrame(sequence, play_time, levels, fragments, now))
+
+    def wait_time(self, now):
+        """Seconds until the next frame is due
+
+        :param now: current time
+        :type now: float
+
+        :return: seconds to wait, None if there are no frames
+        :rtype: float | None
+        """
+        if not self.frames:
+            return None
+
+        return max(self.frames[0].due() - now, 0.001)
+
+    def upcoming(self):
+        """The next frame, due or not
+
+        :return: when to show it and its levels, None if there are no frames
+        :rtype: tuple | None
+        """
+        if not self.frames:
+            return None
+
+        return self.frames[0].play_time, self.frames[0].levels
+
+    def pop(self, now):
+        """Take the latest frame that is due
+
+        Frames due before it are dropped, the channels they set that it
+        does not set are kept.
+
+        :param now: current time
+        :type now: float
+
+        :return: the frame, None if no frame is due
+        :rtype: np.array | None
+        """
+        levels = None
+        while self.frames and self.frames[0].due() <= now:
+            frame = self.frames.popleft()
+            if frame.missing:
+                self.incomplete += 1
+
+            if levels is None:
+                levels = frame.levels
+            else:
+                self.superseded += 1
+                levels = np.where(frame.levels < 0, levels, frame.levels)
+
+            self.shown = frame.sequence
+            self.shown_time = frame.play_time
+
+        if levels is not None:
+            self.played += 1
+
+        return levels
+
+
+class LinkStats(object):
+    """How well frames reach a client, since its last link report
+
+    Frames missing from the sequence are lost.  Jitter is the inter-arrival
+    jitter of RFC 3550, how much the time between frames arriving varies
+    from the time between them being sent.  Headroom is how long before it
+    was due a frame arrived, the server's playout_delay less the one way
+    latency.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_sequence = None
+        self.last_arrival = None
+        self.last_timestamp = None
+        self.jitter = 0.0
+        self.reset()
+
+    def reset(self):
+        self.received = 0
+        self.lost = 0
+        self.headroom = 0.0
+        self.headroom_count = 0
+        self.min_headroom = None
+
+    def add(self, sequence, timestamp, now, offset):
+        """Count a frame or a fragment of one
+
+        :param sequence: frame sequence number
+        :type sequence: int
+
+        :param timestamp: presentation time of the frame, server clock
+        :type timestamp: float
+
+        :param now: when the frame arrived
+        :type now: float
+
+        :param offset: server time - time here, None until the clock synced
+        :type offset: float | None
+        """
+        with self.lock:
+            if sequence == self.last_sequence:
+                return
+
+            if self.last_sequence is not None:
+                gap = (sequence - self.last_sequence) & 0xFFFFFFFF
+                if gap > 0x7FFFFFFF:
+                    # out of order, it was counted as lost
+                    self.received += 1
+                    self.lost = max(self.lost - 1, 0)
+                    return
+
+                if gap <= MAX_SEQUENCE_GAP:
+                    self.lost += gap - 1
+                    transit = (now - self.last_arrival) - (timestamp - self.last_timestamp)
+                    self.jitter += (abs(transit) - self.jitter) / 16.0
+
+            self.last_sequence = sequence
+            self.last_arrival = now
+            self.last_timestamp = timestamp
+            self.received += 1
+
+            if offset is not None:
+                headroom = timestamp - offset - now
+                self.headroom += headroom
+                self.headroom_count += 1
+                if self.min_headroom is None or headroom < self.min_headroom:
+                    self.min_headroom = headroom
+
+    def report(self):
+        """Take the stats as a link report and start over
+
+        :return: the report, None if the clock has not synced yet
+        :rtype: bytes | None
+        """
+        with self.lock:
+            if not self.headroom_count and self.received:
+                return None
+
+            headroom = self.headroom / self.headroom_count if self.headroom_count else 0.0
+            report = network_protocol.encode_stats(self.received,
+                                                   self.lost,
+                                                   self.jitter,
+                                                   headroom,
+                                                   self.min_headroom or 0.0)
+            self.reset()
+
+        return report
+
+
+class ClockServer(threading.Thread):
+    """Answer the clock requests of network clients and collect their link reports
+
+    The latest report from each client is logged and written to status_path
+    as json, with the loss in percent and times in milliseconds.
+    """
+
+    def __init__(self, port, playout_delay, status_path):
+        super(ClockServer, self).__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', port))
+        self.sock.settimeout(1.0)
+        self.running = True
+
+        self.playout_delay = playout_delay
+        self.status_path = status_path
+        self.clients = dict()
+
+    def run(self):
+        block_signals()
+        while self.running:
+            try:
+                packet, address = self.sock.recvfrom(CLOCK_PACKET_SIZE + 1)
+                received = time.time()
+                if packet.startswith(network_protocol.STATS_MAGIC):
+                    self.add_report(address[0], network_protocol.decode_stats(packet), received)
+                    continue
+
+                sent = network_protocol.decode_clock(packet)[0]
+                self.sock.sendto(network_protocol.encode_clock(sent, received, time.time()),
+                                 address)
+            except (socket.timeout, ValueError):
+                continue
+            except socket.error as msg:
+                log.error("clock server: " + str(msg))
+                break
+
+        self.sock.close()
+
+    def add_report(self, client, report, now):
+        """Log a client's link report and update the status file
+
+        :param client: address of the client
+        :type client: str
+
+        :param report: decoded link report
+        :type report: tuple
+
+        :param now: when the report arrived
+        :type now: float
+        """
+        received, lost, jitter, headroom, min_headroom = report
+        frames = received + lost
+        status = {"received": received,
+                  "lost": lost,
+                  "loss": round(100.0 * lost / frames, 2) if frames else 0.0,
+                  "jitter": round(jitter * 1000, 2),
+                  "latency": round((self.playout_delay - headroom) * 1000, 2),
+                  "headroom": round(headroom * 1000, 2),
+                  "min_headroom": round(min_headroom * 1000, 2),
+                  "updated": now}
+        self.clients[client] = status
+
+        log.info("network client %s: loss %.2f%%, jitter %.2f ms, latency %.2f ms, "
+                 "least headroom %.2f ms", client, status["loss"], status["jitter"],
+                 status["latency"], status["min_headroom"])
+
+        # written to a temporary file first so readers never see half of it
+        try:
+            with open(self.status_path + ".tmp", "w") as status_file:
+                json.dump(self.clients, status_file, indent=4, sort_keys=True)
+            os.replace(self.status_path + ".tmp", self.status_path)
+        except (IOError, OSError) as error:
+            log.error("can not write network client status: " + str(error))
+
+    def stop(self):
+        self.running = False
+
+
+class ClockClient(threading.Thread):
+    """Keep track of how far the server's clock is from this one
+
+    Every CLOCK_SYNC_INTERVAL seconds a request is sent to the server the
+    frames come from, the offset is half the difference of the times each
+    way, taken from the sync with the shortest round trip of the last few.
+    A link report goes to the server after each sync.
+    """
+
+    def __init__(self, port, link_stats):
+        super(ClockClient, self).__init__(daemon=True)
+        self.port = port
+        self.link_stats = link_stats
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(1.0)
+        self.samples = deque(maxlen=CLOCK_SAMPLES)
+        self.running = True
+
+        # address of the server, server time - time here
+        self.server = None
+        self.offset = None
+
+    def run(self):
+        block_signals()
+        while self.running:
+            if self.server:
+                self.sync()
+                self.send_report()
+
+            # sync quickly until there is an offset
+            time.sleep(CLOCK_SYNC_INTERVAL if self.offset is not None else 0.2)
+
+        self.sock.close()
+
+    def send_report(self):
+        """Send the server a link report"""
+        report = self.link_stats.report()
+        if report is None:
+            return
+
+        try:
+            self.sock.sendto(report, (self.server, self.port))
+        except socket.error as error:
+            log.debug("link report failed: " + str(error))
+
+    def sync(self):
+        """Ask the server for its time and update the offset"""
+        sent = time.time()
+        try:
+            self.sock.sendto(network_protocol.encode_clock(sent), (self.server, self.port))
+
+            # skip answers to earlier requests that timed out
+            while True:
+                answer = network_protocol.decode_clock(
+                    self.sock.recv(network_protocol.CLOCK.size + 1))
+                if answer[0] == sent:
+                    break
+        except (socket.error, ValueError) as error:
+            log.debug("clock sync failed: " + str(error))
+            return
+
+        now = time.time()
+        received, answered = answer[1:]
+        round_trip = (now - sent) - (answered - received)
+        self.samples.append((round_trip, ((received - sent) + (answered - now)) / 2))
+        self.offset = min(self.samples)[1]
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,319 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.org/
+#
+
+"""A store of decoded songs.
+
+Decoding an mp3, m4a, ogg or wma takes more cpu than anything else in a
+show played from sync files, most of all on a Pi Zero or Pi 1.  With
+pcm_cache_dir set in the [audio_processing] section each compressed song is
+decoded once and kept as raw PCM, named by a hash of the song's contents.
+Playback memory maps the PCM file and reads it as it would the decoder.
+
+The songs coming up in the playlist are decoded by a warmer, this module
+run as a separate low priority process, so they are ready when they are
+played:
+
+    python3 pcm_cache.py --directory=/dev/shm/lightshowpi --size=1048576000 song.mp3 ...
+
+The index, hashing, locking and eviction of the least recently played
+songs are those of sync_cache.SyncCache, with pcm_cache_size as the budget.
+
+Layout of a PCM file (little endian):
+
+    magic          8 bytes    b"LSPIPCM "
+    version        uint16
+    channels       uint16
+    sample rate    uint32
+    frames         uint32
+    data offset    uint32     start of the samples, 16 byte aligned
+    padding        up to data offset
+    samples        int16 * channels * frames
+"""
+
+import argparse
+import fcntl
+import glob
+import logging as log
+import mmap
+import os
+import struct
+
+import decoder
+import sync_cache
+
+MAGIC = b"LSPIPCM "
+VERSION = 1
+HEADER = struct.Struct("<8sHHIII")
+ALIGNMENT = 16
+SAMPLE_WIDTH = 2
+
+PCM_EXTENSION = ".pcm"
+PART_EXTENSION = ".part"
+WARM_LOCK_FILENAME = "warm.lock"
+
+# frames decoded at a time when a song is stored
+DECODE_FRAMES = 4096
+
+# songs the decoder reads without decompressing, not worth keeping
+UNCOMPRESSED_TYPES = (".wav",)
+
+
+def is_compressed(song_filename):
+    """Does a song need decoding
+
+    :param song_filename: path and name of the song
+    :type song_filename: str
+
+    :rtype: bool
+    """
+    return os.path.splitext(song_filename)[1].lower() not in UNCOMPRESSED_TYPES
+
+
+def open_song(song_filename):
+    """Open a song with the decoder, as synchronized_lights.py does
+
+    :param song_filename: path and name of the song
+    :type song_filename: str
+
+    :return: the decoder's file
+    :rtype: object
+    """
+    force_header = any(ax in song_filename for ax in [".mp4", ".m4a", ".m4b"])
+
+    return decoder.open(song_filename, force_header)
+
+
+class PcmFile(object):
+    """A decoded song read from a PCM file
+
+    Has the methods of the decoder's files that lightshowpi uses.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: path and name of the PCM file
+        :type filename: str
+
+        :raise IOError: if the file is not a valid PCM file
+        """
+        with open(filename, "rb") as pcm_fp:
+            header = pcm_fp.read(HEADER.size)
+            if len(header) != HEADER.size:
+                raise IOError("PCM file is truncated: " + filename)
+
+            magic, version, self.channels, self.rate, self.frames, self.offset = \
+                HEADER.unpack(header)
+            if magic != MAGIC:
+                raise IOError("Not a PCM file: " + filename)
+            if version > VERSION:
+                raise IOError("Unsupported PCM file version %d: %s" % (version, filename))
+
+            self.frame_size = self.channels * SAMPLE_WIDTH
+            self.end = self.offset + self.frames * self.frame_size
+            if os.path.getsize(filename) < self.end:
+                raise IOError("PCM file is truncated: " + filename)
+
+            self.data = mmap.mmap(pcm_fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.position = self.offset
+
+    def getframerate(self):
+        return self.rate
+
+    def getnchannels(self):
+        return self.channels
+
+    def getnframes(self):
+        return self.frames
+
+    def getsampwidth(self):
+        return SAMPLE_WIDTH
+
+    def readframes(self, nframes):
+        """Read the next frames
+
+        :param nframes: frames to read
+        :type nframes: int
+
+        :return: the frames, b'' at the end of the song
+        :rtype: bytes
+        """
+        start = self.position
+        self.position = min(start + nframes * self.frame_size, self.end)
+
+        return self.data[start:self.position]
+
+    def close(self):
+        self.data.close()
+
+
+def write_pcm(filename, music_file):
+    """Decode a song into a PCM file
+
+    :param filename: path and name of the PCM file
+    :type filename: str
+
+    :param music_file: the decoder's file
+    :type music_file: object
+
+    :return: frames written
+    :rtype: int
+    """
+    channels = music_file.getnchannels()
+    offset = -(-HEADER.size // ALIGNMENT) * ALIGNMENT
+    frames = 0
+
+    with open(filename, "wb") as pcm_fp:
+        pcm_fp.write(b"\0" * offset)
+
+        data = music_file.readframes(DECODE_FRAMES)
+        while data != b'':
+            pcm_fp.write(data)
+            frames += len(data) // (channels * SAMPLE_WIDTH)
+            data = music_file.readframes(DECODE_FRAMES)
+
+        # the decoder's frame count is only an estimate for some formats
+        pcm_fp.seek(0)
+        pcm_fp.write(HEADER.pack(MAGIC, VERSION, channels, music_file.getframerate(),
+                                 frames, offset))
+
+    return frames
+
+
+class PcmCache(sync_cache.SyncCache):
+    """Decoded songs keyed by song contents"""
+
+    EXTENSIONS = (PCM_EXTENSION,)
+
+    def open(self, song_filename):
+        """Open a song's decoded audio, marking it as just used
+
+        :param song_filename: path and name of the song
+        :type song_filename: str
+
+        :return: the decoded song, None if it is not cached
+        :rtype: PcmFile | None
+        """
+        if not is_compressed(song_filename):
+            return None
+
+        filename = self.lookup(self.song_hash(song_filename), PCM_EXTENSION)
+        if filename is None:
+            return None
+
+        try:
+            pcm_file = PcmFile(filename)
+        except (IOError, ValueError) as error:
+            log.warning("Can not read decoded song: " + str(error))
+            return None
+
+        log.info("Decoded song from cache: " + filename)
+        return pcm_file
+
+    def is_cached(self, song_filename):
+        """Is a song's decoded audio cached, marking it as just used
+
+        :param song_filename: path and name of the song
+        :type song_filename: str
+
+        :rtype: bool
+        """
+        return self.lookup(self.song_hash(song_filename), PCM_EXTENSION) is not None
+
+    def decode(self, song_filename):
+        """Decode a song into the cache and evict the least recently used
+
+        :param song_filename: path and name of the song
+        :type song_filename: str
+
+        :return: path and name of the PCM file, None if the song is bigger
+            than the whole cache
+        :rtype: str | None
+        """
+        key = self.song_hash(song_filename)
+        filename = self.filename(key, PCM_EXTENSION)
+
+        music_file = open_song(song_filename)
+        try:
+            size = music_file.getnframes() * music_file.getnchannels() * SAMPLE_WIDTH
+            if size > self.max_size:
+                log.warning("Decoded song is bigger than the cache: " + song_filename)
+                return None
+
+            # written under another name so a song is never played half decoded
+            write_pcm(filename + PART_EXTENSION, music_file)
+        finally:
+            # the warmer decodes song after song
+            close = getattr(music_file, "close", None)
+            if close is not None:
+                close()
+
+        os.replace(filename + PART_EXTENSION, filename)
+        self.add_entry(key, PCM_EXTENSION, song_filename)
+
+        return filename
+
+    def warm(self, songs):
+        """Decode the songs that are not cached yet
+
+        Only one warmer runs at a time, others return at once.
+
+        :param songs: path and name of each song
+        :type songs: list
+
+        :return: False if another warmer is running
+        :rtype: bool
+        """
+        with open(os.path.join(self.directory, WARM_LOCK_FILENAME), "w") as lock_fp:
+            try:
+                fcntl.lockf(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return False
+
+            # left by a warmer that was stopped
+            for part_filename in glob.glob(os.path.join(self.directory, "*" + PART_EXTENSION)):
+                os.remove(part_filename)
+
+            for song_filename in songs:
+                try:
+                    if is_compressed(song_filename) and not self.is_cached(song_filename):
+                        log.info("Decoding ahead: " + song_filename)
+                        self.decode(song_filename)
+                except Exception as error:
+                    log.error("Can not decode %s: %s" % (song_filename, str(error)))
+
+        return True
+
+    def start_warmer(self, songs):
+        """Decode songs in a separate low priority process
+
+        Songs are hashed to find whether they are cached in that process,
+        hashing a whole song here would hold up the show.
+
+        :param songs: path and name of each song
+        :type songs: list
+        """
+        songs = [song for song in songs if is_compressed(song) and os.path.isfile(song)]
+        if songs:
+            sync_cache.start_warmer(os.path.abspath(__file__), self.directory, self.max_size,
+                                    songs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--directory', required=True, help='where the decoded songs are kept')
+    parser.add_argument('--size', required=True, type=int,
+                        help='most bytes the decoded songs may take')
+    parser.add_argument('songs', nargs='+', help='songs to decode')
+    args = parser.parse_args()
+
+    # leave the cpu to the show
+    os.nice(10)
+
+    PcmCache(args.directory, args.size).warm(args.songs)
+
+
+if __name__ == "__main__":
+    main()
@@ -68,8 +68,8 @@ class PrePostShow(object):
 
         Check the state file to see if play now requested
         """
-        # refresh state
-        self.hc.cm.load_state()
+        # refresh state, only reads the state file if it has changed
+        self.hc.cm.refresh_state()
         if int(self.hc.cm.get_state('play_now', "0")):
             # play now requested!
             return True
@@ -114,17 +114,16 @@ class PrePostShow(object):
 
                         for key in channel_control.keys():
                             mode = key
-                            channels = channel_control[key]
-
-                            for channel in channels:
-                                if mode == 'on':
-                                    self.hc.set_light(int(channel) - 1, True, 1)
-                                elif mode == 'off':
-                                    self.hc.set_light(int(channel) - 1, True, 0)
-                                else:
-                                    logging.error("Unrecognized channel_control mode "
-                                                  "defined in preshow_configuration "
-                                                  + str(mode))
+                            pins = [int(channel) - 1 for channel in channel_control[key]]
+
+                            if mode == 'on':
+                                self.hc.set_lights([1.0] * len(pins), True, pins)
+                            elif mode == 'off':
+                                self.hc.set_lights([0.0] * len(pins), True, pins)
+                            else:
+                                logging.error("Unrecognized channel_control mode "
+                                              "defined in preshow_configuration "
+                                              + str(mode))
 
                     # hold transition for specified time
                     while transition['duration'] > (time.time() - start):
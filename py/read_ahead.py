@@ -0,0 +1,139 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.org/
+#
+
+"""Decode a song ahead of playback.
+
+ReadAhead reads chunks from a decoder in its own thread into a ring buffer
+allocated once for the song, so a slow decode or a stalled sd card does
+not hold up the audio output as long as the buffer has not run dry.
+Playback takes the chunks in order with readframes(), as it would from
+the decoder.
+"""
+
+import logging as log
+import threading
+import time
+
+
+class ReadAhead(threading.Thread):
+    """Read a song's chunks ahead into a ring buffer"""
+
+    def __init__(self, music_file, chunk_size, frame_size, capacity):
+        """
+        :param music_file: decoder (or wave) file to read from
+        :type music_file: object
+
+        :param chunk_size: frames in each chunk
+        :type chunk_size: int
+
+        :param frame_size: bytes in each frame, 2 bytes for each audio channel
+        :type frame_size: int
+
+        :param capacity: chunks the buffer holds
+        :type capacity: int
+        """
+        super(ReadAhead, self).__init__(daemon=True)
+        self.music_file = music_file
+        self.chunk_size = chunk_size
+        self.chunk_bytes = chunk_size * frame_size
+        self.capacity = max(capacity, 2)
+
+        self.buffer = bytearray(self.capacity * self.chunk_bytes)
+        self.lengths = [0] * self.capacity
+        self.head = 0
+        self.count = 0
+        self.finished = False
+        self.error = None
+        self.running = True
+        self.condition = threading.Condition()
+
+        # times playback had to wait for the decoder, and the fewest chunks
+        # that were buffered before the end of the song was decoded
+        self.underruns = 0
+        self.wait_time = 0.0
+        self.lowest = None
+
+    def run(self):
+        while self.running:
+            try:
+                data = self.music_file.readframes(self.chunk_size)
+            except Exception as error:
+                log.error("read ahead: " + str(error))
+                data = b''
+                self.error = error
+
+            with self.condition:
+                if not data:
+                    self.finished = True
+                    self.condition.notify_all()
+                    return
+
+                while self.count == self.capacity and self.running:
+                    self.condition.wait()
+
+                if not self.running:
+                    return
+
+                slot = (self.head + self.count) % self.capacity
+                start = slot * self.chunk_bytes
+                self.buffer[start:start + len(data)] = data
+                self.lengths[slot] = len(data)
+                self.count += 1
+                self.condition.notify_all()
+
+    def readframes(self, chunk_size=None):
+        """Take the next chunk
+
+        Waits for the decoder only when the buffer has run dry, which is
+        counted as an underrun unless it is the first chunk of the song.
+
+        :param chunk_size: ignored, chunks are always the chunk_size the
+            buffer was made with
+        :type chunk_size: int
+
+        :return: the chunk, b'' at the end of the song
+        :rtype: bytes
+        :raise Exception: what the decoder raised, once the chunks read before it are taken
+        """
+        with self.condition:
+            if not self.count and not self.finished:
+                start = time.time()
+                while not self.count and not self.finished:
+                    self.condition.wait()
+
+                if self.lowest is not None:
+                    self.underruns += 1
+                    self.wait_time += time.time() - start
+
+            if not self.count:
+                if self.error is not None:
+                    raise self.error
+                return b''
+
+            # the buffer drains at the end of the song, that is not counted
+            if self.lowest is None or (self.count < self.lowest and not self.finished):
+                self.lowest = self.count
+
+            start = self.head * self.chunk_bytes
+            data = bytes(self.buffer[start:start + self.lengths[self.head]])
+            self.head = (self.head + 1) % self.capacity
+            self.count -= 1
+            self.condition.notify_all()
+
+        return data
+
+    def fill_level(self):
+        """How full the buffer is
+
+        :return: chunks buffered and the capacity
+        :rtype: tuple
+        """
+        return self.count, self.capacity
+
+    def stop(self):
+        """Stop reading, for a song that is stopped before its end"""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
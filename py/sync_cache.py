@@ -0,0 +1,558 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.org/
+#
+
+"""A central store of sync files.
+
+Instead of writing each sync file next to its song, sync files can be kept
+in one directory (sync_cache_dir in the [audio_processing] section).  Each
+is named by a hash of the song file's contents and a hash of the fft config
+it was made with, so:
+
+    - music folders can be read only or on the network
+    - a song keeps a sync file for each channel layout it is played with
+    - a song that is moved, renamed or copied keeps its sync file
+
+Spectrum files (see sync_file) are kept the same way, keyed by the song and
+the spectrum config.
+
+An index (index.json) holds the size and last use of every sync file, and
+the hash of every song seen with its size and modification time so songs
+are only hashed again when they change, even after their files are
+evicted.  When the sync files add up to more than sync_cache_size the least
+recently used are removed, and songs that no longer exist are forgotten.
+The index is locked while it is updated, so several processes can share the
+cache.
+
+The songs coming up in the playlist are hashed by a warmer, this module run
+as a separate low priority process, so a song is not hashed when it starts:
+
+    python3 sync_cache.py --directory=/home/pi/sync_cache --size=104857600 song.mp3 ...
+
+SongCache finds the sync and spectrum files of one song, in a SyncCache or
+next to the song.
+"""
+
+import argparse
+import fcntl
+import hashlib
+import json
+import logging as log
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import sync_file
+
+INDEX_FILENAME = "index.json"
+SYNC_EXTENSION = ".sync"
+SPECTRUM_EXTENSION = ".spectrum"
+HASH_BLOCK_SIZE = 1 << 20
+HASH_LOCK_FILENAME = "hash.lock"
+
+
+def start_warmer(script, directory, max_size, songs):
+    """Run a cache's warmer as a separate low priority process
+
+    :param script: path and name of the warmer, sync_cache.py or pcm_cache.py
+    :type script: str
+
+    :param directory: where the cache is kept
+    :type directory: str
+
+    :param max_size: most bytes the cache may take
+    :type max_size: int
+
+    :param songs: path and name of each song
+    :type songs: list
+    """
+    subprocess.Popen([sys.executable,
+                      script,
+                      "--directory=" + directory,
+                      "--size=" + str(max_size)] + songs,
+                     stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+
+
+class SyncCache(object):
+    """Sync files keyed by song contents and fft config"""
+
+    # files kept in the directory, found when the index is rebuilt
+    EXTENSIONS = (SYNC_EXTENSION, SPECTRUM_EXTENSION)
+
+    def __init__(self, directory, max_size):
+        """
+        :param directory: where the sync files are kept
+        :type directory: str
+
+        :param max_size: most bytes the sync files may take
+        :type max_size: int
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.index_filename = os.path.join(directory, INDEX_FILENAME)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, song_filename, config):
+        """Key of the sync file for a song and fft config
+
+        :param song_filename: path and name of the song
+        :type song_filename: str
+
+        :param config: fft settings, see fft.FFT.get_config()
+        :type config: dict
+
+        :return: the key
+        :rtype: str
+        """
+        config_hash = hashlib.sha1(json.dumps(config, sort_keys=True).encode("utf-8"))
+
+        return self.song_hash(song_filename) + "-" + config_hash.hexdigest()[:16]
+
+    def song_hash(self, song_filename):
+        """Hash of a song's contents, hashed again only when the song changes
+
+        :param song_filename: path and name of the song
+        :type song_filename: str
+
+        :return: the hash
+        :rtype: str
+        """
+        song_filename = os.path.abspath(song_filename)
+        song_stat = os.stat(song_filename)
+        signature = [song_stat.st_size, song_stat.st_mtime]
+
+        index = self.read_index()
+        known = index["songs"].get(song_filename)
+        if known and known[:2] == signature:
+            return known[2]
+
+        song_hash = hashlib.sha1()
+        with open(song_filename, "rb") as song_fp:
+            for block in iter(lambda: song_fp.read(HASH_BLOCK_SIZE), b""):
+                song_hash.update(block)
+
+        with self.locked():
+            index = self.read_index()
+            index["songs"][song_filename] = signature + [song_hash.hexdigest()]
+            self.write_index(index)
+
+        return song_hash.hexdigest()
+
+    def filename(self, key, extension=SYNC_EXTENSION):
+        """Path and name of the sync file for key
+
+        :param key: see key()
+        :type key: str
+
+        :param extension: SYNC_EXTENSION or SPECTRUM_EXTENSION
+        :type extension: str
+
+        :return: path and name of the sync file
+        :rtype: str
+        """
+        return os.path.join(self.directory, key + extension)
+
+    def lookup(self, key, extension=SYNC_EXTENSION):
+        """Find a sync file, marking it as just used
+
+        :param key: see key()
+        :type key: str
+
+        :param extension: SYNC_EXTENSION or SPECTRUM_EXTENSION
+        :type extension: str
+
+        :return: path and name of the sync file, None if it is not cached
+        :rtype: str | None
+        """
+        filename = self.filename(key, extension)
+        with self.locked():
+            index = self.read_index()
+            if key not in index["entries"] or not os.path.isfile(filename):
+                return None
+
+            index["entries"][key]["used"] = time.time()
+            self.write_index(index)
+
+        return filename
+
+    def store(self, key, config, mean, std, levels, song_filename=""):
+        """Write a sync file to the cache and evict the least recently used
+
+        :param key: see key()
+        :type key: str
+
+        :param config: fft settings used to compute the levels
+        :type config: dict
+
+        :param mean: mean of each channel
+        :type mean: numpy.array
+
+        :param std: standard deviation of each channel
+        :type std: numpy.array
+
+        :param levels: one row of levels for each chunk of the song
+        :type levels: numpy.array
+
+        :param song_filename: name of the song, kept in the index for reference
+        :type song_filename: str
+
+        :return: path and name of the sync file
+        :rtype: str
+        """
+        filename = self.filename(key)
+        sync_file.write(filename, config, mean, std, levels)
+        self.add_entry(key, SYNC_EXTENSION, song_filename)
+
+        return filename
+
+    def store_spectrum(self, key, config, spectrum, song_filename=""):
+        """Write a spectrum file to the cache and evict the least recently used
+
+        :param key: see key(), made with the spectrum config
+        :type key: str
+
+        :param config: settings the spectrum was computed with
+        :type config: dict
+
+        :param spectrum: one row of fine spectrum for each chunk of the song
+        :type spectrum: numpy.array
+
+        :param song_filename: name of the song, kept in the index for reference
+        :type song_filename: str
+
+        :return: path and name of the spectrum file
+        :rtype: str
+        """
+        filename = self.filename(key, SPECTRUM_EXTENSION)
+        sync_file.write_spectrum(filename, config, spectrum)
+        self.add_entry(key, SPECTRUM_EXTENSION, song_filename)
+
+        return filename
+
+    def add_entry(self, key, extension, song_filename):
+        """Add a file just written to the index
+
+        :param key: see key()
+        :type key: str
+
+        :param extension: SYNC_EXTENSION or SPECTRUM_EXTENSION
+        :type extension: str
+
+        :param song_filename: name of the song
+        :type song_filename: str
+        """
+        with self.locked():
+            index = self.read_index()
+            index["entries"][key] = {"size": os.path.getsize(self.filename(key, extension)),
+                                     "used": time.time(),
+                                     "song": os.path.basename(song_filename),
+                                     "extension": extension}
+            self.evict(index, keep=key)
+            self.write_index(index)
+
+    def evict(self, index, keep=None):
+        """Remove the least recently used sync files until under max_size
+
+        Songs that no longer exist are removed from the index too.
+
+        :param index: the index, updated in place
+        :type index: dict
+
+        :param keep: key never to remove
+        :type keep: str
+        """
+        entries = index["entries"]
+        total = sum(entry["size"] for entry in entries.values())
+
+        for key in sorted(entries, key=lambda entry_key: entries[entry_key]["used"]):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+
+            entry = entries.pop(key)
+            total -= entry["size"]
+            try:
+                os.remove(self.filename(key, entry.get("extension", SYNC_EXTENSION)))
+            except OSError:
+                pass
+
+            log.info("Evicted from cache: " + key + entry.get("extension", SYNC_EXTENSION))
+
+        # forget songs that were deleted or renamed, songs that are only
+        # evicted keep their hash
+        index["songs"] = dict((song, known) for song, known in index["songs"].items()
+                              if os.path.isfile(song))
+
+    def warm(self, songs):
+        """Hash the songs that are not known yet
+
+        Only one warmer runs at a time, others return at once.
+
+        :param songs: path and name of each song
+        :type songs: list
+
+        :return: False if another warmer is running
+        :rtype: bool
+        """
+        with open(os.path.join(self.directory, HASH_LOCK_FILENAME), "w") as lock_fp:
+            try:
+                fcntl.lockf(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return False
+
+            for song_filename in songs:
+                try:
+                    self.song_hash(song_filename)
+                except (IOError, OSError) as error:
+                    log.error("Can not hash %s: %s" % (song_filename, str(error)))
+
+        return True
+
+    def start_warmer(self, songs):
+        """Hash songs in a separate low priority process
+
+        :param songs: path and name of each song
+        :type songs: list
+        """
+        songs = [song for song in songs if os.path.isfile(song)]
+        if songs:
+            start_warmer(os.path.abspath(__file__), self.directory, self.max_size, songs)
+
+    @contextmanager
+    def locked(self):
+        """Hold the index lock, for reading and writing the index"""
+        with open(self.index_filename + ".lock", "w") as lock_fp:
+            fcntl.lockf(lock_fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(lock_fp, fcntl.LOCK_UN)
+
+    def read_index(self):
+        """Read the index, rebuilding it from the sync files if it is missing
+
+        :return: the index
+        :rtype: dict
+        """
+        try:
+            with open(self.index_filename) as index_fp:
+                index = json.load(index_fp)
+            if "entries" in index and "songs" in index:
+                return index
+        except (IOError, OSError, ValueError):
+            pass
+
+        index = {"entries": dict(), "songs": dict()}
+        for name in os.listdir(self.directory):
+            key, extension = os.path.splitext(name)
+            if extension in self.EXTENSIONS:
+                sync_stat = os.stat(os.path.join(self.directory, name))
+                index["entries"][key] = {"size": sync_stat.st_size,
+                                         "used": sync_stat.st_mtime,
+                                         "song": "",
+                                         "extension": extension}
+
+        return index
+
+    def write_index(self, index):
+        """Write the index, through a temporary file so it is never half written
+
+        :param index: the index
+        :type index: dict
+        """
+        temp_filename = self.index_filename + ".tmp"
+        try:
+            with open(temp_filename, "w") as index_fp:
+                json.dump(index, index_fp)
+            os.replace(temp_filename, self.index_filename)
+        except (IOError, OSError) as error:
+            log.error("Can not write sync cache index: " + str(error))
+
+
+class SongCache(object):
+    """The sync file and spectrum file of a song
+
+    Next to the song (.song.mp3.sync and .song.mp3.spectrum), or in store
+    when a central SyncCache is used.
+    """
+
+    def __init__(self, song_filename, fft_calc, store=None):
+        """
+        :param song_filename: path and name of the song
+        :type song_filename: str
+
+        :param fft_calc: fft the song is analyzed with
+        :type fft_calc: fft.FFT
+
+        :param store: central sync cache, None to keep the files next to the song
+        :type store: SyncCache
+        """
+        self.song_filename = os.path.abspath(song_filename)
+        self.fft_calc = fft_calc
+        self.store = store
+
+        if store:
+            self.key = store.key(self.song_filename, fft_calc.get_config())
+            self.filename = store.filename(self.key)
+        else:
+            self.key = None
+            self.filename = os.path.join(os.path.dirname(self.song_filename), "." +
+                                         os.path.basename(self.song_filename) + SYNC_EXTENSION)
+
+    def read(self):
+        """Read the sync file made with the current fft config
+
+        A text sync file from an older version is upgraded to a binary one.
+
+        :return: mean, std and the levels
+        :rtype: tuple
+        :raise IOError: if there is no sync file for the fft config
+        """
+        if self.store and self.store.lookup(self.key) is None:
+            raise IOError("No cached sync file for " + self.song_filename)
+
+        if sync_file.is_sync_file(self.filename):
+            # the fft config the cache was made with is in its header
+            config, mean, std, levels = sync_file.read(self.filename)
+
+            # compare configuration of cache file to current configuration
+            if config != self.fft_calc.get_config():
+                log.warning("Cached config data does not match")
+                raise IOError("Sync file config does not match: " + self.filename)
+
+            return mean, std, levels
+
+        # text sync file from an older version, the fft config is in the .cfg
+        # file next to it
+        if not self.fft_calc.compare_config(self.filename):
+            raise IOError("Sync file config does not match: " + self.filename)
+
+        mean, std, levels = sync_file.read_text(self.filename)
+
+        # upgrade it so it can be memory mapped next time, the music folder
+        # may be read only, the text file still works then
+        try:
+            sync_file.write(self.filename, self.fft_calc.get_config(), mean, std, levels)
+            log.info("Upgraded sync file to binary format: " + self.filename)
+        except OSError as error:
+            log.warning("Can not upgrade sync file to binary format: " + str(error))
+
+        return mean, std, levels
+
+    def is_current(self):
+        """Is there a sync file made with the current fft config
+
+        :rtype: bool
+        """
+        try:
+            self.read()
+        except IOError:
+            return False
+
+        return True
+
+    def write(self, mean, std, levels):
+        """Write the sync file
+
+        :param mean: mean of each channel
+        :type mean: numpy.array
+
+        :param std: standard deviation of each channel
+        :type std: numpy.array
+
+        :param levels: one row of levels for each chunk of the song
+        :type levels: numpy.array
+        """
+        config = self.fft_calc.get_config()
+        if self.store:
+            # the fft config is in the sync file header
+            self.store.store(self.key, config, mean, std, levels, self.song_filename)
+            return
+
+        # Save the cache with the fft config used to create it
+        sync_file.write(self.filename, config, mean, std, levels)
+
+        # Save fft config, keeping any custom settings
+        self.fft_calc.save_config(self.filename)
+
+    def spectrum_filename(self):
+        """Path and name of the spectrum file next to the song
+
+        :rtype: str
+        """
+        return self.filename[:-len(SYNC_EXTENSION)] + SPECTRUM_EXTENSION
+
+    def levels_from_spectrum(self, num_channels=2):
+        """Levels for the current fft config from the song's spectrum file
+
+        :param num_channels: number of channels in the song
+        :type num_channels: int
+
+        :return: one row of levels for each chunk of the song, None if the
+            song has no spectrum file for the fft's spectrum config
+        :rtype: numpy.array | None
+        """
+        config = self.fft_calc.get_spectrum_config(num_channels)
+        if self.store:
+            filename = self.store.lookup(self.store.key(self.song_filename, config),
+                                         SPECTRUM_EXTENSION)
+        else:
+            filename = self.spectrum_filename()
+
+        if not filename:
+            return None
+
+        try:
+            spectrum_config, spectrum = sync_file.read_spectrum(filename)
+        except IOError:
+            return None
+
+        if spectrum_config != config:
+            log.warning("Spectrum config data does not match: " + filename)
+            return None
+
+        log.info("Sync data made from spectrum file: " + filename)
+        return self.fft_calc.levels_from_spectrum(spectrum, num_channels)
+
+    def write_spectrum(self, spectrum, num_channels=2):
+        """Write the song's spectrum file
+
+        :param spectrum: see fft.FFT.calculate_spectrum
+        :type spectrum: numpy.array
+
+        :param num_channels: number of channels in the song
+        :type num_channels: int
+        """
+        config = self.fft_calc.get_spectrum_config(num_channels)
+        if self.store:
+            self.store.store_spectrum(self.store.key(self.song_filename, config),
+                                      config, spectrum, self.song_filename)
+        else:
+            sync_file.write_spectrum(self.spectrum_filename(), config, spectrum)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--directory', required=True, help='where the sync files are kept')
+    parser.add_argument('--size', required=True, type=int,
+                        help='most bytes the sync files may take')
+    parser.add_argument('songs', nargs='+', help='songs to hash')
+    args = parser.parse_args()
+
+    # leave the cpu to the show
+    os.nice(10)
+
+    SyncCache(args.directory, args.size).warm(args.songs)
+
+
+if __name__ == "__main__":
+    main()
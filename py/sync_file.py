@@ -0,0 +1,305 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.org/
+#
+
+"""Read and write lightshowpi sync files.
+
+A sync file holds the fft levels computed for every chunk of a song, so
+the song can be played back without running the fft again.  Sync files
+are binary, starting with a small header that holds the fft settings used
+to compute the levels and the mean and standard deviation of each channel,
+followed by a float32 matrix with one row per chunk.  The matrix is memory
+mapped when read, so opening a sync file costs the same for any length of
+song.
+
+Layout (little endian):
+
+    magic          8 bytes    b"LSPISYNC"
+    version        uint16
+    reserved       uint16
+    data offset    uint32     start of the levels, 16 byte aligned
+    rows           uint32
+    columns        uint32
+    config size    uint32     length of the fft config that follows
+    fft config     json       see fft.FFT.get_config()
+    mean           float32 * columns
+    std            float32 * columns
+    padding        up to data offset
+    levels         float32 * rows * columns
+
+A spectrum file keeps the fine spectrum of a song (see
+fft.FFT.calculate_spectrum) so sync files for new channel layouts can be
+made without decoding the song again.  It has the same layout with magic
+b"LSPISPEC", no mean and std, and float16 levels.
+
+Sync files written by older versions are plain text (numpy.savetxt), with
+std and mean as the first two rows and the fft config in a separate .cfg
+file.  is_sync_file() tells them apart.
+"""
+
+import json
+import os
+import struct
+import warnings
+
+import numpy as np
+
+MAGIC = b"LSPISYNC"
+VERSION = 1
+HEADER = struct.Struct("<8sHHIIII")
+ALIGNMENT = 16
+DTYPE = np.dtype("<f4")
+
+SPECTRUM_MAGIC = b"LSPISPEC"
+SPECTRUM_DTYPE = np.dtype("<f2")
+
+# added to the name of a file while it is written
+TEMP_EXTENSION = ".tmp"
+
+# percentiles of a normal distribution one standard deviation either side of
+# its median, for the percentile stats
+LOW_PERCENTILE = 15.87
+HIGH_PERCENTILE = 84.13
+
+
+def is_sync_file(filename):
+    """Is filename a binary sync file
+
+    :param filename: path and name of the sync file
+    :type filename: str
+
+    :return: True if the file starts with the sync file magic
+    :rtype: bool
+    """
+    try:
+        with open(filename, "rb") as sync_fp:
+            return sync_fp.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+def read(filename):
+    """Read a binary sync file
+
+    :param filename: path and name of the sync file
+    :type filename: str
+
+    :return: fft config, mean, std and the levels memory mapped read only
+    :rtype: tuple
+    :raise IOError: if the file is not a valid sync file
+    """
+    config, stats, levels = read_matrix(filename, MAGIC, DTYPE, 2)
+    columns = levels.shape[1]
+
+    return config, stats[:columns], stats[columns:], levels
+
+
+def read_spectrum(filename):
+    """Read a spectrum file
+
+    :param filename: path and name of the spectrum file
+    :type filename: str
+
+    :return: spectrum config and the spectrum memory mapped read only
+    :rtype: tuple
+    :raise IOError: if the file is not a valid spectrum file
+    """
+    config, _, spectrum = read_matrix(filename, SPECTRUM_MAGIC, SPECTRUM_DTYPE, 0)
+
+    return config, spectrum
+
+
+def read_matrix(filename, magic_expected, dtype, stats_per_column):
+    """Read a sync or spectrum file
+
+    :param filename: path and name of the file
+    :type filename: str
+
+    :param magic_expected: MAGIC or SPECTRUM_MAGIC
+    :type magic_expected: bytes
+
+    :param dtype: type of the matrix
+    :type dtype: numpy.dtype
+
+    :param stats_per_column: stats stored for each column before the matrix
+    :type stats_per_column: int
+
+    :return: config, stats and the matrix memory mapped read only
+    :rtype: tuple
+    :raise IOError: if the file is not valid
+    """
+    with open(filename, "rb") as sync_fp:
+        header = sync_fp.read(HEADER.size)
+        if len(header) != HEADER.size:
+            raise IOError("Sync file is truncated: " + filename)
+
+        magic, version, _, offset, rows, columns, config_size = HEADER.unpack(header)
+        if magic != magic_expected:
+            raise IOError("Not a sync file: " + filename)
+        if version > VERSION:
+            raise IOError("Unsupported sync file version %d: %s" % (version, filename))
+
+        try:
+            config = json.loads(sync_fp.read(config_size).decode("utf-8"))
+        except ValueError:
+            raise IOError("Sync file config is corrupt: " + filename)
+
+        stats = np.fromfile(sync_fp, dtype=DTYPE, count=stats_per_column * columns)
+        if len(stats) != stats_per_column * columns:
+            raise IOError("Sync file is truncated: " + filename)
+
+    if os.path.getsize(filename) < offset + rows * columns * dtype.itemsize:
+        raise IOError("Sync file is truncated: " + filename)
+
+    if rows:
+        matrix = np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=(rows, columns))
+    else:
+        matrix = np.empty((0, columns), dtype=dtype)
+
+    return config, stats, matrix
+
+
+def stats(levels, mode="mean"):
+    """Mean and standard deviation of each channel, over the chunks it is on
+
+    Only levels above 0 are counted, a channel that is never on has a mean
+    and standard deviation of nan.
+
+    With mode "percentile" the median and half the spread between the 15.87th
+    and 84.13th percentiles are used instead, which match the mean and
+    standard deviation for normally distributed levels but are not thrown
+    off by a few very loud or very quiet chunks.
+
+    :param levels: one row of levels for each chunk of the song
+    :type levels: numpy.array
+
+    :param mode: "mean" or "percentile"
+    :type mode: str
+
+    :return: mean and std of each channel
+    :rtype: tuple of numpy.array
+    """
+    levels = np.asarray(levels, dtype=np.float64)
+    is_on = levels > 0
+
+    if mode == "percentile":
+        # a channel that is never on is all nan
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            low, median, high = np.nanpercentile(np.where(is_on, levels, np.nan),
+                                                 [LOW_PERCENTILE, 50.0, HIGH_PERCENTILE],
+                                                 axis=0)
+        return median, (high - low) / 2
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        count = is_on.sum(axis=0)
+        mean = np.where(is_on, levels, 0.0).sum(axis=0) / count
+        std = np.sqrt(np.where(is_on, (levels - mean) ** 2, 0.0).sum(axis=0) / count)
+
+    return mean, std
+
+
+def write(filename, config, mean, std, levels):
+    """Write a binary sync file
+
+    The file is written next to filename and then moved into place, so a
+    sync file that is memory mapped by a running show is never modified.
+
+    :param filename: path and name of the sync file
+    :type filename: str
+
+    :param config: fft settings used to compute the levels
+    :type config: dict
+
+    :param mean: mean of each channel
+    :type mean: numpy.array
+
+    :param std: standard deviation of each channel
+    :type std: numpy.array
+
+    :param levels: one row of levels for each chunk of the song
+    :type levels: numpy.array
+    """
+    stats = np.concatenate([np.asarray(mean, dtype=DTYPE).ravel(),
+                            np.asarray(std, dtype=DTYPE).ravel()])
+    levels = np.asarray(levels, dtype=DTYPE).reshape(-1, len(stats) // 2)
+
+    write_matrix(filename, MAGIC, config, stats, levels)
+
+
+def write_spectrum(filename, config, spectrum):
+    """Write a spectrum file
+
+    :param filename: path and name of the spectrum file
+    :type filename: str
+
+    :param config: settings the spectrum was computed with
+    :type config: dict
+
+    :param spectrum: one row of fine spectrum for each chunk of the song
+    :type spectrum: numpy.array
+    """
+    write_matrix(filename, SPECTRUM_MAGIC, config, np.empty(0, dtype=DTYPE),
+                 np.asarray(spectrum, dtype=SPECTRUM_DTYPE))
+
+
+def write_matrix(filename, magic, config, stats, matrix):
+    """Write a sync or spectrum file
+
+    The file is written next to filename and then moved into place, so a
+    file that is memory mapped by a running show is never modified.
+
+    :param filename: path and name of the file
+    :type filename: str
+
+    :param magic: MAGIC or SPECTRUM_MAGIC
+    :type magic: bytes
+
+    :param config: settings the matrix was computed with
+    :type config: dict
+
+    :param stats: float32 stats stored before the matrix
+    :type stats: numpy.array
+
+    :param matrix: the levels or spectrum
+    :type matrix: numpy.array
+    """
+    rows, columns = matrix.shape
+
+    config_data = json.dumps(config, sort_keys=True).encode("utf-8")
+
+    offset = HEADER.size + len(config_data) + stats.nbytes
+    offset += -offset % ALIGNMENT
+
+    temp_filename = filename + TEMP_EXTENSION
+    with open(temp_filename, "wb") as sync_fp:
+        sync_fp.write(HEADER.pack(magic, VERSION, 0, offset, rows, columns, len(config_data)))
+        sync_fp.write(config_data)
+        sync_fp.write(stats.tobytes())
+        sync_fp.write(b"\0" * (offset - sync_fp.tell()))
+        sync_fp.write(np.ascontiguousarray(matrix).tobytes())
+
+    os.replace(temp_filename, filename)
+
+
+def read_text(filename):
+    """Read a text sync file written by an older version
+
+    :param filename: path and name of the sync file
+    :type filename: str
+
+    :return: mean, std and the levels
+    :rtype: tuple
+    :raise IOError: if the file can not be read
+    """
+    try:
+        cache_matrix = np.loadtxt(filename, ndmin=2)
+    except ValueError:
+        raise IOError("Text sync file is corrupt: " + filename)
+
+    if len(cache_matrix) < 2:
+        raise IOError("Text sync file is truncated: " + filename)
+
+    # std is located at index 0 and mean at index 1
+    return cache_matrix[1], cache_matrix[0], cache_matrix[2:]
@@ -31,7 +31,7 @@ FFT calculation can be CPU intensive and in some cases can adversely
 affect playback of songs (especially if attempting to decode the song
 as well, as is the case for an mp3).  For this reason, the FFT 
 calculations are cached after the first time a new song is played.
-The values are cached in a gzipped text file in the same location as the
+The values are cached in a binary sync file in the same location as the
 song itself.  Subsequent requests to play the same song will use the
 cached information and not recompute the FFT, thus reducing CPU
 utilization dramatically and allowing for clear music playback of all
@@ -88,9 +88,15 @@ import numpy as np
 from numpy import where, clip, round, nan_to_num
 
 import Platform
+import configuration_manager
 import fft
+import network_client
+import pcm_cache
 from prepostshow import PrePostShow
+import read_ahead
 import RunningStats
+import sync_cache
+import sync_file
 
 
 # Make sure SYNCHRONIZED_LIGHTS_HOME environment variable is set
@@ -121,6 +127,10 @@ file_group.add_argument('--playlist', default=None,
 file_group.add_argument('--file', help='path to the song to play (required if no '
                                        'playlist is designated)')
 
+parser.add_argument('--loop', action="store_true",
+                    help='play songs one after another in this process, keeping the hardware, '
+                         'audio output and fft set up from song to song')
+
 cache_group = parser.add_mutually_exclusive_group()
 cache_group.add_argument('--readcache', type=bool, default=True,
                          help='read light timing from cache if available. Default: true')
@@ -148,6 +158,37 @@ cm = hc.cm
 if not args.playlist:
     args.playlist=cm.lightshow.playlist_path
 
+def close_music_file(music_file):
+    """Close a song, the decoder's process and pipe or a decoded song's map
+
+    :param music_file: the song, see Lightshow.open_song
+    :type music_file: object
+    """
+    close = getattr(music_file, "close", None)
+    if close is not None:
+        close()
+
+
+class PreparedSong(object):
+    """The next song, made ready to play while the one before it plays (--loop)"""
+
+    def __init__(self, song_filename):
+        self.song_filename = song_filename
+        self.music_file = None
+        self.read_ahead = None
+        self.fft_args = None
+        self.song_cache = None
+        self.sync_data = None
+
+    def discard(self):
+        """Stop reading ahead, for a song that is not played next after all"""
+        if self.read_ahead is not None:
+            self.read_ahead.stop()
+            self.read_ahead.join()
+
+        close_music_file(self.music_file)
+
+
 class Lightshow(object):
     def __init__(self):
         self.stream = None
@@ -156,17 +197,35 @@ class Lightshow(object):
         self.sample_rate = None
         self.num_channels = None
         self.music_file = None
+        self.read_ahead = None
         self.fft_calc = None
+        self.fft_args = None
+        self.output_device = None
+        self.audio_format = None
+        self.fm_updating = False
+        self.hardware_ready = False
+        self.random_song = None
+        self.prepared = None
+        self.preparing = None
         self.light_delay = None
         self.cache_found = None
         self.cache_matrix = None
+        self.cache_rows = 0
         self.cache_filename = None
+        self.song_cache = None
+        self.sync_cache = None
+        self.pcm_cache = None
         self.config_filename = None
         self.song_filename = None
+        self.upcoming = list()
         self.terminal = None
 
         self.output = lambda raw_data: None
 
+        # the settings a song's .cfg file can change, put back before each song
+        self.defaults = dict((name, dict(vars(getattr(cm, name))))
+                             for name in ("lightshow", "audio_processing", "fm"))
+
         self.mean = np.array([12.0 for _ in range(cm.hardware.gpio_len)], dtype='float32')
         self.std = np.array([1.5 for _ in range(cm.hardware.gpio_len)], dtype='float32')
 
@@ -188,6 +247,14 @@ class Lightshow(object):
 
         self.chunk_size = cm.audio_processing.chunk_size  # Use a multiple of 8 
 
+        if cm.audio_processing.sync_cache_dir:
+            self.sync_cache = sync_cache.SyncCache(cm.audio_processing.sync_cache_dir,
+                                                   cm.audio_processing.sync_cache_size)
+
+        if cm.audio_processing.pcm_cache_dir:
+            self.pcm_cache = pcm_cache.PcmCache(cm.audio_processing.pcm_cache_dir,
+                                                cm.audio_processing.pcm_cache_size)
+
         atexit.register(self.exit_function)
 
         # Remove traceback on Ctrl-C
@@ -202,7 +269,7 @@ class Lightshow(object):
         """atexit function"""
         if self.server:
             self.network.set_playing()
-            self.network.broadcast([0. for _ in range(cm.hardware.gpio_len)])
+            self.network.broadcast([0. for _ in range(cm.hardware.gpio_len)], True)
             time.sleep(1)
             self.network.unset_playing()
 
@@ -270,8 +337,7 @@ class Lightshow(object):
         if not hasattr(brightness, "__len__"):
             brightness = np.array([brightness])
 
-        for pin in range(len(brightness[:self.physical_gpio_len])):
-            hc.set_light(pin, True, brightness[pin])
+        hc.set_lights(brightness[:self.physical_gpio_len])
 
         if hc.led:
             if cm.led.led_channel_configuration == "EXTEND":
@@ -337,6 +403,12 @@ class Lightshow(object):
                                                stdout=dev_null)
         self.output = lambda raw_data: self.fm_process.stdin.write(raw_data)
 
+        # the threads keep writing to the fifo, the fm process of a later
+        # song (--loop) reads the same fifo
+        if self.fm_updating:
+            return
+        self.fm_updating = True
+
         fmoutthrps = Thread(target=self.update_fmoutps, args=(cm, cm.fm.program_service_name))
         fmoutthrps.daemon = True
         fmoutthrps.start()
@@ -364,6 +436,14 @@ class Lightshow(object):
 
     def set_audio_device(self):
 
+        # in --loop mode the output is kept from song to song while the songs
+        # have the same sample rate and channels
+        audio_format = (self.sample_rate, self.num_channels)
+        if audio_format == self.audio_format:
+            return
+        self.close_audio_device()
+        self.audio_format = audio_format
+
         if cm.fm.enabled:
             self.set_fm()
 
@@ -377,8 +457,18 @@ class Lightshow(object):
             output_device.setformat(aa.PCM_FORMAT_S16_LE)
             output_device.setperiodsize(self.chunk_size)
 
+            self.output_device = output_device
             self.output = lambda raw_data: output_device.write(raw_data)
 
+    def close_audio_device(self):
+        """Close the output of the last song, for a song in another format"""
+        if self.fm_process is not None:
+            self.fm_process.kill()
+
+        if self.output_device is not None:
+            self.output_device.close()
+            self.output_device = None
+
     def set_audio_source(self):
         stream_reader = None
         outq = None
@@ -634,51 +724,61 @@ class Lightshow(object):
 
                         cm.lightshow.postshow = postshow
 
-                if config.has_section('custom_audio_processing'):
-                    if config.has_option('custom_audio_processing', 'min_frequency'):
-                        cm.audio_processing.min_frequency = \
-                            config.getfloat('custom_audio_processing', 'min_frequency')
+        # the fft settings, read on their own so they can be read for the
+        # next song while one plays
+        for option, value in self.custom_audio_processing(self.config_filename).items():
+            setattr(cm.audio_processing, option, value)
 
-                    if config.has_option('custom_audio_processing', 'max_frequency'):
-                        cm.audio_processing.max_frequency = \
-                            config.getfloat('custom_audio_processing', 'max_frequency')
+    def restore_config(self):
+        """Put back the settings the last song's .cfg file changed (--loop)"""
+        for name, values in self.defaults.items():
+            section = vars(getattr(cm, name))
+            section.clear()
+            section.update(values)
 
-                    if config.has_option('custom_audio_processing', 'custom_channel_mapping'):
-                        temp = config.get('custom_audio_processing', 'custom_channel_mapping')
-                        cm.audio_processing.custom_channel_mapping = \
-                            map(int, temp.split(',')) if temp else 0
+        self.attenuate_pct = cm.lightshow.attenuate_pct
+
+    def custom_audio_processing(self, config_filename):
+        """The fft settings for a song, with the [custom_audio_processing] overrides
+
+        The configuration is not changed.
 
-                    if config.has_option('custom_audio_processing', 'custom_channel_frequencies'):
-                        temp = config.get('custom_audio_processing', 'custom_channel_frequencies')
-                        cm.audio_processing.custom_channel_frequencies = \
-                            map(int, temp.split(',')) if temp else 0
+        :param config_filename: path and name of the song's .cfg file
+        :type config_filename: str
+
+        :return: min_frequency, max_frequency, custom_channel_mapping and
+            custom_channel_frequencies
+        :rtype: dict
+        """
+        return configuration_manager.custom_audio_processing(config_filename,
+                                                             self.defaults["audio_processing"])
 
-    def setup_audio(self):
+    def setup_audio(self, prepared=None):
         """Setup audio file
 
         and setup the output.  device.output is a lambda that will send data to
         fm process or to the specified ALSA sound card
+
+        :param prepared: the song opened while the last one played (--loop)
+        :type prepared: PreparedSong
         """
         # Set up audio
-        force_header = False
-
-        if any([ax for ax in [".mp4", ".m4a", ".m4b"] if ax in self.song_filename]):
-            force_header = True
-
-        self.music_file = decoder.open(self.song_filename, force_header)
+        if prepared is not None:
+            self.music_file = prepared.music_file
+            self.read_ahead = prepared.read_ahead
+        else:
+            self.music_file = self.open_song(self.song_filename)
 
         self.sample_rate = self.music_file.getframerate()
         self.num_channels = self.music_file.getnchannels()
 
-        self.fft_calc = fft.FFT(self.chunk_size,
-                                self.sample_rate,
-                                cm.hardware.gpio_len,
-                                cm.audio_processing.min_frequency,
-                                cm.audio_processing.max_frequency,
-                                cm.audio_processing.custom_channel_mapping,
-                                cm.audio_processing.custom_channel_frequencies,
-                                2,
-                                cm.audio_processing.use_gpu)
+        # the last song's fft is used again when the settings are the same
+        settings = dict((option, getattr(cm.audio_processing, option))
+                        for option in configuration_manager.FFT_OPTIONS)
+        fft_args = self.get_fft_args(self.sample_rate, settings)
+        if fft_args != self.fft_args:
+            self.fft_calc = fft.FFT(*fft_args)
+            self.fft_args = fft_args
 
         # setup output device
         self.set_audio_device()
@@ -690,76 +790,258 @@ class Lightshow(object):
         num_frames = str(self.music_file.getnframes() / self.sample_rate)
         log.info("Playing: " + self.song_filename + " (" + num_frames + " sec)")
 
-    def setup_cache(self):
+    def open_song(self, song_filename):
+        """Open a song to play
+
+        :param song_filename: path and name of the song
+        :type song_filename: str
+
+        :return: the decoder's file, or the decoded song from the pcm cache
+        :rtype: object
+        """
+        force_header = False
+
+        if any([ax for ax in [".mp4", ".m4a", ".m4b"] if ax in song_filename]):
+            force_header = True
+
+        # a compressed song that was decoded before is read from the pcm cache
+        music_file = None
+        if self.pcm_cache:
+            music_file = self.pcm_cache.open(song_filename)
+
+        if music_file is None:
+            music_file = decoder.open(song_filename, force_header)
+
+        return music_file
+
+    def get_fft_args(self, sample_rate, settings):
+        """The arguments to make the fft for a song with
+
+        :param sample_rate: the song's sample rate
+        :type sample_rate: int
+
+        :param settings: see custom_audio_processing()
+        :type settings: dict
+
+        :return: arguments for fft.FFT
+        :rtype: tuple
+        """
+        return (self.chunk_size,
+                sample_rate,
+                cm.hardware.gpio_len,
+                settings["min_frequency"],
+                settings["max_frequency"],
+                settings["custom_channel_mapping"],
+                settings["custom_channel_frequencies"],
+                2,
+                cm.audio_processing.use_gpu)
+
+    def setup_cache(self, prepared=None):
         """Setup the cache_matrix, std and mean
 
         loading them from a file if it exists, otherwise create empty arrays to be filled
+
+        :param prepared: the song whose sync data was read while the last one played (--loop)
+        :type prepared: PreparedSong
         :raise IOError:
         """
-        # create empty array for the cache_matrix
-        self.cache_matrix = np.empty(shape=[0, cm.hardware.gpio_len])
+        # allocate the cache_matrix for every chunk of the song, it is filled
+        # in place as the fft is computed
+        rows = self.music_file.getnframes() // self.chunk_size + 1
+        self.cache_matrix = np.empty(shape=[rows, cm.hardware.gpio_len])
+        self.cache_rows = 0
         self.cache_found = False
 
+        # the sync file is next to the song, or found by the song's contents
+        # and the fft config in the central cache
+        sync_data = None
+        if prepared is not None and prepared.fft_args == self.fft_args:
+            self.song_cache = prepared.song_cache
+            self.song_cache.fft_calc = self.fft_calc
+            sync_data = prepared.sync_data
+        else:
+            self.song_cache = sync_cache.SongCache(self.song_filename,
+                                                   self.fft_calc,
+                                                   self.sync_cache)
+        self.cache_filename = self.song_cache.filename
+
         # The values 12 and 1.5 are good estimates for first time playing back
         # (i.e. before we have the actual mean and standard deviations
         # calculated for each channel).
-
-        self.cache_found = self.fft_calc.compare_config(self.cache_filename)
+        self.mean = np.array([12.0 for _ in range(cm.hardware.gpio_len)], dtype='float32')
+        self.std = np.array([1.5 for _ in range(cm.hardware.gpio_len)], dtype='float32')
 
         if args.readcache:
             # Read in cached fft
             try:
-                # compare configuration of cache file to current configuration
-                self.cache_found = self.fft_calc.compare_config(self.cache_filename)
-                if not self.cache_found:
-                    # create empty array for the cache_matrix
-                    self.cache_matrix = np.empty(shape=[0, cm.hardware.gpio_len])
-                    raise IOError()
+                if sync_data is not None:
+                    mean, std, matrix = sync_data
                 else:
-                    # load cache from file using numpy loadtxt
-                    self.cache_matrix = np.loadtxt(self.cache_filename)
-
-                # get std from matrix / located at index 0
-                self.std = np.array(self.cache_matrix[0])
-
-                # get mean from matrix / located at index 1
-                self.mean = np.array(self.cache_matrix[1])
+                    mean, std, matrix = self.song_cache.read()
 
-                # delete mean and std from the array
-                self.cache_matrix = np.delete(self.cache_matrix, 0, axis=0)
-                self.cache_matrix = np.delete(self.cache_matrix, 0, axis=0)
+                self.cache_matrix = matrix
+                self.std = np.array(std)
+                self.mean = np.array(mean)
+                self.cache_found = True
 
                 log.debug("std: " + str(self.std) + ", mean: " + str(self.mean))
             except IOError:
-                self.cache_found = self.fft_calc.compare_config(self.cache_filename)
+                self.cache_found = False
+
+            if not self.cache_found and not self.load_spectrum():
                 msg = "Cached sync data song_filename not found: '"
                 log.warning(msg + self.cache_filename + "'.  One will be generated.")
 
+    def load_spectrum(self):
+        """Make the cache_matrix from the song's spectrum file, if it has one
+
+        For a channel layout the song has no sync file for, without running
+        the fft.  The sync file is saved for next time.
+
+        :return: True if the cache_matrix was made
+        :rtype: bool
+        """
+        matrix = self.song_cache.levels_from_spectrum(self.num_channels)
+        if matrix is None:
+            return False
+
+        self.cache_matrix = matrix
+        self.cache_rows = len(self.cache_matrix)
+        self.mean, self.std = sync_file.stats(self.cache_matrix, cm.audio_processing.sync_stats)
+        self.save_cache()
+        self.cache_found = True
+
+        return True
+
+    def add_to_cache(self, row, matrix):
+        """Store the fft of a chunk in the cache_matrix
+
+        The cache_matrix is grown, doubling it, when the song has more chunks
+        than it was allocated for, or when a cache read from a sync file runs
+        out and the rest of the song is computed.
+
+        :param row: chunk number
+        :type row: int
+
+        :param matrix: fft of the chunk
+        :type matrix: numpy.array
+        """
+        if row >= len(self.cache_matrix):
+            cache_matrix = np.empty(shape=[max(2 * len(self.cache_matrix), row + 1),
+                                           cm.hardware.gpio_len])
+            cache_matrix[:row] = self.cache_matrix[:row]
+            self.cache_matrix = cache_matrix
+
+        self.cache_matrix[row] = matrix
+        self.cache_rows = row + 1
+
     def save_cache(self):
         """
         Save matrix, std, and mean to cache_filename for use during future playback
         """
+        self.cache_matrix = self.cache_matrix[:self.cache_rows]
+
         # Compute the standard deviation and mean values for the cache
-        mean = np.empty(cm.hardware.gpio_len, dtype='float32')
-        std = np.empty(cm.hardware.gpio_len, dtype='float32')
+        mean, std = sync_file.stats(self.cache_matrix, cm.audio_processing.sync_stats)
 
-        for pin in range(0, cm.hardware.gpio_len):
-            std[pin] = np.std([item for item in self.cache_matrix[:, pin] if item > 0])
-            mean[pin] = np.mean([item for item in self.cache_matrix[:, pin] if item > 0])
+        self.song_cache.write(mean, std, self.cache_matrix)
 
-        # Add mean and std to the top of the cache
-        self.cache_matrix = np.vstack([mean, self.cache_matrix])
-        self.cache_matrix = np.vstack([std, self.cache_matrix])
+        cm_len = str(len(self.cache_matrix))
+        log.info("Cached sync data written to '" + self.cache_filename + "' [" + cm_len + " rows]")
 
-        # Save the cache using numpy savetxt
-        np.savetxt(self.cache_filename, self.cache_matrix)
+    @staticmethod
+    def most_voted(songs):
+        """The song with the most votes
 
-        # Save fft config
-        self.fft_calc.save_config()
+        :param songs: the playlist
+        :type songs: list
 
-        cm_len = str(len(self.cache_matrix))
-        log.info("Cached sync data written to '." + self.cache_filename + "' [" + cm_len + " rows]")
-        log.info("Cached config data written to '." + self.fft_calc.config_filename)
+        :return: the playlist entry, None if no song has votes
+        :rtype: list | None
+        """
+        most_votes = [None, None, []]
+        for song in songs:
+            if len(song[2]) > 0:
+                if len(song[2]) >= len(most_votes[2]):
+                    most_votes = song
+
+        if most_votes[0] is None:
+            return None
+
+        return most_votes
+
+    def choose_song(self, songs, play_now, song_to_play):
+        """Choose the song to play from the playlist
+
+        A random song is chosen once, get_song plays the song peek_song saw.
+
+        :param songs: the playlist
+        :type songs: list
+
+        :param play_now: number of the song requested to play now, 0 for none
+        :type play_now: int
+
+        :param song_to_play: index of the next song in the lineup
+        :type song_to_play: int
+
+        :return: the playlist entry, and the index of the song after it in
+            the lineup (None unless the song is the next in the lineup)
+        :rtype: tuple
+        """
+        most_votes = self.most_voted(songs)
+        if most_votes is not None:
+            return most_votes, None
+
+        # Get a "play now" requested song
+        if 0 < play_now <= len(songs):
+            return songs[play_now - 1], None
+
+        # Get random song
+        if cm.lightshow.randomize_playlist:
+            if self.random_song is None or self.random_song >= len(songs):
+                self.random_song = random.randrange(0, len(songs))
+            return songs[self.random_song], None
+
+        # Play next song in the lineup
+        if not (song_to_play <= len(songs) - 1):
+            song_to_play = 0
+
+        if (song_to_play + 1) <= len(songs) - 1:
+            next_song = (song_to_play + 1)
+        else:
+            next_song = 0
+
+        return songs[song_to_play], next_song
+
+    def peek_song(self):
+        """The song get_song will choose next, unless votes or requests come in first
+
+        :return: path and name of the song
+        :rtype: str
+        """
+        song_filename = args.file
+
+        if args.playlist is not None and args.file is None:
+            songs = cm.get_playlist(args.playlist)
+            current_song, _ = self.choose_song(songs,
+                                               int(cm.get_state('play_now', "0")),
+                                               int(cm.get_state('song_to_play', "0")))
+            song_filename = current_song[1]
+
+        return song_filename.replace("$SYNCHRONIZED_LIGHTS_HOME", cm.home_dir)
+
+    @staticmethod
+    def song_config_filename(song_filename):
+        """Path and name of a song's .cfg file
+
+        :param song_filename: path and name of the song
+        :type song_filename: str
+
+        :rtype: str
+        """
+        filename = os.path.abspath(song_filename)
+
+        return os.path.dirname(filename) + "/." + os.path.basename(song_filename) + ".cfg"
 
     def get_song(self):
         """
@@ -773,16 +1055,13 @@ class Lightshow(object):
         self.song_filename = args.file
 
         if args.playlist is not None and args.file is None:
-            most_votes = [None, None, []]
             songs = cm.get_playlist(args.playlist)
-            for song in songs:
-                if len(song[2]) > 0:
-                    if len(song[2]) >= len(most_votes[2]):
-                        most_votes = song
+            current_song, next_song = self.choose_song(songs, play_now, song_to_play)
+            self.random_song = None
+            self.upcoming = list()
 
-            if most_votes[0] is not None:
-                log.info("Most Votes: " + str(most_votes))
-                current_song = most_votes
+            if self.most_voted(songs) is not None:
+                log.info("Most Votes: " + str(current_song))
 
                 # Update playlist with latest votes
                 for song in songs:
@@ -792,26 +1071,8 @@ class Lightshow(object):
                 # Update playlist file
                 cm.write_playlist(songs, args.playlist)
 
-            else:
-                # Get a "play now" requested song
-                if 0 < play_now <= len(songs):
-                    current_song = songs[play_now - 1]
-                # Get random song
-                elif cm.lightshow.randomize_playlist:
-                    current_song = songs[random.randrange(0, len(songs))]
-                # Play next song in the lineup
-                else:
-                    if not (song_to_play <= len(songs) - 1):
-                        song_to_play = 0
-
-                    current_song = songs[song_to_play]
-
-                    if (song_to_play + 1) <= len(songs) - 1:
-                        next_song = (song_to_play + 1)
-                    else:
-                        next_song = 0
-
-                    cm.update_state('song_to_play', str(next_song))
+            elif next_song is not None:
+                cm.update_state('song_to_play', str(next_song))
 
             # Get filename to play and store the current song playing in state cfg
             self.song_filename = current_song[1]
@@ -819,11 +1080,17 @@ class Lightshow(object):
                 cm.fm.radio_text = current_song[0]
             cm.update_state('current_song', str(songs.index(current_song)))
 
+            # the songs after this one, to decode ahead
+            index = songs.index(current_song)
+            ahead = min(cm.audio_processing.pcm_cache_ahead, len(songs) - 1)
+            for offset in range(1, ahead + 1):
+                song = songs[(index + offset) % len(songs)]
+                self.upcoming.append(song[1].replace("$SYNCHRONIZED_LIGHTS_HOME", cm.home_dir))
+
         self.song_filename = self.song_filename.replace("$SYNCHRONIZED_LIGHTS_HOME", cm.home_dir)
 
         filename = os.path.abspath(self.song_filename)
-        self.config_filename = \
-            os.path.dirname(filename) + "/." + os.path.basename(self.song_filename) + ".cfg"
+        self.config_filename = self.song_config_filename(self.song_filename)
         self.cache_filename = \
             os.path.dirname(filename) + "/." + os.path.basename(self.song_filename) + ".sync"
 
@@ -845,15 +1112,23 @@ class Lightshow(object):
     def play_song(self):
         """Play the next song from the play list (or --file argument)."""
 
+        # undo the last song's custom configuration (--loop)
+        self.restore_config()
+
         # get the next song to play
         self.get_song()
 
+        # the song made ready while the last one played, if it was chosen
+        prepared = self.take_prepared()
+
         # load custom configuration from file
         self.load_custom_config()
 
-        # Initialize Lights
+        # Initialize Lights, they are left initialized from song to song (--loop)
         self.network.set_playing()
-        hc.initialize()
+        if not self.hardware_ready:
+            hc.initialize()
+            self.hardware_ready = args.loop
 
         # Handle the pre/post show
         play_now = int(cm.get_state('play_now', "0"))
@@ -874,29 +1149,42 @@ class Lightshow(object):
             play_now = 0
 
         # setup audio file and output device
-        self.setup_audio()
+        self.setup_audio(prepared)
 
         # setup our cache_matrix, std, mean
-        self.setup_cache()
+        self.setup_cache(prepared)
+
+        # hash and decode the next songs while this one plays
+        if self.sync_cache:
+            self.sync_cache.start_warmer(self.upcoming)
+        if self.pcm_cache and not args.createcache:
+            self.pcm_cache.start_warmer(self.upcoming)
 
         matrix_buffer = deque([], 1000)
+        self.decay = np.zeros(cm.hardware.gpio_len, dtype='float32')
+
+        # Process audio song_filename, decoded ahead in a thread of its own
+        # while playing.  --createcache reads the whole song at once.
+        if cm.audio_processing.read_ahead > 0 and not args.createcache:
+            if self.read_ahead is None:
+                self.read_ahead = self.start_read_ahead(self.music_file)
+            music_file = self.read_ahead
+        else:
+            music_file = self.music_file
 
-        # Process audio song_filename
         row = 0
-        data = self.music_file.readframes(self.chunk_size)
+        data = music_file.readframes(self.chunk_size)
 
         if args.createcache:
             total_frames = self.music_file.getnframes() / 100
 
             counter = 0
             percentage = 0
+            song_data = list()
 
             while data != b'':
-                # Compute FFT in this chunk, and cache results
-                matrix = self.fft_calc.calculate_levels(data)
-
-                # Add the matrix to the end of the cache
-                self.cache_matrix = np.vstack([self.cache_matrix, matrix])
+                # Collect the decoded song, the FFT is computed for all of it at once
+                song_data.append(data)
                 data = self.music_file.readframes(self.chunk_size)
 
                 if counter > total_frames:
@@ -909,6 +1197,18 @@ class Lightshow(object):
                                                                           percentage))
                 sys.stdout.flush()
 
+            # Compute FFT for every chunk of the song, and cache results
+            if cm.audio_processing.store_spectrum:
+                self.cache_matrix, spectrum = \
+                    self.fft_calc.calculate_levels_batch(b''.join(song_data),
+                                                         self.num_channels,
+                                                         spectrum=True)
+                self.song_cache.write_spectrum(spectrum, self.num_channels)
+            else:
+                self.cache_matrix = self.fft_calc.calculate_levels_batch(b''.join(song_data),
+                                                                         self.num_channels)
+            self.cache_rows = len(self.cache_matrix)
+
             sys.stdout.write("\rGenerating sync file for :%s %d%%" % (self.song_filename, 100))
             sys.stdout.flush()
 
@@ -917,6 +1217,10 @@ class Lightshow(object):
             play_now = False
             print("\nsaving sync file")
 
+        # get the next song ready while this one plays
+        if args.loop and not args.createcache:
+            self.start_preparing()
+
         while data != b'' and not play_now:
             # output data to sound device
             self.output(data)
@@ -934,8 +1238,8 @@ class Lightshow(object):
                 # No cache - Compute FFT in this chunk, and cache results
                 matrix = self.fft_calc.calculate_levels(data)
 
-                # Add the matrix to the end of the cache
-                self.cache_matrix = np.vstack([self.cache_matrix, matrix])
+                # Add the matrix to the cache
+                self.add_to_cache(row, matrix)
 
             matrix_buffer.appendleft(matrix)
 
@@ -944,18 +1248,28 @@ class Lightshow(object):
                 self.update_lights(matrix)
 
             # Read next chunk of data from music song_filename
-            data = self.music_file.readframes(self.chunk_size)
+            data = music_file.readframes(self.chunk_size)
             row += 1
 
             # Load new application state in case we've been interrupted
-            cm.load_state()
+            cm.refresh_state()
             play_now = int(cm.get_state('play_now', "0"))
 
+        if self.read_ahead is not None:
+            self.stop_read_ahead()
+
+        # the next song is prepared with the sync cache too, one at a time
+        self.finish_preparing()
+
+        # each song is opened anew, the one after it does not reuse this (--loop)
+        close_music_file(self.music_file)
+        self.music_file = None
+
         if not self.cache_found and not play_now:
             self.save_cache()
 
-        # Cleanup the pifm process
-        if cm.fm.enabled:
+        # Cleanup the pifm process, kept for the next song (--loop)
+        if cm.fm.enabled and not args.loop:
             self.fm_process.kill()
 
         # check for postshow
@@ -965,54 +1279,133 @@ class Lightshow(object):
             PrePostShow('postshow', hc).execute()
 
         # We're done, turn it all off and clean up things ;)
-        hc.clean_up()
+        if args.loop:
+            hc.turn_off_lights()
+        else:
+            hc.clean_up()
 
-    def network_client(self):
-        """Network client support
+    def play_show(self):
+        """Play songs one after another until stopped (--loop)
 
-        If in client mode, ignore everything else and just
-        read data from the network and blink the lights
+        The hardware, audio output and fft are kept from song to song, and
+        each song is opened, decoded ahead and has its sync data read while
+        the one before it plays.
         """
-        log.info("Network client mode starting")
-        print("Network client mode starting...")
-        print("press CTRL<C> to end")
+        while True:
+            self.play_song()
 
-        hc.initialize()
+    def start_preparing(self):
+        """Start making the next song ready to play, in a thread"""
+        self.prepared = None
+        self.preparing = Thread(target=self.prepare_song, args=(self.peek_song(),))
+        self.preparing.daemon = True
+        self.preparing.start()
 
-        print
+    def prepare_song(self, song_filename):
+        """Make a song ready to play
 
+        Opens the song, starts decoding it ahead and reads its sync data.
+
+        :param song_filename: path and name of the song
+        :type song_filename: str
+        """
+        prepared = PreparedSong(song_filename)
         try:
-            channels = self.network.channels
-            channel_keys = channels.keys()
+            prepared.music_file = self.open_song(song_filename)
+            if cm.audio_processing.read_ahead > 0:
+                prepared.read_ahead = self.start_read_ahead(prepared.music_file)
 
-            while True:
-                data = self.network.receive()
+            settings = self.custom_audio_processing(self.song_config_filename(song_filename))
+            prepared.fft_args = self.get_fft_args(prepared.music_file.getframerate(), settings)
 
-                if hc.led and isinstance(data[0], np.ndarray):
-                    for led_instance in hc.led:
-                        led_instance.write_all(data[0])
+            # only the config of this fft is used, the song is played with
+            # the (gpu) fft made when it starts
+            fft_calc = fft.FFT(*(prepared.fft_args[:-1] + (False,)))
+            prepared.song_cache = sync_cache.SongCache(song_filename, fft_calc, self.sync_cache)
 
-                if isinstance(data[0], int):
-                    pin = data[0]
-                    if pin in channel_keys:
-                        hc.set_light(channels[pin], True, float(data[1]))
-                    continue
+            if args.readcache:
+                try:
+                    prepared.sync_data = prepared.song_cache.read()
+                except IOError:
+                    pass
+        except Exception as error:
+            log.warning("Can not prepare the next song %s: %s" % (song_filename, str(error)))
+            prepared.discard()
+            return
 
-                elif isinstance(data[0], np.ndarray):
-                    brightness_levels = data[0]
+        self.prepared = prepared
 
-                else:
-                    continue
+    def finish_preparing(self):
+        """Wait for the next song to be ready"""
+        if self.preparing is not None:
+            self.preparing.join()
+            self.preparing = None
+
+    def take_prepared(self):
+        """The song made ready while the last one played
 
-                for pin in channel_keys:
-                    hc.set_light(channels[pin], True, brightness_levels[pin])
+        :return: the prepared song, None if there is none or another song
+            was chosen (votes, play now, a new playlist)
+        :rtype: PreparedSong | None
+        """
+        self.finish_preparing()
+        prepared, self.prepared = self.prepared, None
 
-        except KeyboardInterrupt:
-            log.info("CTRL<C> pressed, stopping")
-            print("stopping")
+        if prepared is not None and prepared.song_filename != self.song_filename:
+            log.info("Next song changed, not using the prepared " + prepared.song_filename)
+            prepared.discard()
+            return None
 
-            self.network.close_connection()
-            hc.clean_up()
+        return prepared
+
+    def start_read_ahead(self, music_file):
+        """Start decoding a song ahead of playback
+
+        The buffer holds read_ahead seconds of the song.
+
+        :param music_file: the song
+        :type music_file: object
+
+        :return: the reader, playback takes chunks from it
+        :rtype: read_ahead.ReadAhead
+        """
+        capacity = int(cm.audio_processing.read_ahead * music_file.getframerate() / self.chunk_size)
+        reader = read_ahead.ReadAhead(music_file,
+                                      self.chunk_size,
+                                      2 * music_file.getnchannels(),
+                                      capacity)
+        reader.start()
+
+        return reader
+
+    def stop_read_ahead(self):
+        """Stop decoding ahead and log how well the buffer kept up"""
+        self.read_ahead.stop()
+        self.read_ahead.join()
+
+        seconds_per_chunk = float(self.chunk_size) / self.sample_rate
+        lowest = self.read_ahead.lowest or 0
+        message = "Read ahead: lowest fill %.1f of %.1f sec, %d underruns (%.2f sec waiting)" % \
+                  (lowest * seconds_per_chunk,
+                   self.read_ahead.capacity * seconds_per_chunk,
+                   self.read_ahead.underruns,
+                   self.read_ahead.wait_time)
+        if self.read_ahead.underruns:
+            log.warning(message)
+        else:
+            log.info(message)
+
+        self.read_ahead = None
+
+    def network_client(self):
+        """Network client support
+
+        If in client mode, ignore everything else and just
+        read data from the network and blink the lights
+
+        py/network_client.py does the same without loading the audio modules
+        """
+        network_client.run(hc, self.network)
 
     def launch_curses(self, screen):
         self.terminal.init(screen)
@@ -1046,5 +1439,8 @@ if __name__ == "__main__":
     elif lightshow.client:
         lightshow.network_client()
 
+    elif args.loop and not args.createcache:
+        lightshow.play_show()
+
     else:
         lightshow.play_song()
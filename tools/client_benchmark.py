@@ -0,0 +1,72 @@
+#
+# Network client startup benchmark for lightshowpi
+#
+# Usage:
+# python3 client_benchmark.py --runs=5 --config=client.cfg
+#
+# Starts a network client the way synchronized_lights.py does (everything it
+# imports and the hardware controller) and the way network_client.py does,
+# each in a fresh python process, and prints how long each took to be ready
+# to receive frames and the memory each process used.  Run it on the client
+# with networking = client configured, the lights are not touched.
+
+import argparse
+import os
+import subprocess
+import sys
+
+HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
+if not HOME_DIR:
+    print("Need to setup SYNCHRONIZED_LIGHTS_HOME environment variable, "
+          "see readme")
+    sys.exit()
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', default=None, help='Config File Override')
+parser.add_argument('--runs', default=5, type=int,
+                    help='times to start each client')
+args = parser.parse_args()
+
+# code run in the new process, prints the seconds taken and the peak rss in kB
+SETUP = """
+import resource, sys, time
+start = time.time()
+sys.path.insert(0, %(py)r)
+sys.argv = ["client"] + %(argv)r
+%(code)s
+print(time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+CLIENTS = [
+    ("synchronized_lights.py", "import synchronized_lights"),
+    ("network_client.py", "import network_client, hardware_controller\n"
+                          "hardware_controller.Hardware(param_config=%r)" % args.config),
+]
+
+
+def start_client(code):
+    argv = ["--config=" + args.config] if args.config else []
+    setup = SETUP % {"py": HOME_DIR + "/py", "argv": argv, "code": code}
+
+    output = subprocess.check_output([sys.executable, "-c", setup], cwd=HOME_DIR + "/py")
+    seconds, rss = output.split()[-2:]
+
+    return float(seconds), int(rss) / 1024.0
+
+
+def main():
+    results = dict()
+    for name, code in CLIENTS:
+        runs = sorted(start_client(code) for _ in range(args.runs))
+        seconds = runs[len(runs) // 2][0]
+        rss = max(rss for _, rss in runs)
+        results[name] = seconds, rss
+        print("%-24s %6.2f seconds %6.1f MB" % (name + ":", seconds, rss))
+
+    old, new = (results[name] for name, _ in CLIENTS)
+    print("network_client.py starts %.1fx faster and uses %.1f MB less" % (old[0] / new[0],
+                                                                           old[1] - new[1]))
+
+
+if __name__ == "__main__":
+    main()
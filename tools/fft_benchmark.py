@@ -0,0 +1,121 @@
+#
+# FFT benchmark for lightshowpi
+#
+# Usage:
+# python3 fft_benchmark.py --seconds=300 --config=overrides.cfg
+#
+# Builds the sync cache for a synthetic song twice, once a chunk at a time with
+# calculate_levels and np.vstack (how caches used to be built) and once with
+# calculate_levels_batch, then prints the time taken by each and checks
+# that both produced the same rows.  It then makes the fine spectrum
+# (store_spectrum) and checks the levels made from it against the fft.  This
+# is done for a stereo and a mono song, --channels for just one of them.
+# The fft settings are read from your configuration, --gpu uses the Pi GPU
+# for the fft like use_gpu does.
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
+if not HOME_DIR:
+    print("Need to setup SYNCHRONIZED_LIGHTS_HOME environment variable, "
+          "see readme")
+    sys.exit()
+
+sys.path.insert(0, HOME_DIR + '/py')
+import configuration_manager
+import fft
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', default=None, help='Config File Override')
+parser.add_argument('--seconds', default=60, type=float,
+                    help='length of the synthetic song in seconds')
+parser.add_argument('--sample_rate', default=44100, type=int,
+                    help='sample rate of the synthetic song')
+parser.add_argument('--gpu', action="store_true",
+                    help='use the Pi GPU for the fft')
+parser.add_argument('--channels', default=None, type=int, choices=[1, 2],
+                    help='channels of the synthetic song, both by default')
+args = parser.parse_args()
+
+cm = configuration_manager.Configuration(param_config=args.config)
+
+
+def make_fft():
+    return fft.FFT(cm.audio_processing.chunk_size,
+                   args.sample_rate,
+                   cm.hardware.gpio_len,
+                   cm.audio_processing.min_frequency,
+                   cm.audio_processing.max_frequency,
+                   cm.audio_processing.custom_channel_mapping,
+                   cm.audio_processing.custom_channel_frequencies,
+                   2,
+                   args.gpu)
+
+
+def make_song(num_channels):
+    """A song of a few tones over some noise, with a silent gap"""
+    frames = int(args.seconds * args.sample_rate)
+    t = np.arange(frames) / float(args.sample_rate)
+    song = np.random.normal(0, 500, frames)
+    for frequency in (55, 220, 880, 3520, 7040):
+        song += 2000 * np.sin(2 * np.pi * frequency * t) * (1 + np.sin(t * frequency / 100)) / 2
+    song[frames // 4:frames // 4 + args.sample_rate] = 0
+    song = np.clip(song, -32768, 32767).astype(np.int16)
+
+    return np.repeat(song[:, None], num_channels, axis=1).tobytes()
+
+
+def per_chunk(fft_calc, data, num_channels):
+    chunk_bytes = cm.audio_processing.chunk_size * num_channels * 2
+    cache_matrix = np.empty(shape=[0, cm.hardware.gpio_len])
+
+    for start in range(0, len(data), chunk_bytes):
+        matrix = fft_calc.calculate_levels(data[start:start + chunk_bytes])
+        cache_matrix = np.vstack([cache_matrix, matrix])
+
+    return cache_matrix
+
+
+def compare(num_channels):
+    data = make_song(num_channels)
+    print("song: %.0f seconds, %d audio channels, %d channels, chunk_size %d" %
+          (args.seconds, num_channels, cm.hardware.gpio_len, cm.audio_processing.chunk_size))
+
+    start = time.time()
+    chunked = per_chunk(make_fft(), data, num_channels)
+    chunk_time = time.time() - start
+    print("per chunk: %8.3f seconds" % chunk_time)
+
+    start = time.time()
+    batched = make_fft().calculate_levels_batch(data, num_channels)
+    batch_time = time.time() - start
+    print("batch:     %8.3f seconds" % batch_time)
+
+    print("speedup:   %8.1fx" % (chunk_time / batch_time))
+    print("rows identical: %s (%d rows)" % (np.array_equal(chunked, batched), len(batched)))
+
+    fft_calc = make_fft()
+    levels, spectrum = fft_calc.calculate_levels_batch(data, num_channels, spectrum=True)
+    from_spectrum = fft_calc.levels_from_spectrum(spectrum, num_channels)
+
+    # the trailing partial chunk has no spectrum
+    rows = len(data) // (cm.audio_processing.chunk_size * num_channels * 2)
+    difference = np.abs(from_spectrum[:rows] - levels[:rows])
+    print("spectrum: %d bands, rows identical: %s, levels from it within %.3f "
+          "(99th percentile %.3f)" % (spectrum.shape[1], np.array_equal(levels, batched),
+                                      difference.max(), np.percentile(difference, 99)))
+
+
+def main():
+    for num_channels in [args.channels] if args.channels else [2, 1]:
+        compare(num_channels)
+        print("")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#
+# sACN benchmark for lightshowpi
+#
+# Usage:
+# python3 sacn_benchmark.py --universes=32 --changing=4 --frames=2000
+#
+# Sends frames of random pixels to a UDP sink on localhost twice, once
+# building a new E131Packet for every universe of every frame (how
+# DriverSACN used to send) and once with DriverSACN, then prints the frame
+# rate each managed and the packets that arrived.  Only the first --changing
+# universes change from frame to frame, DriverSACN sends just those (and a
+# keepalive for the others).
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
+if not HOME_DIR:
+    print("Need to setup SYNCHRONIZED_LIGHTS_HOME environment variable, "
+          "see readme")
+    sys.exit()
+
+sys.path.insert(0, HOME_DIR + '/py')
+from driver_sacn import DriverSACN
+from e131packet import E131Packet
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--universes', default=32, type=int,
+                    help='number of universes to send each frame')
+parser.add_argument('--boundary', default=510, type=int,
+                    help='channels in each universe')
+parser.add_argument('--frames', default=2000, type=int,
+                    help='frames to send')
+parser.add_argument('--changing', default=None, type=int,
+                    help='universes that change each frame, default all of them')
+args = parser.parse_args()
+if args.changing is None:
+    args.changing = args.universes
+
+NUM_LEDS = args.universes * args.boundary // 3
+
+
+class Sink(threading.Thread):
+    """Count the packets arriving on a local UDP port"""
+
+    def __init__(self):
+        super(Sink, self).__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.received = 0
+
+    def run(self):
+        while True:
+            self.sock.recv(2048)
+            self.received += 1
+
+
+def make_frames():
+    frames = np.random.randint(0, 256, (16, NUM_LEDS * 3), dtype=np.uint8)
+    frames[:, args.changing * args.boundary:] = frames[0, args.changing * args.boundary:]
+
+    return [frame.tobytes() for frame in frames]
+
+
+def per_packet(port, frames):
+    """Send the way DriverSACN used to, a new E131Packet per universe"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    boundary = args.boundary
+
+    for frame in range(args.frames):
+        data = bytearray(frames[frame % len(frames)])
+        for universe in range(args.universes):
+            udata = data[universe * boundary:(universe + 1) * boundary]
+            packet = E131Packet(universe=universe + 1, data=udata, sequence=frame % 256)
+            sock.sendto(packet.packet_data, ("127.0.0.1", port))
+
+
+def driver(port, frames):
+    sacn = DriverSACN(num=NUM_LEDS, host="127.0.0.1", port=port,
+                      universe_boundary=args.boundary)
+
+    for frame in range(args.frames):
+        sacn._buf[:] = frames[frame % len(frames)]
+        sacn._send_packet()
+
+
+def run(name, send, frames):
+    sink = Sink()
+    sink.start()
+
+    start = time.time()
+    send(sink.port, frames)
+    elapsed = time.time() - start
+
+    time.sleep(0.2)
+    print("%-11s %8.1f fps %8d packets received" %
+          (name, args.frames / elapsed, sink.received))
+
+    return elapsed
+
+
+def main():
+    frames = make_frames()
+    print("%d universes of %d channels, %d changing, %d frames" % (args.universes,
+                                                                  args.boundary,
+                                                                  args.changing,
+                                                                  args.frames))
+
+    packet_time = run("E131Packet:", per_packet, frames)
+    driver_time = run("DriverSACN:", driver, frames)
+
+    print("speedup:    %8.1fx" % (packet_time / driver_time))
+
+
+if __name__ == "__main__":
+    main()
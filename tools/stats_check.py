@@ -0,0 +1,108 @@
+#
+# Sync file stats check for lightshowpi
+#
+# Usage:
+# python3 stats_check.py --channels=16
+#
+# Computes the mean and standard deviation of each channel with
+# sync_file.stats and with a loop over the channels (how they used to be
+# computed when a sync file was saved), for "mean" and "percentile" stats,
+# then checks that both agree.  Long songs are summed in another order, so
+# their means may differ in the last bits.  This is done for level matrices
+# of a few rows and of odd lengths, each with a channel that is never on,
+# and the time taken by each is printed for the longest one.
+
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+
+HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
+if not HOME_DIR:
+    print("Need to setup SYNCHRONIZED_LIGHTS_HOME environment variable, "
+          "see readme")
+    sys.exit()
+
+sys.path.insert(0, HOME_DIR + '/py')
+import sync_file
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--channels', default=16, type=int,
+                    help='channels in each level matrix')
+parser.add_argument('--rows', default=[1, 2, 3, 7, 64, 1001, 13001], type=int, nargs='+',
+                    help='rows of each level matrix')
+args = parser.parse_args()
+
+
+def make_levels(rows):
+    """Levels of a song, some chunks off, the last channel never on"""
+    levels = np.random.normal(8, 3, (rows, args.channels))
+    levels[np.random.random(levels.shape) < 0.2] = 0
+    levels[:, -1] = 0
+
+    return levels
+
+
+def per_pin(levels, mode):
+    mean = np.empty(args.channels)
+    std = np.empty(args.channels)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for pin in range(0, args.channels):
+            on = [item for item in levels[:, pin] if item > 0]
+            if mode == "percentile":
+                if not on:
+                    mean[pin] = std[pin] = np.nan
+                    continue
+                low, mean[pin], high = np.percentile(on, [sync_file.LOW_PERCENTILE, 50.0,
+                                                          sync_file.HIGH_PERCENTILE])
+                std[pin] = (high - low) / 2
+            else:
+                std[pin] = np.std(on)
+                mean[pin] = np.mean(on)
+
+    return mean, std
+
+
+def compare(levels, mode):
+    looped = per_pin(levels, mode)
+    vectorised = sync_file.stats(levels, mode)
+
+    identical = all(np.array_equal(a, b, equal_nan=True) for a, b in zip(looped, vectorised))
+    close = all(np.allclose(a, b, equal_nan=True) for a, b in zip(looped, vectorised))
+    difference = max(np.nanmax(np.abs(a - b)) for a, b in zip(looped, vectorised))
+    print("%-10s %6d rows: values identical: %-5s within %.2e" %
+          (mode, len(levels), identical, difference))
+
+    return close
+
+
+def main():
+    ok = True
+    for mode in ["mean", "percentile"]:
+        for rows in args.rows:
+            ok = compare(make_levels(rows), mode) and ok
+
+        levels = make_levels(max(args.rows))
+        start = time.time()
+        per_pin(levels, mode)
+        loop_time = time.time() - start
+
+        start = time.time()
+        sync_file.stats(levels, mode)
+        stats_time = time.time() - start
+        print("%-10s per pin: %.4f seconds, stats: %.4f seconds, speedup %.1fx" %
+              (mode, loop_time, stats_time, loop_time / stats_time))
+        print("")
+
+    print("all agree: %s" % ok)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,16 +6,35 @@
 # Enter y to confirm that you wish to run this
 # Enter the path to the folder containing your audio files
 # along with the sync files it will also generate a playlist file
-# enter the path to this playlist file in your overrides.cfg and 
+# enter the path to this playlist file in your overrides.cfg and
 # lightshowpi will use this as your new playlist
+#
+# Or without the questions, for a folder (a playlist is written there too)
+# or for the songs of a playlist:
+#
+# python3 sync_file_generator.py --directory=/home/pi/lightshowpi/music
+# python3 sync_file_generator.py --playlist=/home/pi/lightshowpi/music/.playlist
+#
+# Songs are analyzed in parallel, one process for each core (--jobs to
+# change that, each needs memory for a whole decoded song, about 50MB for 5
+# minutes).  Songs that already have an up to date sync file are skipped
+# (--force to make them all again), so a run that is stopped carries on
+# where it left off when it is run again.  Files a stopped run left half
+# written are removed.  Songs with a spectrum file (see
+# store_spectrum in defaults.cfg) get their sync file without being decoded.
+#
+# Sync files are made with the same code synchronized_lights.py uses, with
+# the [custom_audio_processing] settings of each song's .cfg file.
 
+import argparse
 import decoder
 import glob
+import multiprocessing
 import mutagen
-import numpy as np
 import os
+import signal
 import sys
-import wave
+import time
 
 HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
 if not HOME_DIR:
@@ -31,189 +50,298 @@ path = list(sys.path)
 sys.path.insert(0, HOME_DIR + "/py")
 
 # import the configuration_manager and fft now that we can
+import configuration_manager
 import fft
+import sync_cache
+import sync_file
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--directory', default=None,
+                    help='make sync files for the songs in this folder, and a playlist of them')
+parser.add_argument('--playlist', default=None,
+                    help='make sync files for the songs in this playlist')
+parser.add_argument('--jobs', default=os.cpu_count() or 1, type=int,
+                    help='songs to analyze at once, defaults to the number of cores')
+parser.add_argument('--force', action='store_true',
+                    help='make sync files even for songs that have an up to date one')
+parser.add_argument('--config', default=None, help='Config File Override')
+args = parser.parse_args()
+
+cm = configuration_manager.Configuration(param_config=args.config)
+
+# sync files go to the central cache when sync_cache_dir is set
+SYNC_CACHE = None
+if cm.audio_processing.sync_cache_dir:
+    SYNC_CACHE = sync_cache.SyncCache(cm.audio_processing.sync_cache_dir,
+                                      cm.audio_processing.sync_cache_size)
+
+AUDIO_FILE_TYPES = ["*.mp3", "*.mp4",
+                    "*.m4a", "*.m4b",
+                    "*.aac", "*.ogg",
+                    "*.flac", "*.oga",
+                    "*.wma", "*.wav"]
+
+
+def fft_settings(song_filename):
+    """The fft settings for a song, as synchronized_lights.py uses them
+
+    :param song_filename: path and name of the song
+    :type song_filename: str
+
+    :return: min_frequency, max_frequency, custom_channel_mapping and
+        custom_channel_frequencies, with the overrides in the
+        [custom_audio_processing] section of the song's .cfg file
+    :rtype: dict
+    """
+    config_filename = os.path.join(os.path.dirname(song_filename),
+                                   "." + os.path.basename(song_filename) + ".cfg")
 
-import hardware_controller
-
-hc = hardware_controller.Hardware()
-
-# get copy of configuration manager
-cm = hc.cm
-
-#### reusing code from synchronized_lights.py
-#### no need to reinvent the wheel
-
-GPIOLEN = cm.hardware.gpio_len 
-_MIN_FREQUENCY = cm.audio_processing.min_frequency
-_MAX_FREQUENCY = cm.audio_processing.max_frequency
-
-try:
-    _CUSTOM_CHANNEL_MAPPING = cm.audio_processing.custom_channel_mapping
-except:
-    _CUSTOM_CHANNEL_MAPPING = 0
+    return configuration_manager.custom_audio_processing(config_filename,
+                                                         cm.audio_processing.get_config())
 
-try:
-    _CUSTOM_CHANNEL_FREQUENCIES = cm.audio_processing.custom_channel_frequencies
-except:
-    _CUSTOM_CHANNEL_FREQUENCIES = 0
 
-CHUNK_SIZE = 2048  # Use a multiple of 8 (move this to config)
+def open_song(song_filename):
+    """Open a song with the decoder, as synchronized_lights.py does
 
-def calculate_channel_frequency(min_frequency,
-                                max_frequency,
-                                custom_channel_mapping,
-                                custom_channel_frequencies):
-    """
-    Calculate frequency values
+    :param song_filename: path and name of the song
+    :type song_filename: str
 
-    Calculate frequency values for each channel,
-    taking into account custom settings.
+    :return: the decoder's file
+    :rtype: object
     """
+    force_header = any(ax in song_filename for ax in [".mp4", ".m4a", ".m4b"])
 
-    # How many channels do we need to calculate the frequency for
-    if custom_channel_mapping != 0 and len(custom_channel_mapping) == GPIOLEN:
-        channel_length = max(custom_channel_mapping)
-    else:
-        channel_length = GPIOLEN
-
-    octaves = (np.log(max_frequency / min_frequency)) / np.log(2)
-    octaves_per_channel = octaves / channel_length
-    frequency_limits = []
-    frequency_store = []
+    return decoder.open(song_filename, force_header)
 
-    frequency_limits.append(min_frequency)
-    if custom_channel_frequencies != 0 and (len(custom_channel_frequencies)
-                                            >= channel_length + 1):
-        frequency_limits = custom_channel_frequencies
-    else:
-        for i in range(1, GPIOLEN + 1):
-            frequency_limits.append(frequency_limits[-1]
-                                    * 10 ** (3 /
-                                             (10 * (1 / octaves_per_channel))))
-    for i in range(0, channel_length):
-        frequency_store.append((frequency_limits[i], frequency_limits[i + 1]))
-
-    # we have the frequencies now lets map them if custom mapping is defined
-    if custom_channel_mapping != 0 and len(custom_channel_mapping) == GPIOLEN:
-        frequency_map = []
-        for i in range(0, GPIOLEN):
-            mapped_channel = custom_channel_mapping[i] - 1
-            mapped_frequency_set = frequency_store[mapped_channel]
-            mapped_frequency_set_low = mapped_frequency_set[0]
-            mapped_frequency_set_high = mapped_frequency_set[1]
-            frequency_map.append(mapped_frequency_set)
-        return frequency_map
-    else:
-        return frequency_store
 
 def cache_song(song_filename):
-    """Play the next song from the play list (or --file argument)."""
-    # Initialize FFT stats
-    matrix = [0 for _ in range(GPIOLEN)] # get length of gpio and assign it to a variable
-
-    # Set up audio
-    if song_filename.endswith('.wav'):
-        musicfile = wave.open(song_filename, 'r')
-    else:
-        musicfile = decoder.open(song_filename)
-
-    sample_rate = musicfile.getframerate()
-    num_channels = musicfile.getnchannels()
+    """Make the sync file for a song, unless it has an up to date one
 
-    fft_calc = fft.FFT(CHUNK_SIZE,
-                       sample_rate,
-                       GPIOLEN,
-                       _MIN_FREQUENCY,
-                       _MAX_FREQUENCY,
-                       _CUSTOM_CHANNEL_MAPPING,
-                       _CUSTOM_CHANNEL_FREQUENCIES)
+    Runs in the worker processes.
 
-    song_filename = os.path.abspath(song_filename)
+    :param song_filename: path and name of the song
+    :type song_filename: str
 
-    # create empty array for the cache_matrix
-    cache_matrix = np.empty(shape=[0, GPIOLEN])
-    cache_filename = \
-        os.path.dirname(song_filename) + "/." + os.path.basename(song_filename) + ".sync"
+    :return: the song, what was done and the seconds it took
+    :rtype: tuple
+    """
+    start = time.time()
+    musicfile = None
+    try:
+        # the sample rate from the tags, so up to date songs are not decoded
+        metadata = mutagen.File(song_filename)
+        sample_rate = getattr(getattr(metadata, "info", None), "sample_rate", None)
+        if not sample_rate:
+            musicfile = open_song(song_filename)
+            sample_rate = musicfile.getframerate()
+
+        # every worker runs the numpy fft, they do not compete for the gpu
+        settings = fft_settings(song_filename)
+        fft_calc = fft.FFT(cm.audio_processing.chunk_size,
+                           sample_rate,
+                           cm.hardware.gpio_len,
+                           settings["min_frequency"],
+                           settings["max_frequency"],
+                           settings["custom_channel_mapping"],
+                           settings["custom_channel_frequencies"],
+                           2,
+                           False)
+
+        song_cache = sync_cache.SongCache(song_filename, fft_calc, SYNC_CACHE)
+        if not args.force and song_cache.is_current():
+            return song_filename, "up to date", time.time() - start
+
+        if musicfile is None:
+            musicfile = open_song(song_filename)
+
+        # A song with a spectrum file does not need to be decoded again
+        cache_matrix = None
+        if not args.force:
+            cache_matrix = song_cache.levels_from_spectrum(musicfile.getnchannels())
+        status = "from spectrum"
+
+        if cache_matrix is None:
+            # Decode the whole song, then compute the FFT for every chunk of it at once
+            song_data = list()
+            data = musicfile.readframes(cm.audio_processing.chunk_size)
+            while data != b'':
+                song_data.append(data)
+                data = musicfile.readframes(cm.audio_processing.chunk_size)
+
+            if cm.audio_processing.store_spectrum:
+                cache_matrix, spectrum = \
+                    fft_calc.calculate_levels_batch(b''.join(song_data),
+                                                    musicfile.getnchannels(),
+                                                    spectrum=True)
+                song_cache.write_spectrum(spectrum, musicfile.getnchannels())
+            else:
+                cache_matrix = fft_calc.calculate_levels_batch(b''.join(song_data),
+                                                               musicfile.getnchannels())
+            status = "analyzed"
+
+        # Compute the standard deviation and mean values for the cache
+        mean, std = sync_file.stats(cache_matrix, cm.audio_processing.sync_stats)
+        song_cache.write(mean, std, cache_matrix)
+    except Exception as error:
+        # one bad song does not stop the others
+        status = "failed: " + str(error)
+    finally:
+        # the workers live for the whole run
+        close = getattr(musicfile, "close", None)
+        if close is not None:
+            close()
+
+    return song_filename, status, time.time() - start
+
+
+def find_songs(location):
+    """Every song in a folder
+
+    :param location: path to the folder
+    :type location: str
+
+    :return: path and name of each song
+    :rtype: list
+    """
+    songs = list()
+    for file_type in AUDIO_FILE_TYPES:
+        songs.extend(glob.glob(os.path.join(location, file_type)))
 
-    # The values 12 and 1.5 are good estimates for first time playing back 
-    # (i.e. before we have the actual mean and standard deviations 
-    # calculated for each channel).
-    mean = [12.0 for _ in range(GPIOLEN)]
-    std = [1.5 for _ in range(GPIOLEN)]
+    return sorted(songs)
 
-    # Process audio song_filename
-    row = 0
-    data = musicfile.readframes(CHUNK_SIZE) # move chunk_size to configuration_manager
 
-    while data != b'':
-        # No cache - Compute FFT in this chunk, and cache results
-        matrix = fft_calc.calculate_levels(data)
+def write_playlist(location, songs):
+    """Write a playlist of songs in location
 
-        # Add the matrix to the end of the cache 
-        cache_matrix = np.vstack([cache_matrix, matrix])
+    :param location: path to the folder
+    :type location: str
 
-        # Read next chunk of data from music song_filename
-        data = musicfile.readframes(CHUNK_SIZE)
-        row = row + 1
+    :param songs: path and name of each song
+    :type songs: list
+    """
+    with open(os.path.join(location, "playlist"), "w") as playlist_fp:
+        for song in songs:
+            metadata = mutagen.File(song, easy=True)
+            if metadata is not None and "title" in metadata:
+                title = metadata["title"][0]
+            else:
+                title = os.path.splitext(os.path.basename(song))[0].strip()
+                title = title.replace("_", " ")
+                title = title.replace("-", " - ")
+            playlist_fp.write(title + "\t" + song + "\n")
 
-    # Compute the standard deviation and mean values for the cache
-    for i in range(0, GPIOLEN):
-        std[i] = np.std([item for item in cache_matrix[:, i] if item > 0])
-        mean[i] = np.mean([item for item in cache_matrix[:, i] if item > 0])
 
-    # Add mean and std to the top of the cache
-    cache_matrix = np.vstack([mean, cache_matrix])
-    cache_matrix = np.vstack([std, cache_matrix])
+def format_seconds(seconds):
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
 
-    # Save the cache using numpy savetxt
-    np.savetxt(cache_filename, cache_matrix)
 
-#### end reuse 
+def ignore_interrupt():
+    """Leave CTRL<C> to the main process, which stops the workers"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-def main():        
-    print ("Do you want to generate sync files?")
-    print 
-    print ("This could take a while if you have a lot of songs")
 
-    question = input("Would you like to proceed? (Y to continue) :")
+def remove_temp_files(songs):
+    """Remove the sync and spectrum files a stopped run left half written
 
-    if not question in ["y", "Y"]:
-        sys.exit(0)
+    :param songs: path and name of each song
+    :type songs: list
+    """
+    temp_files = list()
+    for extension in sync_cache.SyncCache.EXTENSIONS:
+        temp_extension = extension + sync_file.TEMP_EXTENSION
+        for song in songs:
+            temp_files.append(os.path.join(os.path.dirname(song),
+                                           "." + os.path.basename(song) + temp_extension))
+        if SYNC_CACHE:
+            temp_files.extend(glob.glob(os.path.join(SYNC_CACHE.directory, "*" + temp_extension)))
 
-    location = input("Enter the path to the folder of songs:")
-    location += "/"
+    for temp_file in temp_files:
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
 
-    sync_list = list()
-    audio_file_types = ["*.mp3", "*.mp4",
-                        "*.m4a", "*.m4b",
-                        "*.aac", "*.ogg",
-                        "*.flac", "*.oga",
-                        "*.wma", "*.wav"]
 
-    for file_type in audio_file_types:
-        sync_list.extend(glob.glob(location + file_type))
+def cache_songs(songs):
+    """Make the sync files for songs across a pool of processes
 
-    playlistFile = open(location + "playlist", "w")
+    Progress and the estimated time left are printed as each song is done.
+    The estimate comes from the bytes of song analyzed per second so far,
+    songs that were up to date do not count.
 
-    for song in sync_list:
-        print ("Generating sync file for",song)
-        cache_song(song)
-        print ("cached")
+    :param songs: path and name of each song
+    :type songs: list
 
-        metadata = mutagen.File(song, easy=True)
-        if "title" in metadata:
-            title = metadata["title"][0]
-        else:
-            title = os.path.splitext(os.path.basename(song))[0].strip()
-            title = title.replace("_", " ")
-            title = title.replace("-", " - ")
-        playlistFile.write(title + "\t" + song + "\n")
+    :return: False if CTRL<C> stopped it
+    :rtype: bool
+    """
+    sizes = dict((song, os.path.getsize(song)) for song in songs)
+    remaining = sum(sizes.values())
+    analyzed = 0
+    counts = dict()
+    start = time.time()
+
+    remove_temp_files(songs)
+    stopped = False
+    pool = multiprocessing.Pool(max(args.jobs, 1), ignore_interrupt)
+    try:
+        for done, (song, status, seconds) in enumerate(pool.imap_unordered(cache_song, songs), 1):
+            remaining -= sizes[song]
+            if status in ("analyzed", "from spectrum"):
+                analyzed += sizes[song]
+
+            elapsed = time.time() - start
+            eta = elapsed / analyzed * remaining if analyzed else 0.0
+            counts[status.split(":")[0]] = counts.get(status.split(":")[0], 0) + 1
+
+            print("%4d/%d  %3d%%  elapsed %s  eta %s  %-13s %s (%.1fs)" %
+                  (done, len(songs), 100 * done // len(songs), format_seconds(elapsed),
+                   format_seconds(eta), status, os.path.basename(song), seconds))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        stopped = True
+    finally:
+        pool.join()
+
+    if stopped:
+        # the workers were killed in the middle of writing files
+        remove_temp_files(songs)
+        print("\nStopped, run again to carry on where this left off")
+        return False
+
+    print("Done in %s: %s" % (format_seconds(time.time() - start),
+                              ", ".join("%d %s" % (count, status)
+                                        for status, count in sorted(counts.items()))))
+    return True
+
+
+def main():
+    location = args.directory
+    if args.playlist is None and location is None:
+        print ("Do you want to generate sync files?")
+        print
+        print ("This could take a while if you have a lot of songs")
+
+        question = input("Would you like to proceed? (Y to continue) :")
+
+        if not question in ["y", "Y"]:
+            sys.exit(0)
+
+        location = input("Enter the path to the folder of songs:")
+
+    if args.playlist is not None:
+        songs = [song[1].replace("$SYNCHRONIZED_LIGHTS_HOME", cm.home_dir)
+                 for song in cm.get_playlist(args.playlist)]
+    else:
+        songs = find_songs(location)
+        write_playlist(location, songs)
 
-    playlistFile.close()
+    print ("Generating sync files for %d songs, %d at a time" % (len(songs), args.jobs))
+    finished = cache_songs(songs)
 
-    print ("All Finished.")
-    print ("A playlist was also generated")
-    print (location + "playlist")
+    if finished and args.playlist is None:
+        print ("All Finished.")
+        print ("A playlist was also generated")
+        print (os.path.join(location, "playlist"))
     sys.path[:] = path
 
 if __name__ == "__main__":